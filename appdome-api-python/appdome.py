@@ -0,0 +1,50 @@
+import argparse
+import sys
+from importlib import import_module
+
+# Command modules (and requests) are only imported once a command is chosen, so help and argument errors return right away
+COMMANDS = {
+    'run': ('appdome_api', 'Upload, build, sign and download an app in one go'),
+    'batch': ('batch', 'Run the whole process for many apps from a manifest'),
+    'daemon': ('daemon', 'Run jobs submitted over a local HTTP or Unix socket, keeping connections warm between jobs'),
+    'upload': ('upload', 'Upload app to Appdome'),
+    'build': ('build', 'Initialize Build app on Appdome'),
+    'status': ('status', 'Wait for status of task to be done'),
+    'context': ('context', 'Initialize Context on Appdome'),
+    'sign': ('sign', 'Initialize signing on Appdome'),
+    'private_sign': ('private_sign', 'Initialize private signing on Appdome'),
+    'auto_dev_sign': ('auto_dev_sign', 'Initialize Auto-DEV private signing on Appdome'),
+    'download': ('download', 'Download final output from Appdome'),
+    'certified_secure': ('certified_secure', 'Download Certified Secure pdf file'),
+    'certified_secure_json': ('certified_secure_json', 'Download Certified Secure json file'),
+    'validate': ('validate', 'Validate App after local signing'),
+    'preflight': ('preflight', 'Check an app file before uploading it to Appdome'),
+    'mock_server': ('mock_server', 'Run a local stand-in for the Appdome API and storage endpoints'),
+    'benchmark': ('benchmark', 'Measure the client end to end against a local mock Appdome server'),
+}
+
+
+def parse_arguments(argv=None):
+    commands_help = '\n'.join(f"  {name:<24}{description}" for name, (module_name, description) in COMMANDS.items())
+    parser = argparse.ArgumentParser(prog='appdome.py', description='Runs Appdome API commands',
+                                     formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     epilog=f"commands:\n{commands_help}\n\nRun 'appdome.py <command> -h' for the arguments of a command")
+    parser.add_argument('command', choices=COMMANDS, metavar='command', help='Command to run, see below')
+    # Everything after the command, including -h, is left to the command's own parser
+    argv = sys.argv[1:] if argv is None else argv
+    command_index = next((i for i, arg in enumerate(argv) if not arg.startswith('-')), len(argv))
+    args = parser.parse_args(argv[:command_index + 1])
+    args.command_args = argv[command_index + 1:]
+    return args
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    module_name = COMMANDS[args.command][0]
+    # The command scripts parse sys.argv themselves, and show it as their usage prefix
+    sys.argv = [f"appdome.py {args.command}"] + args.command_args
+    import_module(module_name).main()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,44 @@
 import argparse
+import json
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import ExitStack
 from enum import Enum
+from functools import partial
+from threading import Lock, current_thread
 from os import getenv
-from os.path import splitext
+from os.path import exists, splitext
 
+from artifact_cache import add_artifact_cache_args, init_artifact_cache, download_output
 from auto_dev_sign import auto_dev_sign_android, auto_dev_sign_ios
 from build import build
-from certified_secure import download_certified_secure
-from certified_secure_json import download_certified_secure_json, format_json_file
+from certified_secure_json import format_json_file
 from context import context
-from download import download, download_action
+from credentials import load_signing_credentials
+from download import download_action
+from flow_checkpoint import add_flow_checkpoint_args, init_flow_checkpoint
+from metrics import get_metrics, add_metrics_args, export_metrics
+from multipart_upload import DEFAULT_PART_SIZE_MB, DEFAULT_UPLOAD_WORKERS
+from poller import StatusPoller
+from preflight import add_preflight_args, app_kind, preflight
 from private_sign import private_sign_android, private_sign_ios
+from ranged_download import add_ranged_download_args, init_ranged_download
 from sign import sign_android, sign_ios
-from status import wait_for_status_complete
-from upload import upload
-from utils import validate_response, log_and_exit, add_common_args, init_common_args, validate_output_path, init_overrides
+from status import wait_for_status_complete, add_polling_args, init_polling_policy
+from timeline import add_timeline_args, init_timeline, export_timeline
+from upload import upload, add_multipart_upload_args
+from upload_cache import add_upload_cache_args, init_upload_cache
+from utils import (validate_response, AppdomeError, add_common_args, init_common_args, validate_common_args, validate_output_path,
+                   init_overrides, exit_on_error)
+
+DEFAULT_DOWNLOAD_WORKERS = 5
+# Only these mean the app id is gone. Other errors, like a bad Fusion Set id or overrides, would fail again after an upload
+CACHED_APP_REJECTED_CODES = [404, 410]
+OUTPUT_ARGS = {'output': 'output', 'deobfuscation_script': 'deobfuscation_script_output', 'sign_second_output': 'sign_second_output',
+               'certificate_output': 'certificate_output', 'certificate_json': 'certificate_json'}
+SIGN_MODE_ARGS = ['sign_on_appdome', 'private_signing', 'auto_dev_private_signing']
+SIGN_CONFIG_ARGS = SIGN_MODE_ARGS + ['keystore', 'keystore_pass', 'keystore_alias', 'key_pass', 'signing_fingerprint', 'google_play_signing',
+                                     'provisioning_profiles', 'entitlements', 'sign_overrides'] + list(OUTPUT_ARGS.values())
 
 
 class Platform(Enum):
@@ -23,18 +47,29 @@ class Platform(Enum):
     IOS = 2
 
 
-def parse_arguments():
-    parser = argparse.ArgumentParser(description='Runs Appdome API commands')
+def parse_arguments(argv=None, parser_class=argparse.ArgumentParser):
+    parser = parser_class(description='Runs Appdome API commands')
     upload_group = parser.add_mutually_exclusive_group(required=True)
     upload_group.add_argument('-a', '--app', metavar='application_file', help='Upload app file input path')
     upload_group.add_argument('--app_id', metavar='app_id_value', help='App id of previously uploaded app')
 
     add_common_args(parser)
-
-    parser.add_argument('-fs', '--fusion_set_id', metavar='fusion_set_id_value',
+    add_multipart_upload_args(parser)
+    add_upload_cache_args(parser)
+    add_artifact_cache_args(parser)
+    add_ranged_download_args(parser)
+    add_polling_args(parser)
+    add_flow_checkpoint_args(parser)
+    add_metrics_args(parser)
+    add_timeline_args(parser)
+    add_preflight_args(parser)
+
+    parser.add_argument('-fs', '--fusion_set_id', nargs='+', metavar='fusion_set_id_value',
                         help='Appdome Fusion Set id. '
                              'Default for Android is environment variable APPDOME_ANDROID_FS_ID. '
-                             'Default for iOS is environment variable APPDOME_IOS_FS_ID')
+                             'Default for iOS is environment variable APPDOME_IOS_FS_ID. '
+                             'Can be multiple Fusion Sets, each built concurrently from one upload, optionally with its own build overrides '
+                             'as <fusion_set_id>:<overrides_json_file>. Output file names then get a _<fusion_set_id> suffix')
     parser.add_argument('-bv', '--build_overrides', metavar='overrides_json_file', help='Path to json file with build overrides')
     parser.add_argument('-bl', '--diagnostic_logs', action='store_true', help="Build the app with Appdome's Diagnostic Logs (if licensed)")
     parser.add_argument('-sv', '--sign_overrides', metavar='overrides_json_file', help='Path to json file with sign overrides')
@@ -43,6 +78,15 @@ def parse_arguments():
     sign_group.add_argument('-s', '--sign_on_appdome', action='store_true', help='Sign on Appdome')
     sign_group.add_argument('-ps', '--private_signing', action='store_true', help='Sign application manually')
     sign_group.add_argument('-adps', '--auto_dev_private_signing', action='store_true', help='Use a pre-generated signing script for automated local signing')
+    sign_group.add_argument('--sign_configs', metavar='sign_configs_json_file',
+                            help='Path to json file mapping names to signing configurations, each signing the same build and downloading '
+                                 'its own outputs. A configuration holds signing and output arguments, e.g. '
+                                 '{"store": {"sign_on_appdome": true, "keystore": "store.keystore", "output": "store.apk"}}. '
+                                 'Signing arguments missing from a configuration are taken from the command line')
+    parser.add_argument('--sign_workers', type=int, metavar='workers',
+                        help='Number of signing configurations to run concurrently. Default is all of them. Only applies when the '
+                             'server gives every signing a task of its own. Signings on the build task, as the Appdome API does '
+                             'today, run one at a time')
 
     # Signing credentials
     parser.add_argument('-k', '--keystore', metavar='keystore_file', help='Path to keystore file to use on Appdome iOS and Android signing.')
@@ -60,84 +104,232 @@ def parse_arguments():
     parser.add_argument('--sign_second_output', metavar='second_output_app_file', help='Output file for secondary output file - universal apk when building an aab app')
     parser.add_argument('-co', '--certificate_output', metavar='certificate_output_file', help='Output file for Certified Secure pdf')
     parser.add_argument('-cj', '--certificate_json', metavar='certificate_json_output_file', help='Output file for Certified Secure json')
-    return parser.parse_args()
+    parser.add_argument('--download_workers', type=int, default=DEFAULT_DOWNLOAD_WORKERS, metavar='workers',
+                        help=f'Number of output files to download concurrently. Default is {DEFAULT_DOWNLOAD_WORKERS}')
+    # Set by batch jobs, which keep their own multipart upload checkpoint
+    parser.set_defaults(job_name=None)
+    return parser.parse_args(argv)
+
+
+def read_fusion_sets(args):
+    fusion_sets = []
+    for value in args.fusion_set_id or []:
+        fusion_set_id, _, build_overrides = value.partition(':')
+        fusion_sets.append((fusion_set_id, build_overrides or args.build_overrides))
+    return fusion_sets
 
 
 def validate_args(args):
-    fusion_set_id = args.fusion_set_id
+    fusion_sets = read_fusion_sets(args)
+    if len(fusion_sets) > 1:
+        # Several Fusion Sets are split into a flow each by run_fusion_sets, batch jobs must not pass more than one
+        raise AppdomeError(f"A single flow builds one Fusion Set but {len(fusion_sets)} were given. "
+                           f"Run them from appdome_api.py or give each batch job its own Fusion Set")
+    fusion_set_id = None
+    if fusion_sets:
+        fusion_set_id, args.build_overrides = fusion_sets[0]
     platform = Platform.UNKNOWN
-    init_common_args(args)
+    validate_common_args(args)
     if args.app:
-        app_path_ext = splitext(args.app)[-1].lower()
-        if app_path_ext == ".ipa":
-            platform = Platform.IOS
-        elif app_path_ext == ".apk" or app_path_ext == ".aab":
-            platform = Platform.ANDROID
-        else:
-            log_and_exit(f"App extension [{app_path_ext}] must be .ipa, .apk or .aab")
+        kind = app_kind(args.app)
+        if not kind:
+            raise AppdomeError(f"App extension [{splitext(args.app)[-1].lower()}] must be .ipa, .apk or .aab")
+        platform = Platform.IOS if kind == 'ipa' else Platform.ANDROID
 
+    sign_configs = read_sign_configs(args)
     if platform == Platform.UNKNOWN:
-        if args.provisioning_profiles and not args.signing_fingerprint and not args.keystore_alias:
+        signing_args = sign_configs[0][1] if sign_configs else args
+        if signing_args.provisioning_profiles and not signing_args.signing_fingerprint and not signing_args.keystore_alias:
             platform = Platform.IOS
-        elif not args.provisioning_profiles and (args.signing_fingerprint or args.keystore_alias):
+        elif not signing_args.provisioning_profiles and (signing_args.signing_fingerprint or signing_args.keystore_alias):
             platform = Platform.ANDROID
         else:
-            log_and_exit(f"Please specify the correct platform signing credentials")
+            raise AppdomeError(f"Please specify the correct platform signing credentials")
 
     if not fusion_set_id:
         fusion_set_id = getenv('APPDOME_IOS_FS_ID' if platform == Platform.IOS else 'APPDOME_ANDROID_FS_ID')
         if not fusion_set_id:
-            log_and_exit(f"fusion_set_id must be specified or set though the correct platform environment variable")
+            raise AppdomeError(f"fusion_set_id must be specified or set though the correct platform environment variable")
+
+    for name, config_args in sign_configs or [(None, args)]:
+        validate_sign_args(config_args, platform, name)
+    return platform, fusion_set_id, sign_configs
+
+
+def validate_sign_args(args, platform, name=None):
+    if name and not any(getattr(args, arg) for arg in SIGN_MODE_ARGS):
+        raise AppdomeError(f"Signing configuration {name} must set one of {', '.join(SIGN_MODE_ARGS)}")
 
     if args.private_signing or args.auto_dev_private_signing:
         if platform == Platform.ANDROID and not args.signing_fingerprint:
-            log_and_exit(f"signing_fingerprint must be specified when using any Android local signing")
+            raise AppdomeError(f"signing_fingerprint must be specified when using any Android local signing")
 
     if platform == Platform.IOS and not args.provisioning_profiles:
-        log_and_exit(f"provisioning_profiles must be specified when using any iOS signing")
+        raise AppdomeError(f"provisioning_profiles must be specified when using any iOS signing")
 
     if args.sign_on_appdome:
         if not args.keystore or not args.keystore_pass:
-            log_and_exit(f"keystore and keystore_pass must be specified when using on Appdome signing")
+            raise AppdomeError(f"keystore and keystore_pass must be specified when using on Appdome signing")
         if platform == Platform.ANDROID and (not args.keystore_alias or not args.key_pass):
-            log_and_exit(f"keystore_alias and key_pass must be specified when using on Appdome Android signing")
+            raise AppdomeError(f"keystore_alias and key_pass must be specified when using on Appdome Android signing")
 
     validate_output_path(args.output)
     validate_output_path(args.certificate_output)
     validate_output_path(args.certificate_json)
-    return platform, fusion_set_id
 
 
-def _upload(api_key, team_id, app_path):
-    upload_response = upload(api_key, team_id, app_path)
+def read_sign_configs(args):
+    if not args.sign_configs:
+        return None
+    if not exists(args.sign_configs):
+        raise AppdomeError(f"Signing configurations file [{args.sign_configs}] does not exist")
+    with open(args.sign_configs) as f:
+        try:
+            configs = json.load(f)
+        except ValueError as e:
+            raise AppdomeError(f"Signing configurations file [{args.sign_configs}] is not valid json: {e}")
+    if not isinstance(configs, dict) or not configs:
+        raise AppdomeError(f"Signing configurations file [{args.sign_configs}] must map configuration names to signing arguments")
+
+    shared_outputs = [arg for arg in OUTPUT_ARGS.values() if getattr(args, arg)]
+    if shared_outputs:
+        raise AppdomeError(f"{', '.join(shared_outputs)} must be set in each signing configuration when using sign_configs")
+
+    sign_configs = []
+    outputs = {}
+    for name, config in configs.items():
+        unknown_args = sorted(set(config) - set(SIGN_CONFIG_ARGS))
+        if unknown_args:
+            raise AppdomeError(f"Signing configuration {name} has unknown arguments: {', '.join(unknown_args)}")
+        config_args = argparse.Namespace(**vars(args))
+        config_args.sign_configs = None
+        for arg, value in config.items():
+            setattr(config_args, arg, value)
+        for arg in OUTPUT_ARGS.values():
+            if config.get(arg) and getattr(args, 'output_suffix', None):
+                setattr(config_args, arg, suffixed_path(config[arg], args.output_suffix))
+            output_path = getattr(config_args, arg)
+            if not output_path:
+                continue
+            if output_path in outputs:
+                raise AppdomeError(f"Signing configurations {outputs[output_path]} and {name} both write [{output_path}]")
+            outputs[output_path] = name
+        sign_configs.append((name, config_args))
+    return sign_configs
+
+
+def _upload(api_key, team_id, app_path, multipart=False, part_size_mb=DEFAULT_PART_SIZE_MB,
+            upload_workers=DEFAULT_UPLOAD_WORKERS, job=None):
+    with get_metrics().stage('upload'):
+        upload_response = upload(api_key, team_id, app_path, multipart, part_size_mb, upload_workers, job)
     validate_response(upload_response)
     logging.info(f"Upload done. Response: {upload_response.json()}")
     return upload_response.json()['id']
 
 
-def _build(api_key, team_id, app_id, fusion_set_id, build_overrides, use_diagnostic_logs):
+class SharedReupload:
+    # Builds of several Fusion Sets that reject the same app id upload the app once, and all of them build the new app id
+    def __init__(self, reupload):
+        self._reupload = reupload
+        self._lock = Lock()
+        self._app_id = None
+
+    def __call__(self):
+        with self._lock:
+            if self._app_id is None:
+                self._app_id = self._reupload()
+            return self._app_id
+
+
+def _upload_app(args):
+    return _upload(args.api_key, args.team_id, args.app, args.multipart_upload, args.upload_part_size, args.upload_workers,
+                   args.job_name)
+
+
+def _cached_upload(args, upload_cache):
+    cache_key = upload_cache.key(args.app, args.team_id)
+
+    def reupload():
+        upload_cache.invalidate(cache_key)
+        new_app_id = _upload_app(args)
+        upload_cache.put(cache_key, new_app_id, args.app)
+        return new_app_id
+
+    app_id = upload_cache.get(cache_key)
+    if app_id:
+        logging.info(f"Reusing app id {app_id} from upload cache for [{args.app}]")
+        return app_id, reupload
+    return reupload(), None
+
+
+def _build(api_key, team_id, app_id, fusion_set_id, build_overrides, use_diagnostic_logs, reupload=None, polling_policy=None,
+           poller=None, checkpoint=None):
+    with get_metrics().stage('build'):
+        return _start_build(api_key, team_id, app_id, fusion_set_id, build_overrides, use_diagnostic_logs, reupload, polling_policy,
+                            poller, checkpoint)
+
+
+def _start_build(api_key, team_id, app_id, fusion_set_id, build_overrides, use_diagnostic_logs, reupload, polling_policy, poller,
+                 checkpoint):
     build_overrides_json = init_overrides(build_overrides)
     build_response = build(api_key, team_id, app_id, fusion_set_id, build_overrides_json, use_diagnostic_logs)
+    if reupload and build_response.status_code in CACHED_APP_REJECTED_CODES:
+        logging.info(f"Cached app id {app_id} was rejected with status code {build_response.status_code}. Uploading the app again")
+        app_id = reupload()
+        build_response = build(api_key, team_id, app_id, fusion_set_id, build_overrides_json, use_diagnostic_logs)
     validate_response(build_response)
     logging.info(f"Build request started. Response: {build_response.json()}")
     task_id = build_response.json()['task_id']
-    wait_for_status_complete(api_key, team_id, task_id)
+    if checkpoint:
+        checkpoint.start('build', app_id=app_id, task_id=task_id)
+    wait_for_status_complete(api_key, team_id, task_id, polling_policy=polling_policy, poller=poller)
     return task_id
 
 
-def _context(api_key, team_id, task_id):
-    context_response = context(api_key, team_id, task_id)
-    validate_response(context_response)
-    logging.info(f"Context request started. Response: {context_response.json()}")
-    wait_for_status_complete(api_key, team_id, task_id)
+def _context(api_key, team_id, task_id, polling_policy=None, poller=None, checkpoint=None):
+    with get_metrics().stage('context'):
+        context_response = context(api_key, team_id, task_id)
+        validate_response(context_response)
+        logging.info(f"Context request started. Response: {context_response.json()}")
+        if checkpoint:
+            checkpoint.start('context')
+        wait_for_status_complete(api_key, team_id, task_id, polling_policy=polling_policy, poller=poller)
 
 
-def _sign(args, platform, task_id, sign_overrides):
+def sign_stage_name(args):
+    if args.sign_on_appdome:
+        return 'sign'
+    return 'private_sign' if args.private_signing else 'auto_dev_sign'
+
+
+def init_signing_credentials(args, platform):
+    keystore_path = args.keystore if args.sign_on_appdome else None
+    provisioning_profiles_paths = args.provisioning_profiles if platform == Platform.IOS else None
+    entitlements_paths = args.entitlements if platform == Platform.IOS and not args.private_signing else None
+    return load_signing_credentials(keystore_path, provisioning_profiles_paths, entitlements_paths)
+
+
+def _sign(args, platform, task_id, sign_overrides, polling_policy=None, poller=None, checkpoint=None, credentials=None):
+    with get_metrics().stage(sign_stage_name(args)):
+        _start_sign(args, platform, task_id, sign_overrides, polling_policy, poller, checkpoint,
+                    credentials or init_signing_credentials(args, platform))
+
+
+def _start_sign(args, platform, task_id, sign_overrides, polling_policy, poller, checkpoint, credentials):
+    _request_sign(args, platform, task_id, sign_overrides, credentials)
+    if checkpoint:
+        checkpoint.start('sign')
+    wait_for_status_complete(args.api_key, args.team_id, task_id, polling_policy=polling_policy, poller=poller)
+    logging.info(f"Signing request finished.")
+
+
+def _request_sign(args, platform, task_id, sign_overrides, credentials):
     sign_overrides_json = init_overrides(sign_overrides)
     if platform == Platform.ANDROID:
         if args.sign_on_appdome:
             r = sign_android(args.api_key, args.team_id, task_id, args.keystore, args.keystore_pass,
-                             args.keystore_alias, args.key_pass, args.signing_fingerprint if args.google_play_signing else None, sign_overrides_json)
+                             args.keystore_alias, args.key_pass, args.signing_fingerprint if args.google_play_signing else None, sign_overrides_json,
+                             credentials)
         elif args.private_signing:
             r = private_sign_android(args.api_key, args.team_id, task_id, args.signing_fingerprint, args.google_play_signing, sign_overrides_json)
         else:
@@ -145,47 +337,290 @@ def _sign(args, platform, task_id, sign_overrides):
     else:
         if args.sign_on_appdome:
             r = sign_ios(args.api_key, args.team_id, task_id, args.keystore, args.keystore_pass,
-                         args.provisioning_profiles, args.entitlements, sign_overrides_json)
+                         args.provisioning_profiles, args.entitlements, sign_overrides_json, credentials)
         elif args.private_signing:
-            r = private_sign_ios(args.api_key, args.team_id, task_id, args.provisioning_profiles, sign_overrides_json)
+            r = private_sign_ios(args.api_key, args.team_id, task_id, args.provisioning_profiles, sign_overrides_json, credentials)
         else:
-            r = auto_dev_sign_ios(args.api_key, args.team_id, task_id, args.provisioning_profiles, args.entitlements, sign_overrides_json)
+            r = auto_dev_sign_ios(args.api_key, args.team_id, task_id, args.provisioning_profiles, args.entitlements, sign_overrides_json,
+                                  credentials)
 
     validate_response(r)
     logging.info(f"Signing request started. Response: {r.json()}")
-    wait_for_status_complete(args.api_key, args.team_id, task_id)
-    logging.info(f"Signing request finished.")
+    return r.json().get('task_id') or task_id
 
 
-def _download_file(api_key, team_id, task_id, output_path, download_func):
-    download_response = download_func(api_key, team_id, task_id)
-    validate_response(download_response)
-    with open(output_path, 'wb') as f:
-        f.write(download_response.content)
+def _download_file(api_key, team_id, task_id, output_path, command, artifact_cache=None, ranged_download=None):
+    download_output(api_key, team_id, task_id, command, output_path, artifact_cache=artifact_cache, ranged_download=ranged_download)
     logging.info(f"File written to {output_path}")
 
 
-def main():
-    args = parse_arguments()
-    platform, fusion_set_id = validate_args(args)
-
-    app_id = _upload(args.api_key, args.team_id, args.app) if args.app else args.app_id
+def _download_certificate_json(api_key, team_id, task_id, output_path, artifact_cache=None, ranged_download=None):
+    _download_file(api_key, team_id, task_id, output_path, 'certificate-json', artifact_cache, ranged_download)
+    format_json_file(output_path)
 
-    task_id = _build(args.api_key, args.team_id, app_id, fusion_set_id, args.build_overrides, args.diagnostic_logs)
 
-    _context(args.api_key, args.team_id, task_id)
+def _timed_download(download_func):
+    with get_metrics().stage('download'):
+        download_func()
 
-    _sign(args, platform, task_id, args.sign_overrides)
 
+def _download_outputs(args, task_id, workers=DEFAULT_DOWNLOAD_WORKERS, checkpoint=None, artifact_cache=None):
+    downloads = {}
+    ranged_download = init_ranged_download(args)
     if args.output:
-        _download_file(args.api_key, args.team_id, task_id, args.output, download)
-    download_action(args.api_key, args.team_id, task_id, args.deobfuscation_script_output, 'deobfuscation_script')
-    download_action(args.api_key, args.team_id, task_id, args.sign_second_output, 'sign_second_output')
+        downloads['output'] = partial(_download_file, args.api_key, args.team_id, task_id, args.output, 'output', artifact_cache,
+                                      ranged_download)
+    if args.deobfuscation_script_output:
+        downloads['deobfuscation_script'] = partial(download_action, args.api_key, args.team_id, task_id,
+                                                    args.deobfuscation_script_output, 'deobfuscation_script', artifact_cache, ranged_download)
+    if args.sign_second_output:
+        downloads['sign_second_output'] = partial(download_action, args.api_key, args.team_id, task_id,
+                                                  args.sign_second_output, 'sign_second_output', artifact_cache, ranged_download)
     if args.certificate_output:
-        _download_file(args.api_key, args.team_id, task_id, args.certificate_output, download_certified_secure)
+        downloads['certificate_output'] = partial(_download_file, args.api_key, args.team_id, task_id,
+                                                  args.certificate_output, 'certificate', artifact_cache, ranged_download)
     if args.certificate_json:
-        _download_file(args.api_key, args.team_id, task_id, args.certificate_json, download_certified_secure_json)
-        format_json_file(args.certificate_json)
+        downloads['certificate_json'] = partial(_download_certificate_json, args.api_key, args.team_id, task_id, args.certificate_json,
+                                                artifact_cache, ranged_download)
+    if checkpoint:
+        for name in [name for name in downloads if checkpoint.has_artifact(name, getattr(args, OUTPUT_ARGS[name]))]:
+            logging.info(f"Skipping download of {name} written in a previous run")
+            del downloads[name]
+    if not downloads:
+        return
+
+    failed_downloads = []
+    with ThreadPoolExecutor(max_workers=max(min(workers, len(downloads)), 1), thread_name_prefix=current_thread().name) as executor:
+        futures = {executor.submit(_timed_download, download_func): name for name, download_func in downloads.items()}
+        for future in as_completed(futures):
+            try:
+                future.result()
+                if checkpoint:
+                    checkpoint.add_artifact(futures[future], getattr(args, OUTPUT_ARGS[futures[future]]))
+            except Exception as e:
+                logging.error(f"Download of {futures[future]} failed. Error: {e}")
+                failed_downloads.append(futures[future])
+
+    if failed_downloads:
+        raise AppdomeError(f"Failed to download: {', '.join(sorted(failed_downloads))}")
+
+
+def _upload_stage(args):
+    if not args.app:
+        return args.app_id, None
+    upload_cache = init_upload_cache(args)
+    if upload_cache:
+        return _cached_upload(args, upload_cache)
+    return _upload_app(args), None
+
+
+class FlowState:
+    def __init__(self, args):
+        self.args = args
+        self.platform, self.fusion_set_id, sign_configs = validate_args(args)
+        self.polling_policy = init_polling_policy(args)
+        # Registered before any signing, so starting one drops the outputs this cache holds for the task
+        self.artifact_cache = init_artifact_cache(args)
+        # Signing files are loaded and validated before the upload, and shared by jobs using the same files
+        self.credentials = None if sign_configs else init_signing_credentials(args, self.platform)
+        self.sign_configs = [(name, config_args, init_signing_credentials(config_args, self.platform))
+                             for name, config_args in sign_configs or []]
+        if args.app and not args.skip_preflight:
+            # A corrupt archive or a bundle id without a provisioning profile fails here instead of after the upload and build
+            all_credentials = [self.credentials] + [credentials for name, config_args, credentials in self.sign_configs]
+            preflight(args.app, [credentials.provisioning_profiles for credentials in all_credentials if credentials])
+        self.checkpoint = init_flow_checkpoint(args, self.fusion_set_id, sign_configs)
+        self.app_id = self.checkpoint.app_id
+        self.reupload = None
+        self.task_id = self.checkpoint.task_id
+
+    def wait_for_resumed_task(self, step, poller=None):
+        logging.info(f"Waiting for the {step} of task {self.task_id} started in a previous run")
+        wait_for_status_complete(self.args.api_key, self.args.team_id, self.task_id, polling_policy=self.polling_policy, poller=poller)
+
+
+def upload_stage(state, poller=None):
+    if state.checkpoint.is_completed('upload'):
+        logging.info(f"Reusing app id {state.app_id} uploaded in a previous run")
+        state.reupload = SharedReupload(partial(_upload_app, state.args)) if state.args.app else None
+        return
+    state.app_id, reupload = _upload_stage(state.args)
+    state.reupload = SharedReupload(reupload) if reupload else None
+    state.checkpoint.complete('upload', app_id=state.app_id)
+
+
+def build_stage(state, poller=None):
+    args = state.args
+    if state.checkpoint.is_completed('build'):
+        return
+    if state.checkpoint.is_started('build'):
+        state.wait_for_resumed_task('build', poller)
+    else:
+        state.task_id = _build(args.api_key, args.team_id, state.app_id, state.fusion_set_id, args.build_overrides,
+                               args.diagnostic_logs, state.reupload, state.polling_policy, poller, state.checkpoint)
+    state.checkpoint.complete('build')
+
+
+def sign_stage(state, poller=None):
+    args = state.args
+    checkpoint = state.checkpoint
+    if checkpoint.is_completed('sign'):
+        return
+    if not checkpoint.is_started('context'):
+        _context(args.api_key, args.team_id, state.task_id, state.polling_policy, poller, checkpoint)
+    elif not checkpoint.is_started('sign'):
+        state.wait_for_resumed_task('context', poller)
+    if state.sign_configs:
+        if checkpoint.is_started('sign'):
+            state.wait_for_resumed_task('signing', poller)
+        else:
+            checkpoint.start('sign')
+        _run_sign_configs(state, poller)
+    elif not checkpoint.is_started('sign'):
+        _sign(args, state.platform, state.task_id, args.sign_overrides, state.polling_policy, poller, checkpoint, state.credentials)
+    else:
+        state.wait_for_resumed_task('signing', poller)
+    checkpoint.complete('sign')
+
+
+def _sign_config(state, name, config_args, credentials, build_task_lock, poller=None):
+    build_task_lock.acquire()
+    locked = True
+    try:
+        with get_metrics().stage(sign_stage_name(config_args)):
+            logging.info(f"Signing configuration {name} started")
+            sign_task_id = _request_sign(config_args, state.platform, state.task_id, config_args.sign_overrides, credentials)
+            if sign_task_id != state.task_id:
+                # The server gave this signing a task of its own, so the other configurations can sign the build meanwhile
+                build_task_lock.release()
+                locked = False
+            wait_for_status_complete(config_args.api_key, config_args.team_id, sign_task_id, polling_policy=state.polling_policy,
+                                     poller=poller)
+            logging.info(f"Signing configuration {name} finished")
+        # A signing on the build task replaces its outputs, so they are downloaded before the next configuration signs
+        _download_outputs(config_args, sign_task_id, config_args.download_workers, artifact_cache=state.artifact_cache)
+    finally:
+        if locked:
+            build_task_lock.release()
+
+
+def _run_sign_configs(state, poller=None):
+    checkpoint = state.checkpoint
+    sign_configs = []
+    for name, config_args, credentials in state.sign_configs:
+        if checkpoint.is_completed(f"sign:{name}"):
+            logging.info(f"Skipping signing configuration {name} finished in a previous run")
+        else:
+            sign_configs.append((name, config_args, credentials))
+    if not sign_configs:
+        return
+
+    build_task_lock = Lock()
+    failed_configs = []
+    workers = state.args.sign_workers or len(sign_configs)
+    with ThreadPoolExecutor(max_workers=max(min(workers, len(sign_configs)), 1), thread_name_prefix=current_thread().name) as executor:
+        futures = {executor.submit(_sign_config, state, name, config_args, credentials, build_task_lock, poller): name
+                   for name, config_args, credentials in sign_configs}
+        for future in as_completed(futures):
+            try:
+                future.result()
+                checkpoint.complete(f"sign:{futures[future]}")
+            except Exception as e:
+                logging.error(f"Signing configuration {futures[future]} failed. Error: {e}")
+                failed_configs.append(futures[future])
+
+    if failed_configs:
+        raise AppdomeError(f"Failed signing configurations: {', '.join(sorted(failed_configs))}")
+
+
+def download_stage(state, poller=None):
+    # Signing configurations download their outputs as soon as they are signed
+    if not state.sign_configs:
+        _download_outputs(state.args, state.task_id, state.args.download_workers, state.checkpoint, state.artifact_cache)
+    # Nothing is left to resume once all outputs are written
+    state.checkpoint.remove()
+
+
+FLOW_STAGES = [('upload', upload_stage), ('build', build_stage), ('sign', sign_stage), ('download', download_stage)]
+
+
+def suffixed_path(path, suffix):
+    name, ext = splitext(path)
+    return f"{name}_{suffix}{ext}"
+
+
+def fusion_set_args(args, fusion_set_id, build_overrides):
+    fusion_set_args = argparse.Namespace(**vars(args))
+    fusion_set_args.fusion_set_id = [fusion_set_id]
+    fusion_set_args.build_overrides = build_overrides
+    fusion_set_args.output_suffix = fusion_set_id
+    for arg in list(OUTPUT_ARGS.values()) + ['state_file']:
+        if getattr(args, arg):
+            setattr(fusion_set_args, arg, suffixed_path(getattr(args, arg), fusion_set_id))
+    return fusion_set_args
+
+
+def _run_stages(state, stages, poller=None):
+    for stage_name, stage_func in stages:
+        stage_func(state, poller)
+
+
+def run_fusion_sets(args, fusion_sets, poller=None):
+    # Every Fusion Set is validated, including its signing files, before the app is uploaded
+    states = {}
+    for fusion_set_id, build_overrides in fusion_sets:
+        if fusion_set_id in states:
+            raise AppdomeError(f"Fusion Set {fusion_set_id} is given more than once")
+        states[fusion_set_id] = FlowState(fusion_set_args(args, fusion_set_id, build_overrides))
+
+    first_state = next(iter(states.values()))
+    upload_stage(first_state, poller)
+    for state in states.values():
+        if not state.checkpoint.is_completed('upload'):
+            state.app_id = first_state.app_id
+            state.checkpoint.complete('upload', app_id=state.app_id)
+        state.reupload = first_state.reupload
+
+    failed_fusion_sets = []
+    with ExitStack() as stack:
+        if not poller:
+            # The builds are started together, so a single poller waits for all of them
+            poller = stack.enter_context(StatusPoller(polling_policy=first_state.polling_policy, max_in_flight=len(states)))
+        executor = stack.enter_context(ThreadPoolExecutor(max_workers=len(states), thread_name_prefix=current_thread().name))
+        futures = {executor.submit(_run_stages, state, FLOW_STAGES[1:], poller): fusion_set_id for fusion_set_id, state in states.items()}
+        for future in as_completed(futures):
+            try:
+                future.result()
+                logging.info(f"Fusion Set {futures[future]} finished. Task id: {states[futures[future]].task_id}")
+            except Exception as e:
+                logging.error(f"Fusion Set {futures[future]} failed. Error: {e}")
+                failed_fusion_sets.append(futures[future])
+
+    if failed_fusion_sets:
+        raise AppdomeError(f"Failed Fusion Sets: {', '.join(sorted(failed_fusion_sets))}")
+    return {fusion_set_id: state.task_id for fusion_set_id, state in states.items()}
+
+
+def run(args, poller=None):
+    with get_metrics().stage('flow'):
+        fusion_sets = read_fusion_sets(args)
+        if len(fusion_sets) > 1:
+            return run_fusion_sets(args, fusion_sets, poller)
+        state = FlowState(args)
+        _run_stages(state, FLOW_STAGES, poller)
+    return state.task_id
+
+
+@exit_on_error
+def main():
+    args = parse_arguments()
+    init_common_args(args)
+    init_timeline(args)
+    try:
+        run(args)
+    finally:
+        export_metrics(args)
+        export_timeline(args)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,231 @@
+import hashlib
+import json
+import logging
+import shutil
+from contextlib import contextmanager
+from os import getenv, makedirs, replace, remove, stat, getpid
+from os.path import join, expanduser, exists, dirname, abspath, basename
+from threading import Lock, get_ident
+from time import time, monotonic
+
+from metrics import get_metrics
+from ranged_download import object_validator, write_output_to_file
+from timeline import get_timeline
+from utils import SERVER_BASE_URL, task_output_command, validate_response, validate_output_path
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+ARTIFACT_CACHE_DIR_ENV = 'APPDOME_ARTIFACT_CACHE_DIR'
+DEFAULT_ARTIFACT_CACHE_DIR = getenv(ARTIFACT_CACHE_DIR_ENV, join(expanduser('~'), '.cache', 'appdome', 'artifacts'))
+DEFAULT_ARTIFACT_CACHE_MAX_SIZE_MB = 10240
+MB = 1024 * 1024
+# Linux ioctl cloning a file on copy-on-write file systems (btrfs, xfs)
+FICLONE = 0x40049409
+
+_cache_dirs = {DEFAULT_ARTIFACT_CACHE_DIR}
+_cache_dirs_lock = Lock()
+
+
+def _clone_file(source_path, target_path):
+    if not fcntl or not hasattr(fcntl, 'ioctl'):
+        raise OSError('File cloning is not supported')
+    with open(source_path, 'rb') as source, open(target_path, 'wb') as target:
+        fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+
+
+def materialize_file(source_path, target_path):
+    # A clone costs no copying and, like a copy, shares no inode with the source. Hard links are never used, writing
+    # into one output would change the cached blob and every other output taken from it. The file is put in place
+    # atomically, like a downloaded one
+    temp_path = join(dirname(abspath(target_path)), f".{basename(target_path)}.{getpid()}.{get_ident()}.part")
+    try:
+        for method, materialize in [('clone', _clone_file), ('copy', shutil.copyfile)]:
+            try:
+                if exists(temp_path):
+                    remove(temp_path)
+                materialize(source_path, temp_path)
+                break
+            except OSError:
+                if method == 'copy':
+                    raise
+        replace(temp_path, target_path)
+    finally:
+        if exists(temp_path):
+            remove(temp_path)
+    return method
+
+
+class ArtifactCache:
+    def __init__(self, cache_dir=DEFAULT_ARTIFACT_CACHE_DIR, max_size_mb=DEFAULT_ARTIFACT_CACHE_MAX_SIZE_MB):
+        self.cache_dir = cache_dir
+        self.max_size = int(max_size_mb * MB)
+        self.blobs_dir = join(cache_dir, 'blobs')
+        self.index_path = join(cache_dir, 'artifact_cache.json')
+        self._lock = Lock()
+        with _cache_dirs_lock:
+            _cache_dirs.add(cache_dir)
+
+    @staticmethod
+    def key(team_id, task_id, command, action=None):
+        return hashlib.sha256(f"{SERVER_BASE_URL}|{team_id or ''}|{task_id}|{command}|{action or ''}".encode()).hexdigest()
+
+    def _blob_path(self, sha256):
+        return join(self.blobs_dir, sha256)
+
+    def _blob_valid(self, entry):
+        # A blob changed or truncated on disk is not handed out again
+        blob_path = self._blob_path(entry['sha256'])
+        if not exists(blob_path):
+            return False
+        blob_stat = stat(blob_path)
+        return blob_stat.st_size == entry['size'] and blob_stat.st_mtime_ns == entry['mtime_ns']
+
+    def contains(self, key):
+        if not exists(self.index_path):
+            return False
+        with self._locked_index() as index:
+            return key in index
+
+    def materialize(self, key, output_path, validator):
+        with self._locked_index() as index:
+            entry = index.get(key)
+            if not entry:
+                return None
+            if not validator or entry.get('validator') != validator:
+                # Another signing replaced the output on the server, from this host or any other
+                logging.info(f"Dropping artifact cache entry for {entry['command']} of task {entry['task_id']} replaced on the server")
+                self._remove_entries(index, [key])
+                return None
+            if not self._blob_valid(entry):
+                logging.info(f"Dropping changed or missing artifact cache entry for {entry['command']} of task {entry['task_id']}")
+                self._remove_entries(index, [key])
+                return None
+            entry['last_used'] = time()
+            with get_timeline().span('artifact_cache_materialize', 'file', path=output_path):
+                start_time = monotonic()
+                method = materialize_file(self._blob_path(entry['sha256']), output_path)
+            get_metrics().record_transfer('artifact_cache', entry['size'], monotonic() - start_time)
+            return method
+
+    def put(self, key, file_path, sha256, validator, team_id, task_id, command, action=None):
+        with self._locked_index() as index:
+            blob_entries = [entry for entry in index.values() if entry['sha256'] == sha256]
+            if not blob_entries or not self._blob_valid(blob_entries[0]):
+                makedirs(self.blobs_dir, exist_ok=True)
+                materialize_file(file_path, self._blob_path(sha256))
+            blob_stat = stat(self._blob_path(sha256))
+            now = time()
+            index[key] = {'team_id': team_id, 'task_id': task_id, 'command': command, 'action': action, 'sha256': sha256,
+                          'validator': validator, 'size': blob_stat.st_size, 'mtime_ns': blob_stat.st_mtime_ns, 'created': now, 'last_used': now}
+            for entry in blob_entries:
+                entry['mtime_ns'] = blob_stat.st_mtime_ns
+            self._evict(index)
+
+    def invalidate_task(self, team_id, task_id):
+        if not exists(self.index_path):
+            return
+        with self._locked_index() as index:
+            keys = [key for key, entry in index.items() if entry['task_id'] == task_id and entry['team_id'] == team_id]
+            if keys:
+                logging.debug(f"Dropping {len(keys)} cached outputs of task {task_id}")
+                self._remove_entries(index, keys)
+
+    def _remove_entries(self, index, keys):
+        removed_hashes = set(index.pop(key)['sha256'] for key in keys)
+        referenced_hashes = set(entry['sha256'] for entry in index.values())
+        for sha256 in removed_hashes - referenced_hashes:
+            if exists(self._blob_path(sha256)):
+                remove(self._blob_path(sha256))
+
+    def _evict(self, index):
+        # Blobs are shared by entries with the same content, so each blob is counted once
+        def total_size(keys):
+            return sum({index[key]['sha256']: index[key]['size'] for key in keys}.values())
+
+        by_last_used = sorted(index, key=lambda key: index[key]['last_used'])
+        evicted = 0
+        while evicted < len(by_last_used) and total_size(by_last_used[evicted:]) > self.max_size:
+            evicted += 1
+        if evicted:
+            logging.debug(f"Evicting {evicted} artifact cache entries")
+            self._remove_entries(index, by_last_used[:evicted])
+
+    @contextmanager
+    def _locked_index(self):
+        makedirs(self.cache_dir, exist_ok=True)
+        with self._lock, open(join(self.cache_dir, 'artifact_cache.lock'), 'w') as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            index = self._load()
+            yield index
+            self._save(index)
+
+    def _load(self):
+        if not exists(self.index_path):
+            return {}
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable artifact cache index [{self.index_path}]: {e}")
+            return {}
+
+    def _save(self, index):
+        temp_path = self.index_path + '-tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(index, f)
+        replace(temp_path, self.index_path)
+
+
+def invalidate_task_artifacts(team_id, task_id):
+    # Signing on the build task replaces its outputs, so starting an action drops them from the caches used by this process.
+    # Signings from other processes or hosts are caught by the storage validator checked on every hit
+    with _cache_dirs_lock:
+        cache_dirs = list(_cache_dirs)
+    for cache_dir in cache_dirs:
+        ArtifactCache(cache_dir).invalidate_task(team_id, task_id)
+
+
+def output_validator(api_key, team_id, task_id, command, action=None):
+    # The first byte of the output brings the storage ETag or Last-Modified, which change when a signing replaces the output
+    response = task_output_command(api_key, team_id, task_id, command, action, byte_range=(0, 0))
+    response.close()
+    return object_validator(response.headers) if response.status_code in [200, 206] else None
+
+
+def download_output(api_key, team_id, task_id, command, output_path, action=None, artifact_cache=None, ranged_download=None):
+    validate_output_path(output_path)
+    key = artifact_cache.key(team_id, task_id, command, action) if artifact_cache else None
+    if artifact_cache and artifact_cache.contains(key):
+        method = artifact_cache.materialize(key, output_path, output_validator(api_key, team_id, task_id, command, action))
+        if method:
+            logging.info(f"{action or command} of task {task_id} taken from the artifact cache ({method})")
+            return
+    response = task_output_command(api_key, team_id, task_id, command, action)
+    validate_response(response)
+    digest = hashlib.sha256() if artifact_cache else None
+    validator = object_validator(response.headers)
+    source = {'server': SERVER_BASE_URL, 'team_id': team_id, 'task_id': task_id, 'command': command, 'action': action}
+    write_output_to_file(response, output_path, source, digest, ranged_download)
+    if artifact_cache and validator:
+        artifact_cache.put(key, output_path, digest.hexdigest(), validator, team_id, task_id, command, action)
+    elif artifact_cache:
+        logging.debug(f"{action or command} of task {task_id} is not cached, storage sent no ETag or Last-Modified to check it against")
+
+
+def add_artifact_cache_args(parser):
+    parser.add_argument('--artifact_cache', action='store_true',
+                        help='Keep downloaded outputs in a local cache and take them from there when the same task output is downloaded again')
+    parser.add_argument('--artifact_cache_dir', default=DEFAULT_ARTIFACT_CACHE_DIR, metavar=ARTIFACT_CACHE_DIR_ENV,
+                        help=f"Artifact cache directory. Default is environment variable '{ARTIFACT_CACHE_DIR_ENV}' or ~/.cache/appdome/artifacts")
+    parser.add_argument('--artifact_cache_max_size', type=float, default=DEFAULT_ARTIFACT_CACHE_MAX_SIZE_MB, metavar='MB',
+                        help=f'Max size of the artifact cache. Least recently used outputs are evicted. Default is {DEFAULT_ARTIFACT_CACHE_MAX_SIZE_MB}')
+
+
+def init_artifact_cache(args):
+    if not getattr(args, 'artifact_cache', False):
+        return None
+    return ArtifactCache(args.artifact_cache_dir, args.artifact_cache_max_size)
@@ -0,0 +1,123 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from artifact_cache import download_output
+from auto_dev_sign import auto_dev_sign_android, auto_dev_sign_ios
+from build import build
+from certified_secure_json import format_json_file
+from context import context
+from multipart_upload import DEFAULT_PART_SIZE_MB, DEFAULT_UPLOAD_WORKERS
+from private_sign import private_sign_android, private_sign_ios
+from sign import sign_android, sign_ios
+from status import status, PollingPolicy, StatusWait
+from upload import upload
+from utils import AppdomeError, DEFAULT_HTTP_POOL_SIZE, DEFAULT_HTTP_RETRIES, init_client, validate_response
+
+
+def _validated(func, *args, **kwargs):
+    response = func(*args, **kwargs)
+    validate_response(response)
+    return response
+
+
+class AsyncAppdomeClient:
+    def __init__(self, api_key, team_id=None, pool_size=DEFAULT_HTTP_POOL_SIZE, polling_policy=None, artifact_cache=None,
+                 ranged_download=None, num_of_retries=DEFAULT_HTTP_RETRIES):
+        self.api_key = api_key
+        self.team_id = team_id
+        self.polling_policy = polling_policy or PollingPolicy()
+        self.artifact_cache = artifact_cache
+        self.ranged_download = ranged_download
+        # Sets up the shared client if the process has none yet, a client already in use is kept as it is
+        client = init_client(pool_size, num_of_retries)
+        # Blocking requests run on a pool no larger than the connection pool, waits run on the event loop
+        self._executor = ThreadPoolExecutor(max_workers=client.pool_size, thread_name_prefix='appdome-async')
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(func, *args, **kwargs))
+
+    async def _call(self, func, *args, **kwargs):
+        return await self._run(_validated, func, self.api_key, self.team_id, *args, **kwargs)
+
+    async def upload(self, file_path, multipart=False, part_size_mb=DEFAULT_PART_SIZE_MB, upload_workers=DEFAULT_UPLOAD_WORKERS):
+        return await self._call(upload, file_path, multipart, part_size_mb, upload_workers)
+
+    async def build(self, app_id, fusion_set_id, overrides=None, use_diagnostic_logs=False):
+        return await self._call(build, app_id, fusion_set_id, overrides, use_diagnostic_logs)
+
+    async def context(self, task_id, new_bundle_id=None, new_version=None, new_build_num=None, new_display_name=None,
+                      app_icon_path=None, icon_overlay_path=None):
+        return await self._call(context, task_id, new_bundle_id, new_version, new_build_num, new_display_name,
+                                app_icon_path, icon_overlay_path)
+
+    async def sign_android(self, task_id, keystore_path, keystore_pass, key_alias, key_pass,
+                           google_play_signing_fingerprint=None, sign_overrides=None, credentials=None):
+        return await self._call(sign_android, task_id, keystore_path, keystore_pass, key_alias, key_pass,
+                                google_play_signing_fingerprint, sign_overrides, credentials)
+
+    async def sign_ios(self, task_id, keystore_p12_path, keystore_pass, provisioning_profiles_paths, entitlements_paths=None,
+                       sign_overrides=None, credentials=None):
+        return await self._call(sign_ios, task_id, keystore_p12_path, keystore_pass, provisioning_profiles_paths,
+                                entitlements_paths, sign_overrides, credentials)
+
+    async def private_sign_android(self, task_id, signing_fingerprint, is_google_play_signing=False, sign_overrides=None):
+        return await self._call(private_sign_android, task_id, signing_fingerprint, is_google_play_signing, sign_overrides)
+
+    async def private_sign_ios(self, task_id, provisioning_profiles_paths, sign_overrides=None, credentials=None):
+        return await self._call(private_sign_ios, task_id, provisioning_profiles_paths, sign_overrides, credentials)
+
+    async def auto_dev_sign_android(self, task_id, signing_fingerprint, is_google_play_signing=False, sign_overrides=None):
+        return await self._call(auto_dev_sign_android, task_id, signing_fingerprint, is_google_play_signing, sign_overrides)
+
+    async def auto_dev_sign_ios(self, task_id, provisioning_profiles_paths, entitlements_paths=None, sign_overrides=None,
+                                credentials=None):
+        return await self._call(auto_dev_sign_ios, task_id, provisioning_profiles_paths, entitlements_paths, sign_overrides,
+                                credentials)
+
+    async def status(self, task_id):
+        return await self._run(status, self.api_key, self.team_id, task_id)
+
+    async def wait_for_status_complete(self, task_id, timeout_sec=3600, num_of_retries=3, polling_policy=None):
+        status_wait = StatusWait(task_id, polling_policy or self.polling_policy, timeout_sec, num_of_retries)
+        while True:
+            status_response = error = None
+            try:
+                status_response = await self.status(task_id)
+            except Exception as e:
+                error = e
+            delay_sec = status_wait.step(status_response, error)
+            if delay_sec is None:
+                break
+            await asyncio.sleep(delay_sec)
+
+        status_response_json = status_wait.finish()
+        if status_wait.status_value != 'completed':
+            raise AppdomeError(f"Task {task_id} not completed successfully. Response: {status_response_json}")
+        return status_response_json
+
+    async def _download_to_file(self, command, task_id, output_path, action=None):
+        await self._run(download_output, self.api_key, self.team_id, task_id, command, output_path, action, self.artifact_cache,
+                        self.ranged_download)
+        logging.info(f"File written to {output_path}")
+
+    async def download(self, task_id, output_path, action=None):
+        await self._download_to_file('output', task_id, output_path, action)
+
+    async def download_certified_secure(self, task_id, output_path):
+        await self._download_to_file('certificate', task_id, output_path)
+
+    async def download_certified_secure_json(self, task_id, output_path):
+        await self._download_to_file('certificate-json', task_id, output_path)
+        format_json_file(output_path)
@@ -0,0 +1,268 @@
+import argparse
+import json
+import logging
+import re
+from functools import partial
+from os import makedirs
+from os.path import basename, join, splitext
+from threading import current_thread
+from time import monotonic
+
+import appdome_api
+from flow_checkpoint import FLOW_CHECKPOINT_SUFFIX
+from metrics import get_metrics, add_metrics_args, export_metrics
+from timeline import get_timeline, add_timeline_args, init_timeline, export_timeline
+from pipeline import StagedPipeline
+from poller import StatusPoller, DEFAULT_STATUS_REQUESTS_PER_SEC
+from status import add_polling_args, init_polling_policy
+from utils import AppdomeError, add_common_args, init_common_args, log_and_exit, validate_output_path, exit_on_error
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+DEFAULT_BATCH_WORKERS = 4
+INHERITED_ARGS = ['api_key', 'team_id', 'verbose', 'resume']
+JOB_LOG_FORMAT = '[%(asctime)s] [%(levelname)s] [%(threadName)s] [%(filename)s:%(lineno)d - %(funcName)s] %(message)s'
+
+
+class BatchJob:
+    def __init__(self, index, entry):
+        self.index = index
+        self.name = str(entry.pop('name', None) or default_job_name(index, entry))
+        self.entry = entry
+        self.status = 'pending'
+        self.stage = None
+        self.state = None
+        self.task_id = None
+        self.start_time = None
+        self.duration_sec = 0
+        self.error = ''
+        self.outputs = {}
+        self.log_path = None
+        self.log_handler = None
+
+    @property
+    def thread_name(self):
+        return f"job-{self.name}"
+
+    def to_json(self):
+        return {'name': self.name, 'status': self.status, 'task_id': self.task_id, 'duration_sec': round(self.duration_sec, 3),
+                'error': self.error, 'log_path': self.log_path}
+
+
+def default_job_name(index, entry):
+    source = entry.get('app') or entry.get('app_id') or 'job'
+    return f"{index}-{splitext(basename(str(source)))[0]}"
+
+
+def entry_to_argv(entry):
+    argv = []
+    for key, value in entry.items():
+        if value is None or value is False:
+            continue
+        option = f"--{key}"
+        if value is True:
+            argv.append(option)
+        elif isinstance(value, list):
+            argv += [option] + [str(v) for v in value]
+        else:
+            argv += [option, str(value)]
+    return argv
+
+
+def load_manifest(manifest_path):
+    with open(manifest_path) as f:
+        if manifest_path.endswith(('.yaml', '.yml')):
+            if not yaml:
+                log_and_exit("PyYAML is required for YAML manifests. You can install it with 'pip3 install pyyaml'")
+            entries = yaml.safe_load(f) or []
+        else:
+            entries = [json.loads(line) for line in f if line.strip() and not line.lstrip().startswith('#')]
+    if not isinstance(entries, list) or not all(isinstance(entry, dict) for entry in entries):
+        log_and_exit(f"Manifest [{manifest_path}] must contain one object of appdome_api.py arguments per job")
+    jobs = [BatchJob(index, dict(entry)) for index, entry in enumerate(entries, 1)]
+    names = [job.name for job in jobs]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        log_and_exit(f"Job names must be unique. Duplicates: {duplicates}")
+    return jobs
+
+
+def job_file_name(job, suffix):
+    return re.sub(r'[^\w.-]', '_', job.name) + suffix
+
+
+class JobLogHandler(logging.Handler):
+    def __init__(self, job, log_dir=None):
+        super().__init__()
+        self.job = job
+        self.file_handler = None
+        if log_dir:
+            job.log_path = join(log_dir, job_file_name(job, '.log'))
+            self.file_handler = logging.FileHandler(job.log_path, mode='w')
+            self.file_handler.setFormatter(logging.Formatter(JOB_LOG_FORMAT))
+
+    def filter(self, record):
+        # Threads started by a job are named with the job thread name as prefix
+        return record.threadName == self.job.thread_name or record.threadName.startswith(self.job.thread_name + '_')
+
+    def emit(self, record):
+        if self.file_handler:
+            self.file_handler.emit(record)
+
+    def close(self):
+        if self.file_handler:
+            self.file_handler.close()
+        super().close()
+
+
+class JobArgumentParser(argparse.ArgumentParser):
+    # Job arguments are checked without writing usage to the shared stderr or exiting the batch or daemon process
+    def error(self, message):
+        raise AppdomeError(message)
+
+    def exit(self, status=0, message=None):
+        raise AppdomeError(message or f"Argument parsing exited with status {status}")
+
+
+def job_argv(job, batch_args):
+    argv = entry_to_argv(job.entry)
+    for key in INHERITED_ARGS:
+        if key not in job.entry:
+            argv += entry_to_argv({key: getattr(batch_args, key)})
+    return argv
+
+
+def parse_job_arguments(job, batch_args):
+    try:
+        args = appdome_api.parse_arguments(job_argv(job, batch_args), JobArgumentParser)
+    except AppdomeError as e:
+        raise AppdomeError(f"Invalid arguments for job {job.name}: {e}")
+    args.job_name = job.name
+    if batch_args.state_dir and not args.state_file:
+        args.state_file = join(batch_args.state_dir, job_file_name(job, FLOW_CHECKPOINT_SUFFIX))
+    return args
+
+
+def start_job(job, batch_args):
+    job.log_handler = JobLogHandler(job, batch_args.log_dir)
+    logging.getLogger().addHandler(job.log_handler)
+    job.start_time = monotonic()
+    job.status = 'queued'
+
+
+def run_job_stage(stage_name, stage_func, batch_args, poller, job):
+    current_thread().name = job.thread_name
+    if job.state is None:
+        logging.info(f"Starting job {job.name}")
+        job.status = 'running'
+        job.state = appdome_api.FlowState(parse_job_arguments(job, batch_args))
+    job.stage = stage_name
+    with get_timeline().span(stage_name, 'pipeline', job=job.name):
+        stage_func(job.state, poller)
+    job.task_id = job.state.task_id
+
+
+def finish_job(job, future):
+    error = future.exception()
+    if error:
+        logging.error(f"Job {job.name} failed. Error: {error}")
+    job.status = 'failed' if error else 'completed'
+    job.error = str(error or '')
+    job.duration_sec = monotonic() - job.start_time
+    get_metrics().record_stage('flow', job.duration_sec, bool(error))
+    logging.info(f"Job {job.name} {job.status}{f' in stage {job.stage}' if error else ''} in {job.duration_sec:.1f} seconds")
+    logging.getLogger().removeHandler(job.log_handler)
+    job.log_handler.close()
+
+
+def parse_stage_workers(batch_args):
+    stage_workers = {stage_name: batch_args.workers for stage_name, stage_func in appdome_api.FLOW_STAGES}
+    for value in batch_args.stage_workers or []:
+        stage_name, _, workers = value.partition('=')
+        if stage_name not in stage_workers or not workers.isdigit() or int(workers) < 1:
+            log_and_exit(f"Invalid stage workers [{value}]. Expected <stage>=<workers> with stage one of {list(stage_workers)}")
+        stage_workers[stage_name] = int(workers)
+    return stage_workers
+
+
+def run_batch(jobs, batch_args):
+    stage_workers = parse_stage_workers(batch_args)
+    with StatusPoller(batch_args.status_requests_per_sec, init_polling_policy(batch_args),
+                      max_in_flight=batch_args.http_pool_size) as poller:
+        stages = [(stage_name, partial(run_job_stage, stage_name, stage_func, batch_args, poller))
+                  for stage_name, stage_func in appdome_api.FLOW_STAGES]
+        with StagedPipeline(stages, stage_workers) as pipeline:
+            for job in jobs:
+                start_job(job, batch_args)
+                pipeline.submit(job).add_done_callback(partial(finish_job, job))
+    return jobs
+
+
+def summary_table(jobs):
+    max_error_len = 80
+    rows = [('Job', 'Status', 'Task id', 'Duration', 'Error')]
+    for job in jobs:
+        error = job.error if len(job.error) <= max_error_len else job.error[:max_error_len] + '...'
+        rows.append((job.name, job.status, job.task_id or '', f"{job.duration_sec:.1f}s", error))
+    widths = [max(len(str(row[i])) for row in rows) for i in range(len(rows[0]))]
+    lines = ['  '.join(str(value).ljust(width) for value, width in zip(row, widths)).rstrip() for row in rows]
+    lines.insert(1, '  '.join('-' * width for width in widths))
+    return '\n'.join(lines)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Runs the Appdome flow for many apps from a manifest')
+    add_common_args(parser)
+    parser.add_argument('-m', '--manifest', required=True, metavar='manifest_file',
+                        help='JSON lines (or YAML list) file. Each job is an object of appdome_api.py arguments, '
+                             'e.g. {"name": "prod", "app": "app.apk", "sign_on_appdome": true, "keystore": "ks", ...}')
+    parser.add_argument('-w', '--workers', type=int, default=DEFAULT_BATCH_WORKERS, metavar='workers',
+                        help=f'Number of jobs to run concurrently in each stage (upload, build, sign, download). Default is {DEFAULT_BATCH_WORKERS}')
+    parser.add_argument('--stage_workers', nargs='+', metavar='stage=workers',
+                        help='Override the number of workers of specific stages, e.g. upload=2 build=16 sign=16 download=4')
+    parser.add_argument('--log_dir', metavar='log_directory', help='Directory to write a log file per job')
+    parser.add_argument('--state_dir', metavar='state_directory',
+                        help='Directory to write the flow state file of every job. Default is next to the output of the job')
+    parser.add_argument('--resume', action='store_true', help='Resume every job from its flow state file')
+    parser.add_argument('--summary_json', metavar='summary_json_file', help='Output file for a json summary of all jobs')
+    parser.add_argument('--status_requests_per_sec', type=float, default=DEFAULT_STATUS_REQUESTS_PER_SEC, metavar='requests',
+                        help=f'Max task status requests per second across all jobs. Default is {DEFAULT_STATUS_REQUESTS_PER_SEC}')
+    add_polling_args(parser)
+    add_metrics_args(parser)
+    add_timeline_args(parser)
+    return parser.parse_args()
+
+
+@exit_on_error
+def main():
+    args = parse_arguments()
+    init_common_args(args)
+    for handler in logging.getLogger().handlers:
+        handler.setFormatter(logging.Formatter(JOB_LOG_FORMAT))
+    for directory in [args.log_dir, args.state_dir]:
+        if directory:
+            makedirs(directory, exist_ok=True)
+    validate_output_path(args.summary_json)
+    init_timeline(args)
+
+    try:
+        jobs = run_batch(load_manifest(args.manifest), args)
+    finally:
+        export_metrics(args)
+        export_timeline(args)
+
+    print(summary_table(jobs), flush=True)
+    if args.summary_json:
+        with open(args.summary_json, 'w') as f:
+            json.dump([job.to_json() for job in jobs], f, indent=2)
+    failed_jobs = [job for job in jobs if job.status != 'completed']
+    if failed_jobs:
+        log_and_exit(f"{len(failed_jobs)} of {len(jobs)} jobs failed")
+    logging.info(f"All {len(jobs)} jobs completed")
+
+
+if __name__ == '__main__':
+    main()
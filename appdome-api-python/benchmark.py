@@ -0,0 +1,220 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import zipfile
+from os.path import abspath, dirname, join
+from statistics import median
+from subprocess import Popen, DEVNULL
+from tempfile import TemporaryDirectory
+from time import monotonic
+
+from batch import entry_to_argv
+from mock_server import MockAppdomeServer, MB, DEFAULT_TASK_DURATION_SEC, DEFAULT_OUTPUT_SIZE_MB
+from preflight import APK_MANIFEST, BINARY_XML_MAGIC
+from utils import init_logging, log_and_exit, validate_output_path, exit_on_error
+
+SCRIPTS_DIR = dirname(abspath(__file__))
+SCENARIOS = ['startup', 'single', 'batch']
+DEFAULT_APP_SIZE_MB = 50
+DEFAULT_BATCH_JOBS = 10
+DEFAULT_REPEAT = 1
+DEFAULT_STARTUP_RUNS = 20
+# Modules the CLI must not import before a command actually talks to the server
+STARTUP_DEFERRED_MODULES = ['requests', 'urllib3']
+BENCHMARK_FINGERPRINT = 'AA:BB:CC:DD:EE:FF:00:11:22:33:44:55:66:77:88:99:AA:BB:CC:DD'
+# ru_maxrss is in kilobytes on Linux and in bytes on macOS
+RSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+
+def create_app_file(path, size_mb):
+    # A minimal apk layout passes the preflight checks. Random content keeps hashing and uploading as expensive as for a real app
+    chunk = os.urandom(MB)
+    remaining = int(size_mb * MB)
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED) as zip_file:
+        zip_file.writestr(APK_MANIFEST, BINARY_XML_MAGIC + os.urandom(1024))
+        with zip_file.open('classes.dex', 'w', force_zip64=True) as f:
+            while remaining > 0:
+                f.write(chunk[:remaining])
+                remaining -= len(chunk)
+
+
+def flow_entry(app_path, output_dir):
+    return {'app': app_path, 'fusion_set_id': 'benchmark', 'private_signing': True, 'signing_fingerprint': BENCHMARK_FINGERPRINT,
+            'output': join(output_dir, 'output.apk'), 'certificate_output': join(output_dir, 'certificate.pdf'),
+            'certificate_json': join(output_dir, 'certificate.json')}
+
+
+def single_command(work_dir, app_path, client_args):
+    return [sys.executable, join(SCRIPTS_DIR, 'appdome_api.py'), '--api_key', 'benchmark'] + \
+        entry_to_argv(flow_entry(app_path, join(work_dir, 'single'))) + client_args
+
+
+def batch_command(work_dir, app_path, jobs, client_args):
+    manifest_path = join(work_dir, 'manifest.jsonl')
+    with open(manifest_path, 'w') as f:
+        for i in range(jobs):
+            f.write(json.dumps(dict(flow_entry(app_path, join(work_dir, 'batch', str(i))), name=f"benchmark-{i}")) + '\n')
+    return [sys.executable, join(SCRIPTS_DIR, 'batch.py'), '--api_key', 'benchmark', '--manifest', manifest_path] + client_args
+
+
+def startup_commands(work_dir):
+    # Help, and an argument error raised by validate_args after all the flow modules are imported.
+    # log_and_exit exits with -1
+    invalid_app_path = join(work_dir, 'benchmark.txt')
+    return {
+        'help': ([sys.executable, join(SCRIPTS_DIR, 'appdome.py'), '-h'], 0),
+        'run_help': ([sys.executable, join(SCRIPTS_DIR, 'appdome.py'), 'run', '-h'], 0),
+        'run_invalid_args': ([sys.executable, join(SCRIPTS_DIR, 'appdome.py'), 'run', '--api_key', 'benchmark'] +
+                             entry_to_argv(dict(flow_entry(invalid_app_path, work_dir), app=invalid_app_path)), 255)
+    }
+
+
+def imported_modules(log_path):
+    with open(log_path) as f:
+        return {line.split('|')[-1].strip() for line in f if line.startswith('import time:')}
+
+
+def run_startup(server, work_dir, runs):
+    results = []
+    for name, (command, expected_exit_code) in startup_commands(work_dir).items():
+        log_path = join(work_dir, f"startup-{name}.log")
+        command_results = [run_command(server, 'startup', name, command, log_path, expected_exit_code) for _ in range(runs)]
+        run_command(server, 'startup', name, command, log_path, expected_exit_code, env={'PYTHONPROFILEIMPORTTIME': '1'})
+        deferred_modules = sorted(imported_modules(log_path) & set(STARTUP_DEFERRED_MODULES))
+        if deferred_modules:
+            logging.error(f"startup {name} imported {', '.join(deferred_modules)}")
+        result = command_results[-1]
+        result.update({column: round(median(command_result[column] for command_result in command_results), 3)
+                       for column in ['wall_sec', 'cpu_sec', 'peak_rss_mb']})
+        result['failed'] = any(command_result['failed'] for command_result in command_results) or bool(deferred_modules)
+        result['deferred_modules_imported'] = deferred_modules
+        results.append(result)
+    return results
+
+
+def run_command(server, scenario, run, command, log_path, expected_exit_code=0, env=None):
+    server.state.reset_stats()
+    start_time = monotonic()
+    with open(log_path, 'w') as log_file:
+        process = Popen(command, stdout=DEVNULL, stderr=log_file,
+                        env=dict(os.environ, APPDOME_SERVER_BASE_URL=server.base_url, **(env or {})))
+        # wait4 returns the resource usage of this child alone
+        _, exit_status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(exit_status)
+    wall_sec = monotonic() - start_time
+    stats = server.state.reset_stats()
+    failed = process.returncode != expected_exit_code
+    if failed:
+        with open(log_path) as f:
+            logging.error(f"{scenario} run {run} exited with {process.returncode}:\n{''.join(f.readlines()[-10:])}")
+    return {
+        'scenario': scenario,
+        'run': run,
+        'exit_code': process.returncode,
+        'failed': failed,
+        'wall_sec': round(wall_sec, 3),
+        'cpu_sec': round(rusage.ru_utime + rusage.ru_stime, 3),
+        'peak_rss_mb': round(rusage.ru_maxrss * RSS_UNIT / MB, 1),
+        'requests': stats.requests,
+        'connections': stats.connections,
+        'uploaded_mb': round(stats.bytes_received / MB, 1),
+        'downloaded_mb': round(stats.bytes_sent / MB, 1),
+        'errors_injected': stats.errors_injected,
+        'routes': stats.routes
+    }
+
+
+def results_table(results):
+    columns = ['scenario', 'run', 'exit_code', 'wall_sec', 'cpu_sec', 'peak_rss_mb', 'requests', 'connections', 'uploaded_mb', 'downloaded_mb']
+    rows = [columns] + [[str(result[column]) for column in columns] for result in results]
+    scenarios = sorted({result['scenario'] for result in results}, key=SCENARIOS.index)
+    for scenario in scenarios:
+        scenario_results = [result for result in results if result['scenario'] == scenario]
+        # Every startup row is already the median of a different command
+        if len(scenario_results) > 1 and scenario != 'startup':
+            rows.append([scenario, 'median', ''] + [str(round(median(result[column] for result in scenario_results), 3))
+                                                    for column in columns[3:]])
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    lines = ['  '.join(value.ljust(width) for value, width in zip(row, widths)).rstrip() for row in rows]
+    lines.insert(1, '  '.join('-' * width for width in widths))
+    return '\n'.join(lines)
+
+
+def run_benchmark(args):
+    results = []
+    with TemporaryDirectory(prefix='appdome-benchmark-') as work_dir:
+        app_path = join(work_dir, 'benchmark.apk')
+        create_app_file(app_path, args.app_size)
+        server = MockAppdomeServer(latency_sec=args.latency, fail_rate=args.fail_rate, task_duration_sec=args.task_duration,
+                                   output_size_mb=args.output_size, error_rate=args.error_rate).start()
+        try:
+            for scenario in args.scenarios:
+                if scenario == 'startup':
+                    logging.info(f"Running startup commands {args.startup_runs} times each")
+                    results += run_startup(server, work_dir, args.startup_runs)
+                    continue
+                for run in range(1, args.repeat + 1):
+                    if scenario == 'single':
+                        command = single_command(work_dir, app_path, args.client_args)
+                    else:
+                        command = batch_command(work_dir, app_path, args.jobs, args.client_args)
+                    logging.info(f"Running {scenario} run {run}/{args.repeat}")
+                    results.append(run_command(server, scenario, run, command, join(work_dir, f"{scenario}-{run}.log")))
+        finally:
+            server.stop()
+    return results
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Measure the client end to end against a local mock Appdome server')
+    parser.add_argument('-s', '--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS,
+                        help='startup measures appdome.py help and argument errors, single runs appdome_api.py on one app, '
+                             'batch runs batch.py on --jobs apps. Default is all')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, metavar='runs', help=f'Runs of every scenario. Default is {DEFAULT_REPEAT}')
+    parser.add_argument('--jobs', type=int, default=DEFAULT_BATCH_JOBS, metavar='jobs',
+                        help=f'Number of apps in the batch scenario. Default is {DEFAULT_BATCH_JOBS}')
+    parser.add_argument('--app_size', type=float, default=DEFAULT_APP_SIZE_MB, metavar='MB', help=f'Size of the uploaded app. Default is {DEFAULT_APP_SIZE_MB}')
+    parser.add_argument('--output_size', type=float, default=DEFAULT_OUTPUT_SIZE_MB, metavar='MB',
+                        help=f'Size of the downloaded app. Default is {DEFAULT_OUTPUT_SIZE_MB}')
+    parser.add_argument('--task_duration', type=float, default=DEFAULT_TASK_DURATION_SEC, metavar='seconds',
+                        help=f'Time every task stays in progress. Default is {DEFAULT_TASK_DURATION_SEC}')
+    parser.add_argument('--latency', type=float, default=0, metavar='seconds', help='Latency added to every request')
+    parser.add_argument('--fail_rate', type=float, default=0, metavar='ratio', help='Fraction of storage uploads to fail with 503')
+    parser.add_argument('--error_rate', type=float, default=0, metavar='ratio', help='Fraction of API requests to fail with 503')
+    parser.add_argument('--startup_runs', type=int, default=DEFAULT_STARTUP_RUNS, metavar='runs',
+                        help=f'Runs of every startup command, reported as the median. Default is {DEFAULT_STARTUP_RUNS}')
+    parser.add_argument('--max_startup_ms', type=float, metavar='ms',
+                        help='Fail when the median time of a startup command is above this, e.g. to guard startup time in CI')
+    parser.add_argument('--results_json', metavar='results_json_file', help='Output file for the results of all runs')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Show debug logs')
+    parser.add_argument('--client_args', nargs=argparse.REMAINDER, default=[],
+                        help='Arguments added to every appdome_api.py / batch.py command, e.g. --client_args --poll_interval 0.5')
+    return parser.parse_args()
+
+
+@exit_on_error
+def main():
+    args = parse_arguments()
+    init_logging(args.verbose)
+    if not hasattr(os, 'wait4'):
+        log_and_exit("The benchmark measures the client processes with wait4, which is not available on this platform")
+    validate_output_path(args.results_json)
+
+    results = run_benchmark(args)
+
+    print(results_table(results), flush=True)
+    if args.results_json:
+        with open(args.results_json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if any(result['failed'] for result in results):
+        log_and_exit("Some benchmark runs failed")
+    slow_startups = [result['run'] for result in results
+                     if result['scenario'] == 'startup' and args.max_startup_ms and result['wall_sec'] * 1000 > args.max_startup_ms]
+    if slow_startups:
+        log_and_exit(f"Startup of {', '.join(slow_startups)} took longer than {args.max_startup_ms} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -2,10 +2,8 @@ import argparse
 import json
 import logging
 
-import requests
-
-from utils import (request_headers, empty_files, validate_response, debug_log_request, TASKS_URL,
-                   ACTION_KEY, OVERRIDES_KEY, add_common_args, init_common_args, init_overrides, team_params)
+from utils import (request_headers, empty_files, validate_response, debug_log_request, TASKS_URL, get_client,
+                   ACTION_KEY, OVERRIDES_KEY, add_common_args, init_common_args, init_overrides, team_params, exit_on_error)
 
 
 def create_build_request(api_key, team_id, app_id, fusion_set_id, overrides=None, use_diagnostic_logs=False):
@@ -28,7 +26,8 @@ def create_build_request(api_key, team_id, app_id, fusion_set_id, overrides=None
 def build(api_key, team_id, app_id, fusion_set_id, overrides=None, use_diagnostic_logs=False):
     url, headers, body, params = create_build_request(api_key, team_id, app_id, fusion_set_id, overrides, use_diagnostic_logs)
     debug_log_request(url, headers=headers, params=params, data=body)
-    return requests.post(url, headers=headers, params=params, data=body, files=empty_files())
+    # A build request without an answer is not sent again, a second build of the same app can't be told apart from the first
+    return get_client().request('POST', url, headers=headers, params=params, data=body, files=empty_files(), retry=True)
 
 
 def parse_arguments():
@@ -41,6 +40,7 @@ def parse_arguments():
     return parser.parse_args()
 
 
+@exit_on_error
 def main():
     args = parse_arguments()
     init_common_args(args)
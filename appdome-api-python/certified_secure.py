@@ -1,7 +1,8 @@
 import argparse
 import logging
 
-from utils import (validate_response, add_common_args, init_common_args, validate_output_path, task_output_command)
+from artifact_cache import add_artifact_cache_args, init_artifact_cache, download_output
+from utils import add_common_args, init_common_args, task_output_command, exit_on_error
 
 
 def download_certified_secure(api_key, team_id, task_id):
@@ -11,18 +12,16 @@ def download_certified_secure(api_key, team_id, task_id):
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Download Certified Secure pdf file')
     add_common_args(parser, add_task_id=True)
+    add_artifact_cache_args(parser)
     parser.add_argument('-co', '--certificate_output', required=True, metavar='certificate_output_file', help='Output file for Certified Secure pdf')
     return parser.parse_args()
 
 
+@exit_on_error
 def main():
     args = parse_arguments()
     init_common_args(args)
-    validate_output_path(args.certificate_output)
-    r = download_certified_secure(args.api_key, args.team_id, args.task_id)
-    validate_response(r)
-    with open(args.certificate_output, 'wb') as f:
-        f.write(r.content)
+    download_output(args.api_key, args.team_id, args.task_id, 'certificate', args.certificate_output, artifact_cache=init_artifact_cache(args))
     logging.info(f"Downloaded file to {args.certificate_output}")
 
 
@@ -4,7 +4,8 @@ from json import load, dump
 from os.path import exists
 from shutil import move
 
-from utils import (validate_response, add_common_args, init_common_args, validate_output_path, task_output_command)
+from artifact_cache import add_artifact_cache_args, init_artifact_cache, download_output
+from utils import add_common_args, init_common_args, task_output_command, exit_on_error
 
 
 def download_certified_secure_json(api_key, team_id, task_id):
@@ -29,18 +30,16 @@ def format_json_file(file_path):
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Download Certified Secure json file')
     add_common_args(parser, add_task_id=True)
+    add_artifact_cache_args(parser)
     parser.add_argument('-cj', '--certificate_json', required=True, metavar='certificate_json_output_file', help='Output file for Certified Secure json')
     return parser.parse_args()
 
 
+@exit_on_error
 def main():
     args = parse_arguments()
     init_common_args(args)
-    validate_output_path(args.certificate_json)
-    r = download_certified_secure_json(args.api_key, args.team_id, args.task_id)
-    validate_response(r)
-    with open(args.certificate_json, 'wb') as f:
-        f.write(r.content)
+    download_output(args.api_key, args.team_id, args.task_id, 'certificate-json', args.certificate_json, artifact_cache=init_artifact_cache(args))
     logging.info(f"Downloaded file to {args.certificate_json}")
     format_json_file(args.certificate_json)
 
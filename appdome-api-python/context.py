@@ -1,7 +1,7 @@
 import argparse
 import logging
 
-from utils import run_task_action, cleaned_fd_list, validate_response, add_common_args, init_common_args
+from utils import run_task_action, cleaned_fd_list, validate_response, add_common_args, init_common_args, exit_on_error
 
 
 def context(api_key, team_id, task_id, new_bundle_id=None, new_version=None,
@@ -44,6 +44,7 @@ def parse_arguments():
     return parser.parse_args()
 
 
+@exit_on_error
 def main():
     args = parse_arguments()
     init_common_args(args)
@@ -51,7 +52,7 @@ def main():
     r = context(args.api_key, args.team_id, args.task_id, args.new_bundle_id, args.new_version, args.new_build_num,
                 args.new_display_name, args.app_icon, args.icon_overlay)
     validate_response(r)
-    logging.info(f"Context for Build id: {r.json()['task_id']} started")
+    logging.info(f"Context for Build id: {r.json().get('task_id', args.task_id)} started")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,108 @@
+import logging
+import plistlib
+from collections import OrderedDict
+from datetime import datetime, timezone
+from os import stat
+from os.path import exists
+from threading import Lock
+
+from utils import AppdomeError
+
+
+def read_provisioning_profile(content):
+    # Provisioning profiles are CMS signed, with the plist stored as is inside the signed data
+    content = bytes(content)
+    start = content.find(b'<?xml')
+    end = content.find(b'</plist>')
+    if start < 0 or end < 0:
+        return None
+    try:
+        return plistlib.loads(content[start:end + len(b'</plist>')])
+    except Exception:
+        return None
+
+
+class SigningCredentials:
+    def __init__(self, keystore_path=None, provisioning_profiles_paths=None, entitlements_paths=None):
+        self.keystore = self._load(keystore_path) if keystore_path else None
+        self.provisioning_profiles = [self._load(path) for path in provisioning_profiles_paths or []]
+        self.entitlements = [self._load(path) for path in entitlements_paths or []]
+        for path, content in self.provisioning_profiles:
+            self._validate_provisioning_profile(path, content)
+        for path, content in self.entitlements:
+            try:
+                plistlib.loads(bytes(content))
+            except Exception as e:
+                raise AppdomeError(f"Entitlements file [{path}] is not a valid plist: {e}")
+
+    def _load(self, path):
+        if not exists(path):
+            raise AppdomeError(f"Signing file [{path}] does not exist")
+        with open(path, 'rb') as f:
+            content = f.read()
+        if not content:
+            raise AppdomeError(f"Signing file [{path}] is empty")
+        return path, content
+
+    @staticmethod
+    def _validate_provisioning_profile(path, content):
+        profile = read_provisioning_profile(content)
+        if profile is None:
+            raise AppdomeError(f"Provisioning profile [{path}] does not contain a valid plist")
+        expiration_date = profile.get('ExpirationDate')
+        if expiration_date and expiration_date.replace(tzinfo=timezone.utc) < datetime.now(timezone.utc):
+            raise AppdomeError(f"Provisioning profile [{path}] {profile.get('Name', '')} expired on {expiration_date}")
+
+    def keystore_files(self, field):
+        return [(field, self.keystore)]
+
+    def ios_files(self, overrides, use_entitlements=True):
+        files_list = [('provisioning_profile', profile) for profile in self.provisioning_profiles]
+        if use_entitlements and self.entitlements:
+            if overrides:
+                overrides['manual_entitlements_matching'] = True
+            files_list += [('entitlements_files', entitlements) for entitlements in self.entitlements]
+        else:
+            overrides['manual_entitlements_matching'] = False
+        return files_list
+
+    def close(self):
+        self.keystore = None
+        self.provisioning_profiles = []
+        self.entitlements = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+MAX_CACHED_CREDENTIALS = 16
+
+_credentials_cache = OrderedDict()
+_credentials_cache_lock = Lock()
+
+
+def _file_key(path):
+    file_stat = stat(path) if path and exists(path) else None
+    return (path, file_stat.st_size, file_stat.st_mtime_ns) if file_stat else (path,)
+
+
+def load_signing_credentials(keystore_path=None, provisioning_profiles_paths=None, entitlements_paths=None):
+    # Jobs signing with the same files share one bundle. A changed file is loaded again
+    paths = [keystore_path] + list(provisioning_profiles_paths or []) + [None] + list(entitlements_paths or [])
+    key = tuple(_file_key(path) for path in paths)
+    with _credentials_cache_lock:
+        credentials = _credentials_cache.get(key)
+        if credentials:
+            _credentials_cache.move_to_end(key)
+            return credentials
+        credentials = SigningCredentials(keystore_path, provisioning_profiles_paths, entitlements_paths)
+        _credentials_cache[key] = credentials
+        logging.debug(f"Loaded signing credentials from {[path for path in paths if path]}")
+        # Evicted bundles, and the ones of changed files, are not closed since running jobs may still sign with them.
+        # They are freed when the last of those jobs is done
+        while len(_credentials_cache) > MAX_CACHED_CREDENTIALS:
+            _credentials_cache.popitem(last=False)
+        return credentials
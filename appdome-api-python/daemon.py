@@ -0,0 +1,292 @@
+import argparse
+import hmac
+import json
+import logging
+import re
+import secrets
+import signal
+from collections import Counter
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from os import O_CREAT, O_TRUNC, O_WRONLY, fdopen, makedirs, remove, umask
+from os import open as os_open
+from os.path import abspath, dirname, exists, expanduser, join
+from socketserver import ThreadingMixIn, UnixStreamServer
+from threading import Lock
+from urllib.parse import urlparse
+
+import appdome_api
+from batch import (BatchJob, parse_job_arguments, start_job, run_job_stage, finish_job, parse_stage_workers, DEFAULT_BATCH_WORKERS,
+                   JOB_LOG_FORMAT)
+from metrics import get_metrics, add_metrics_args, export_metrics
+from pipeline import StagedPipeline
+from poller import StatusPoller, DEFAULT_STATUS_REQUESTS_PER_SEC
+from status import add_polling_args, init_polling_policy
+from utils import AppdomeError, add_common_args, init_common_args, exit_on_error
+
+DEFAULT_DAEMON_PORT = 8490
+DEFAULT_MAX_FINISHED_JOBS = 1000
+MAX_REQUEST_SIZE = 1024 * 1024
+DEFAULT_TOKEN_DIR = join(expanduser('~'), '.cache', 'appdome')
+JSON_CONTENT_TYPE = 'application/json'
+# Load balancers and process managers check health without the token, it only shows job counts
+PUBLIC_ROUTES = ['health']
+
+
+class JobExistsError(AppdomeError):
+    pass
+
+
+class JobService:
+    def __init__(self, args):
+        self.args = args
+        self.max_finished_jobs = args.max_finished_jobs
+        self._lock = Lock()
+        self._jobs = {}
+        self._index = count(1)
+        self.poller = StatusPoller(args.status_requests_per_sec, init_polling_policy(args), max_in_flight=args.http_pool_size)
+        stages = [(stage_name, partial(run_job_stage, stage_name, stage_func, args, self.poller))
+                  for stage_name, stage_func in appdome_api.FLOW_STAGES]
+        self.pipeline = StagedPipeline(stages, parse_stage_workers(args))
+
+    def submit(self, entry):
+        if not isinstance(entry, dict):
+            raise AppdomeError('A job must be an object of appdome_api.py arguments')
+        job = BatchJob(next(self._index), dict(entry))
+        # Invalid arguments are rejected right away instead of failing the job in its first stage
+        parse_job_arguments(job, self.args)
+        with self._lock:
+            if job.name in self._jobs:
+                raise JobExistsError(f"Job {job.name} already exists")
+            self._jobs[job.name] = job
+            start_job(job, self.args)
+        logging.info(f"Accepted job {job.name}")
+        self.pipeline.submit(job).add_done_callback(partial(self._finish, job))
+        return job
+
+    def _finish(self, job, future):
+        finish_job(job, future)
+        job.outputs = job_outputs(job)
+        # Only the summary of a finished job is kept
+        job.state = None
+        with self._lock:
+            finished_jobs = [name for name, finished_job in self._jobs.items() if finished_job.status in ['completed', 'failed']]
+            for name in finished_jobs[:max(len(finished_jobs) - self.max_finished_jobs, 0)]:
+                del self._jobs[name]
+
+    def job(self, name):
+        with self._lock:
+            return self._jobs.get(name)
+
+    def jobs(self):
+        with self._lock:
+            return list(self._jobs.values())
+
+    def close(self):
+        logging.info('Waiting for running jobs to finish')
+        self.pipeline.join()
+        self.poller.close()
+
+
+def job_outputs(job):
+    if not job.state:
+        return {}
+    state = job.state
+    flows = [(name, config_args) for name, config_args, credentials in state.sign_configs] if state.sign_configs else [(None, state.args)]
+    outputs = {}
+    for config_name, flow_args in flows:
+        for output_name, arg in appdome_api.OUTPUT_ARGS.items():
+            path = getattr(flow_args, arg)
+            if path and exists(path):
+                outputs[f"{config_name}:{output_name}" if config_name else output_name] = abspath(path)
+    return outputs
+
+
+def job_json(job):
+    return dict(job.to_json(), stage=job.stage, outputs=job.outputs)
+
+
+class DaemonRequestHandler(BaseHTTPRequestHandler):
+    routes = [
+        ('GET', r'/health$', 'health'),
+        ('GET', r'/metrics$', 'metrics'),
+        ('GET', r'/jobs$', 'list_jobs'),
+        ('POST', r'/jobs$', 'submit_job'),
+        ('GET', r'/jobs/(?P<name>[^/]+)$', 'get_job'),
+    ]
+
+    @property
+    def service(self):
+        return self.server.service
+
+    def log_message(self, format, *args):
+        # Unix socket clients have no address
+        logging.debug(f"Daemon: {format % args}")
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def dispatch(self, method):
+        path = urlparse(self.path).path
+        for route_method, pattern, handler_name in self.routes:
+            match = re.match(pattern, path)
+            if route_method == method and match:
+                if handler_name not in PUBLIC_ROUTES and not self.authorized():
+                    return self.send_json(401, {'error': 'Missing or wrong daemon token'})
+                return getattr(self, handler_name)(**match.groupdict())
+        self.send_json(404, {'error': f"No route for {method} {path}"})
+
+    def authorized(self):
+        # Web pages can post to a local port, only clients that read the token file can use the daemon
+        token = self.server.token
+        if not token:
+            return True
+        scheme, _, value = self.headers.get('Authorization', '').partition(' ')
+        return scheme.lower() == 'bearer' and hmac.compare_digest(value.strip().encode(), token.encode())
+
+    def send_body(self, status_code, body, content_type):
+        self.send_response(status_code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, status_code, obj):
+        self.send_body(status_code, json.dumps(obj).encode(), JSON_CONTENT_TYPE)
+
+    def health(self):
+        self.send_json(200, {'status': 'ok', 'jobs': dict(Counter(job.status for job in self.service.jobs()))})
+
+    def metrics(self):
+        self.send_body(200, get_metrics().to_prometheus().encode(), 'text/plain; version=0.0.4')
+
+    def list_jobs(self):
+        self.send_json(200, [job_json(job) for job in self.service.jobs()])
+
+    def get_job(self, name):
+        job = self.service.job(name)
+        if not job:
+            return self.send_json(404, {'error': f"Unknown job {name}"})
+        self.send_json(200, job_json(job))
+
+    def submit_job(self):
+        # Browsers send text/plain and form posts to other origins without a preflight, json needs one
+        if self.headers.get_content_type() != JSON_CONTENT_TYPE:
+            return self.send_json(415, {'error': f"Job request Content-Type must be {JSON_CONTENT_TYPE}"})
+        size = int(self.headers.get('Content-Length') or 0)
+        if size > MAX_REQUEST_SIZE:
+            return self.send_json(413, {'error': f"Job request is larger than {MAX_REQUEST_SIZE} bytes"})
+        try:
+            job = self.service.submit(json.loads(self.rfile.read(size) or b'null'))
+        except ValueError as e:
+            return self.send_json(400, {'error': f"Job request is not valid json: {e}"})
+        except JobExistsError as e:
+            return self.send_json(409, {'error': str(e)})
+        except AppdomeError as e:
+            return self.send_json(400, {'error': str(e)})
+        self.send_json(202, job_json(job))
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+def write_token_file(path):
+    token = secrets.token_urlsafe(32)
+    makedirs(dirname(abspath(path)), exist_ok=True)
+    if exists(path):
+        remove(path)
+    # Created readable by the owner only, the token lets anyone run jobs with the daemon's api key
+    with fdopen(os_open(path, O_CREAT | O_WRONLY | O_TRUNC, 0o600), 'w') as f:
+        f.write(token)
+    return token
+
+
+def create_server(args, service):
+    if args.socket:
+        if exists(args.socket):
+            remove(args.socket)
+        # Anyone who can connect can run jobs with the daemon's api key, so the socket is created owner only
+        old_umask = umask(0o177)
+        try:
+            httpd = ThreadingUnixHTTPServer(args.socket, DaemonRequestHandler)
+        finally:
+            umask(old_umask)
+        httpd.token = None
+        address = f"unix socket {args.socket}"
+    else:
+        httpd = ThreadingHTTPServer((args.host, args.port), DaemonRequestHandler)
+        httpd.daemon_threads = True
+        httpd.token = write_token_file(args.token_file)
+        address = f"http://{args.host}:{httpd.server_address[1]}/ (token in {args.token_file})"
+    httpd.service = service
+    logging.info(f"Appdome daemon listening on {address}")
+    return httpd
+
+
+def stop_on_signal(signum, frame):
+    raise KeyboardInterrupt
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Runs Appdome flow jobs submitted over a local HTTP or Unix socket')
+    add_common_args(parser)
+    listen_group = parser.add_mutually_exclusive_group()
+    listen_group.add_argument('--socket', metavar='unix_socket_path', help='Unix socket to listen on instead of a TCP port')
+    listen_group.add_argument('--port', type=int, default=DEFAULT_DAEMON_PORT, help=f'Port to listen on. Default is {DEFAULT_DAEMON_PORT}')
+    parser.add_argument('--host', default='127.0.0.1', help='Host to listen on. Default is 127.0.0.1')
+    parser.add_argument('--token_file', metavar='token_file_path',
+                        help='File to write the token that TCP clients must send as "Authorization: Bearer <token>". '
+                             'A new token is made every start. Default is ~/.cache/appdome/daemon-<port>.token')
+    parser.add_argument('-w', '--workers', type=int, default=DEFAULT_BATCH_WORKERS, metavar='workers',
+                        help=f'Number of jobs to run concurrently in each stage (upload, build, sign, download). Default is {DEFAULT_BATCH_WORKERS}')
+    parser.add_argument('--stage_workers', nargs='+', metavar='stage=workers',
+                        help='Override the number of workers of specific stages, e.g. upload=2 build=16 sign=16 download=4')
+    parser.add_argument('--log_dir', metavar='log_directory', help='Directory to write a log file per job')
+    parser.add_argument('--state_dir', metavar='state_directory',
+                        help='Directory to write the flow state file of every job. Default is next to the output of the job')
+    parser.add_argument('--resume', action='store_true', help='Resume every job from its flow state file')
+    parser.add_argument('--max_finished_jobs', type=int, default=DEFAULT_MAX_FINISHED_JOBS, metavar='jobs',
+                        help=f'Number of finished jobs to keep the status of. Default is {DEFAULT_MAX_FINISHED_JOBS}')
+    parser.add_argument('--status_requests_per_sec', type=float, default=DEFAULT_STATUS_REQUESTS_PER_SEC, metavar='requests',
+                        help=f'Max task status requests per second across all jobs. Default is {DEFAULT_STATUS_REQUESTS_PER_SEC}')
+    add_polling_args(parser)
+    add_metrics_args(parser)
+    return parser.parse_args()
+
+
+@exit_on_error
+def main():
+    args = parse_arguments()
+    if not args.socket and not args.token_file:
+        args.token_file = join(DEFAULT_TOKEN_DIR, f"daemon-{args.port}.token")
+    # The pooled client is created once and shared by all jobs
+    init_common_args(args)
+    for handler in logging.getLogger().handlers:
+        handler.setFormatter(logging.Formatter(JOB_LOG_FORMAT))
+    for directory in [args.log_dir, args.state_dir]:
+        if directory:
+            makedirs(directory, exist_ok=True)
+
+    service = JobService(args)
+    httpd = create_server(args, service)
+    signal.signal(signal.SIGTERM, stop_on_signal)
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        logging.info('Stopping the Appdome daemon')
+    finally:
+        httpd.server_close()
+        path = args.socket or args.token_file
+        if exists(path):
+            remove(path)
+        service.close()
+        export_metrics(args)
+
+
+if __name__ == '__main__':
+    main()
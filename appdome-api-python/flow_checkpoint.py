@@ -0,0 +1,204 @@
+import json
+import logging
+from os import remove, replace
+from os.path import exists, getsize
+from threading import Lock
+from time import time
+
+from status import status
+from upload_cache import file_sha256
+from utils import SERVER_BASE_URL
+
+FLOW_CHECKPOINT_SUFFIX = '.appdome-flow.json'
+FLOW_CHECKPOINT_VERSION = 1
+FLOW_STAGE_NAMES = ['upload', 'build', 'sign', 'download']
+RESUMABLE_TASK_STATUSES = ['progress', 'completed']
+
+
+def _files_sha256(paths):
+    if not paths:
+        return None
+    return [file_sha256(path) for path in ([paths] if isinstance(paths, str) else paths)]
+
+
+def build_inputs(args, fusion_set_id):
+    return {
+        'server': SERVER_BASE_URL,
+        'team_id': args.team_id,
+        'app_sha256': _files_sha256(args.app),
+        'app_id': args.app_id,
+        'fusion_set_id': fusion_set_id,
+        'build_overrides_sha256': _files_sha256(args.build_overrides),
+        'diagnostic_logs': args.diagnostic_logs
+    }
+
+
+def sign_inputs(args):
+    # Passwords are not stored, a changed password fails the signing and is retried on the next resume
+    return {
+        'sign_mode': 'sign_on_appdome' if args.sign_on_appdome else 'private_signing' if args.private_signing else 'auto_dev_private_signing',
+        'sign_overrides_sha256': _files_sha256(args.sign_overrides),
+        'keystore_sha256': _files_sha256(args.keystore),
+        'keystore_alias': args.keystore_alias,
+        'signing_fingerprint': args.signing_fingerprint,
+        'google_play_signing': args.google_play_signing,
+        'provisioning_profiles_sha256': _files_sha256(args.provisioning_profiles),
+        'entitlements_sha256': _files_sha256(args.entitlements)
+    }
+
+
+class FlowCheckpoint:
+    def __init__(self, path, data):
+        self.path = path
+        self.data = data
+        self._lock = Lock()
+
+    @classmethod
+    def open(cls, path, build_inputs, sign_inputs, resume=False):
+        data = cls._load(path) if path and resume else None
+        if data and data.get('build_inputs') != build_inputs:
+            logging.info(f"Flow state [{path}] does not match the app or build arguments. Starting from the upload")
+            data = None
+        if not data:
+            data = {
+                'version': FLOW_CHECKPOINT_VERSION,
+                'created': time(),
+                'build_inputs': build_inputs,
+                'sign_inputs': sign_inputs,
+                'app_id': None,
+                'task_id': None,
+                'started': [],
+                'completed': [],
+                'artifacts': {}
+            }
+        checkpoint = cls(path, data)
+        if data.get('sign_inputs') != sign_inputs:
+            logging.info(f"Signing arguments changed since flow state [{path}] was written. Signing again")
+            data['sign_inputs'] = sign_inputs
+            checkpoint.reset_from('sign')
+        elif data['completed']:
+            logging.info(f"Resuming from flow state [{path}]. Completed stages: {', '.join(data['completed'])}")
+        checkpoint.save()
+        return checkpoint
+
+    @staticmethod
+    def _load(path):
+        if not exists(path):
+            logging.info(f"No flow state found at [{path}]. Starting from the upload")
+            return None
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable flow state [{path}]: {e}")
+            return None
+        if data.get('version') != FLOW_CHECKPOINT_VERSION:
+            logging.info(f"Ignoring flow state [{path}] of version {data.get('version')}")
+            return None
+        return data
+
+    @property
+    def app_id(self):
+        return self.data['app_id']
+
+    @property
+    def task_id(self):
+        return self.data['task_id']
+
+    def is_started(self, step):
+        return step in self.data['started']
+
+    def is_completed(self, stage_name):
+        return stage_name in self.data['completed']
+
+    def start(self, step, **values):
+        with self._lock:
+            self.data.update(values)
+            if step not in self.data['started']:
+                self.data['started'].append(step)
+            self.save()
+
+    def complete(self, stage_name, **values):
+        with self._lock:
+            self.data.update(values)
+            if stage_name not in self.data['completed']:
+                self.data['completed'].append(stage_name)
+            self.save()
+
+    def reset_from(self, stage_name):
+        # The build, context and sign steps all run on the build task, so redoing a stage redoes everything after it
+        stage_names = FLOW_STAGE_NAMES[FLOW_STAGE_NAMES.index(stage_name):]
+        with self._lock:
+            if 'build' in stage_names:
+                self.data['task_id'] = None
+                self.data['started'] = []
+            elif 'sign' in stage_names:
+                self.data['started'] = [step for step in self.data['started'] if step == 'build']
+            # Signing configurations are completed as sign:<name>
+            self.data['completed'] = [name for name in self.data['completed'] if name.split(':')[0] not in stage_names]
+            self.data['artifacts'] = {}
+            self.save()
+
+    def has_artifact(self, name, path):
+        artifact = self.data['artifacts'].get(name)
+        return bool(artifact and artifact['path'] == path and exists(path) and getsize(path) == artifact['size'])
+
+    def add_artifact(self, name, path):
+        with self._lock:
+            self.data['artifacts'][name] = {'path': path, 'size': getsize(path)}
+            self.save()
+
+    def verify_task(self, api_key, team_id):
+        task_id = self.task_id
+        if not task_id or not self.path:
+            return
+        response = status(api_key, team_id, task_id, retry=True)
+        status_value = response.json().get('status') if response.status_code == 200 else f"status code {response.status_code}"
+        if status_value not in RESUMABLE_TASK_STATUSES:
+            logging.info(f"Task {task_id} from flow state [{self.path}] can't be resumed ({status_value}). Building again")
+            self.reset_from('build')
+            return
+        logging.info(f"Task {task_id} from flow state [{self.path}] is {status_value} on the server")
+
+    def save(self):
+        if not self.path:
+            return
+        self.data['updated'] = time()
+        temp_path = self.path + '-tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self.data, f, indent=2)
+        replace(temp_path, self.path)
+
+    def remove(self):
+        if self.path and exists(self.path):
+            remove(self.path)
+
+
+def default_flow_checkpoint_path(args, sign_configs=None):
+    if sign_configs:
+        args = sign_configs[0][1]
+    output_path = args.output or args.certificate_output or args.certificate_json
+    return output_path + FLOW_CHECKPOINT_SUFFIX if output_path else None
+
+
+def add_flow_checkpoint_args(parser):
+    parser.add_argument('--state_file', metavar='state_json_file',
+                        help=f'Flow state file recording the finished stages of this run, so it can be resumed. '
+                             f'Default with --resume is the output file path with a {FLOW_CHECKPOINT_SUFFIX} suffix. Removed when the flow completes')
+    parser.add_argument('--resume', action='store_true',
+                        help='Record the finished stages in the flow state file, and continue from the first unfinished stage '
+                             'recorded there instead of uploading and building again')
+
+
+def init_flow_checkpoint(args, fusion_set_id, sign_configs=None):
+    path = args.state_file or (default_flow_checkpoint_path(args, sign_configs) if args.resume else None)
+    if not path:
+        # Nothing is persisted unless the run can be resumed, so there is no point hashing the inputs
+        return FlowCheckpoint.open(None, None, None)
+    if sign_configs:
+        flow_sign_inputs = {name: sign_inputs(config_args) for name, config_args in sign_configs}
+    else:
+        flow_sign_inputs = sign_inputs(args)
+    checkpoint = FlowCheckpoint.open(path, build_inputs(args, fusion_set_id), flow_sign_inputs, args.resume)
+    checkpoint.verify_task(args.api_key, args.team_id)
+    return checkpoint
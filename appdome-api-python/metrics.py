@@ -0,0 +1,247 @@
+import json
+import re
+from collections import defaultdict
+from contextlib import contextmanager
+from os import replace
+from threading import Lock, local
+from time import monotonic, time
+from urllib.parse import urlparse
+
+from timeline import get_timeline
+
+OPERATION_PATTERNS = [
+    (re.compile(r'/upload-link$'), 'upload_link'),
+    (re.compile(r'/upload-using-link$'), 'upload_using_link'),
+    (re.compile(r'/tasks/[^/]+/status$'), 'task_status'),
+    (re.compile(r'/tasks/[^/]+/output$'), 'task_output'),
+    (re.compile(r'/tasks/[^/]+/certificate$'), 'certificate'),
+    (re.compile(r'/tasks/[^/]+/certificate-json$'), 'certificate_json'),
+    (re.compile(r'/validation/upload$'), 'validation_upload'),
+    (re.compile(r'/validation/[^/]+/status$'), 'validation_status'),
+]
+UNKNOWN_STAGE = 'other'
+PROMETHEUS_PREFIX = 'appdome'
+
+
+def request_operation(method, url, data=None):
+    path = urlparse(url).path
+    if path.endswith('/tasks') and method == 'POST':
+        action = data.get('action') if isinstance(data, dict) else None
+        return f"task_{action}" if action else 'task_action'
+    for pattern, operation in OPERATION_PATTERNS:
+        if pattern.search(path):
+            return operation
+    # Anything else is a presigned storage URL
+    return 'storage_put' if method == 'PUT' else f"storage_{method.lower()}"
+
+
+class DurationSummary:
+    def __init__(self):
+        self.count = 0
+        self.failed = 0
+        self.total_sec = 0
+        self.max_sec = 0
+
+    def add(self, duration_sec, failed=False):
+        self.count += 1
+        self.failed += int(failed)
+        self.total_sec += duration_sec
+        self.max_sec = max(self.max_sec, duration_sec)
+
+    def to_json(self):
+        return {'count': self.count, 'failed': self.failed, 'total_sec': round(self.total_sec, 3),
+                'avg_sec': round(self.total_sec / self.count, 3) if self.count else 0, 'max_sec': round(self.max_sec, 3)}
+
+
+class RequestSummary(DurationSummary):
+    def __init__(self):
+        super().__init__()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.retries = 0
+        self.status_codes = defaultdict(int)
+
+    def to_json(self):
+        return dict(super().to_json(), bytes_sent=self.bytes_sent, bytes_received=self.bytes_received, retries=self.retries,
+                    status_codes=dict(self.status_codes))
+
+
+class WaitSummary(DurationSummary):
+    def __init__(self):
+        super().__init__()
+        self.polls = 0
+        self.slack_sec = 0
+
+    def to_json(self):
+        return dict(super().to_json(), polls=self.polls, slack_sec=round(self.slack_sec, 3))
+
+
+class TransferSummary(DurationSummary):
+    def __init__(self):
+        super().__init__()
+        self.bytes = 0
+
+    def to_json(self):
+        mb_per_sec = self.bytes / self.total_sec / (1024 * 1024) if self.total_sec else 0
+        return dict(super().to_json(), bytes=self.bytes, mb_per_sec=round(mb_per_sec, 2))
+
+
+class RateLimitSummary(DurationSummary):
+    def __init__(self):
+        super().__init__()
+        self.delayed = 0
+
+    def to_json(self):
+        return dict(super().to_json(), delayed=self.delayed)
+
+
+class RunMetrics:
+    def __init__(self):
+        self.start_time = time()
+        self._start = monotonic()
+        self._lock = Lock()
+        self._local = local()
+        self.stages = defaultdict(DurationSummary)
+        self.requests = defaultdict(RequestSummary)
+        self.waits = defaultdict(WaitSummary)
+        self.transfers = defaultdict(TransferSummary)
+        self.rate_limits = defaultdict(RateLimitSummary)
+
+    @property
+    def current_stage(self):
+        return getattr(self._local, 'stage', None) or UNKNOWN_STAGE
+
+    @contextmanager
+    def stage(self, name):
+        previous_stage = getattr(self._local, 'stage', None)
+        self._local.stage = name
+        start_time = monotonic()
+        failed = True
+        try:
+            with get_timeline().span(name, 'stage'):
+                yield
+            failed = False
+        finally:
+            self._local.stage = previous_stage
+            self.record_stage(name, monotonic() - start_time, failed)
+
+    def record_stage(self, name, duration_sec, failed=False):
+        with self._lock:
+            self.stages[name].add(duration_sec, failed)
+
+    def record_request(self, operation, status_code, duration_sec, bytes_sent=0, bytes_received=0):
+        with self._lock:
+            summary = self.requests[operation]
+            summary.add(duration_sec, status_code is None or status_code >= 400)
+            summary.status_codes[str(status_code or 'error')] += 1
+            summary.bytes_sent += bytes_sent
+            summary.bytes_received += bytes_received
+
+    def record_retry(self, operation):
+        with self._lock:
+            self.requests[operation].retries += 1
+
+    def record_wait(self, duration_sec, polls, slack_sec=None, failed=False):
+        with self._lock:
+            summary = self.waits[self.current_stage]
+            summary.add(duration_sec, failed)
+            summary.polls += polls
+            summary.slack_sec += slack_sec or 0
+
+    def record_rate_limit(self, operation, wait_sec):
+        with self._lock:
+            summary = self.rate_limits[operation]
+            summary.add(wait_sec)
+            summary.delayed += int(wait_sec > 0)
+
+    def record_transfer(self, direction, num_bytes, duration_sec):
+        with self._lock:
+            summary = self.transfers[direction]
+            summary.add(duration_sec)
+            summary.bytes += num_bytes
+
+    def to_json(self):
+        with self._lock:
+            return {
+                'start_time': self.start_time,
+                'duration_sec': round(monotonic() - self._start, 3),
+                'stages': {name: summary.to_json() for name, summary in self.stages.items()},
+                'waits': {name: summary.to_json() for name, summary in self.waits.items()},
+                'transfers': {name: summary.to_json() for name, summary in self.transfers.items()},
+                'requests': {name: summary.to_json() for name, summary in self.requests.items()},
+                'rate_limits': {name: summary.to_json() for name, summary in self.rate_limits.items()}
+            }
+
+    def to_prometheus(self):
+        summary = self.to_json()
+        lines = []
+
+        def metric(name, metric_type, help_text, samples):
+            lines.append(f"# HELP {PROMETHEUS_PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}_{name} {metric_type}")
+            for labels, value in samples:
+                label_text = ','.join(f'{key}="{label_value}"' for key, label_value in labels.items())
+                lines.append(f"{PROMETHEUS_PREFIX}_{name}{{{label_text}}} {value}" if labels else f"{PROMETHEUS_PREFIX}_{name} {value}")
+
+        def samples(group, label, key):
+            return [({label: name}, values[key]) for name, values in sorted(summary[group].items())]
+
+        metric('run_duration_seconds', 'gauge', 'Duration of the run', [({}, summary['duration_sec'])])
+        metric('run_start_time_seconds', 'gauge', 'Unix time the run started', [({}, summary['start_time'])])
+        metric('stage_duration_seconds_sum', 'counter', 'Time spent in each stage', samples('stages', 'stage', 'total_sec'))
+        metric('stage_duration_seconds_count', 'counter', 'Number of times each stage ran', samples('stages', 'stage', 'count'))
+        metric('stage_failures_total', 'counter', 'Number of failed runs of each stage', samples('stages', 'stage', 'failed'))
+        metric('task_wait_seconds_sum', 'counter', 'Time spent waiting for server tasks, by stage', samples('waits', 'stage', 'total_sec'))
+        metric('task_wait_polls_total', 'counter', 'Status requests sent while waiting for server tasks, by stage', samples('waits', 'stage', 'polls'))
+        metric('task_wait_slack_seconds_sum', 'counter', 'Upper bound of the time between task completion and the status request noticing it',
+               samples('waits', 'stage', 'slack_sec'))
+        metric('transfer_bytes_total', 'counter', 'Bytes of app files uploaded and outputs downloaded', samples('transfers', 'direction', 'bytes'))
+        metric('transfer_seconds_sum', 'counter', 'Time spent uploading app files and downloading outputs', samples('transfers', 'direction', 'total_sec'))
+        metric('http_request_duration_seconds_sum', 'counter', 'Time spent in HTTP requests', samples('requests', 'operation', 'total_sec'))
+        metric('http_request_duration_seconds_count', 'counter', 'Number of HTTP requests', samples('requests', 'operation', 'count'))
+        metric('http_request_retries_total', 'counter', 'Number of retried HTTP requests', samples('requests', 'operation', 'retries'))
+        metric('http_request_bytes_sent_total', 'counter', 'Bytes sent in HTTP requests', samples('requests', 'operation', 'bytes_sent'))
+        metric('http_request_bytes_received_total', 'counter', 'Bytes received in HTTP responses',
+               samples('requests', 'operation', 'bytes_received'))
+        metric('rate_limit_wait_seconds_sum', 'counter', 'Time requests waited for the client side rate limiter',
+               samples('rate_limits', 'operation', 'total_sec'))
+        metric('rate_limit_delayed_total', 'counter', 'Number of requests delayed by the client side rate limiter',
+               samples('rate_limits', 'operation', 'delayed'))
+        metric('http_responses_total', 'counter', 'Number of HTTP responses by status code',
+               [({'operation': operation, 'code': code}, count) for operation, values in sorted(summary['requests'].items())
+                for code, count in sorted(values['status_codes'].items())])
+        return '\n'.join(lines) + '\n'
+
+    def write_json(self, path):
+        _write_atomic(path, json.dumps(self.to_json(), indent=2))
+
+    def write_prometheus(self, path):
+        _write_atomic(path, self.to_prometheus())
+
+
+def _write_atomic(path, content):
+    # The node exporter textfile collector may read the file at any time
+    temp_path = path + '-tmp'
+    with open(temp_path, 'w') as f:
+        f.write(content)
+    replace(temp_path, path)
+
+
+_metrics = RunMetrics()
+
+
+def get_metrics():
+    return _metrics
+
+
+def add_metrics_args(parser):
+    parser.add_argument('--metrics_json', metavar='metrics_json_file', help='Output file for stage, wait, transfer and HTTP request metrics')
+    parser.add_argument('--metrics_prom', metavar='metrics_prom_file',
+                        help='Output file for the same metrics in the Prometheus text format, e.g. for the node exporter textfile collector')
+
+
+def export_metrics(args):
+    if getattr(args, 'metrics_json', None):
+        _metrics.write_json(args.metrics_json)
+    if getattr(args, 'metrics_prom', None):
+        _metrics.write_prometheus(args.metrics_prom)
@@ -0,0 +1,478 @@
+import argparse
+import base64
+import hashlib
+import json
+import logging
+import random
+import re
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from time import sleep, monotonic
+from urllib.parse import urlparse, parse_qs
+from uuid import uuid4
+from xml.etree import ElementTree
+
+READ_CHUNK_SIZE = 1024 * 1024
+MB = 1024 * 1024
+DEFAULT_TASK_DURATION_SEC = 5
+DEFAULT_OUTPUT_SIZE_MB = 10
+CERTIFICATE_SIZE = 200 * 1024
+ERROR_RETRY_AFTER_SEC = 1
+# Payload byte i is i % 251, so misplaced ranges change the content
+PAYLOAD_PERIOD = 251
+PAYLOAD_PATTERN = bytes(range(PAYLOAD_PERIOD)) * (READ_CHUNK_SIZE // PAYLOAD_PERIOD + 2)
+RANGE_HEADER = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def payload_chunks(offset, length):
+    while length > 0:
+        chunk_size = min(READ_CHUNK_SIZE, length)
+        start = offset % PAYLOAD_PERIOD
+        yield PAYLOAD_PATTERN[start:start + chunk_size]
+        offset += chunk_size
+        length -= chunk_size
+
+
+class MockStats:
+    def __init__(self):
+        self.requests = 0
+        self.connections = 0
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.errors_injected = 0
+        self.responses_lost = 0
+        self.downloads_dropped = 0
+        self.routes = {}
+
+    def to_json(self):
+        return dict(vars(self), routes=dict(self.routes))
+
+
+class MockState:
+    def __init__(self, latency_sec=0, fail_rate=0, task_duration_sec=DEFAULT_TASK_DURATION_SEC, output_size_mb=DEFAULT_OUTPUT_SIZE_MB,
+                 error_rate=0, task_fail_rate=0, separate_sign_tasks=False, lost_response_rate=0, download_drop_rate=0):
+        self.latency_sec = latency_sec
+        self.fail_rate = fail_rate
+        self.task_duration_sec = task_duration_sec
+        self.output_size = int(output_size_mb * MB)
+        self.error_rate = error_rate
+        self.task_fail_rate = task_fail_rate
+        self.separate_sign_tasks = separate_sign_tasks
+        self.lost_response_rate = lost_response_rate
+        self.download_drop_rate = download_drop_rate
+        self.lock = Lock()
+        self.payload_md5s = {}
+        self.files = {}
+        self.multipart_uploads = {}
+        self.apps = {}
+        self.tasks = {}
+        self.validations = {}
+        self.stats = MockStats()
+
+    def reset_stats(self):
+        with self.lock:
+            stats, self.stats = self.stats, MockStats()
+        return stats
+
+    def count(self, **values):
+        with self.lock:
+            for key, value in values.items():
+                setattr(self.stats, key, getattr(self.stats, key) + value)
+
+    def payload_md5(self, size):
+        with self.lock:
+            if size not in self.payload_md5s:
+                digest = hashlib.md5()
+                for chunk in payload_chunks(0, size):
+                    digest.update(chunk)
+                self.payload_md5s[size] = base64.b64encode(digest.digest()).decode()
+            return self.payload_md5s[size]
+
+
+class MockRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    routes = [
+        ('GET', r'/api/v1/upload-link$', 'upload_link'),
+        ('PUT', r'/storage/(?P<file_id>[^/]+)$', 'storage_put'),
+        ('POST', r'/storage/(?P<file_id>[^/]+)$', 'storage_complete'),
+        ('POST', r'/api/v1/upload-using-link$', 'upload_using_link'),
+        ('POST', r'/api/v1/tasks$', 'create_task'),
+        ('GET', r'/api/v1/tasks/(?P<task_id>[^/]+)/status$', 'task_status'),
+        ('GET', r'/api/v1/tasks/(?P<task_id>[^/]+)/(?P<command>output|certificate|certificate-json)$', 'task_output'),
+        ('GET', r'/downloads/(?P<task_id>[^/]+)/(?P<command>output|certificate)$', 'storage_get'),
+        ('POST', r'/api/v1/validation/upload$', 'validation_upload'),
+        ('GET', r'/api/v1/validation/(?P<validation_id>[^/]+)/status$', 'validation_status'),
+        ('GET', r'/mock/stats$', 'mock_stats'),
+    ]
+
+    @property
+    def state(self):
+        return self.server.state
+
+    @property
+    def base_url(self):
+        return f"http://{self.headers.get('Host')}"
+
+    def setup(self):
+        super().setup()
+        self.state.count(connections=1)
+
+    def log_message(self, format, *args):
+        logging.debug(f"Mock server: {format % args}")
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_PUT(self):
+        self.dispatch('PUT')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def dispatch(self, method):
+        parsed = urlparse(self.path)
+        self.query = {key: values[0] for key, values in parse_qs(parsed.query).items()}
+        self.state.count(requests=1)
+        for route_method, pattern, handler_name in self.routes:
+            match = re.match(pattern, parsed.path)
+            if route_method == method and match:
+                with self.state.lock:
+                    self.state.stats.routes[handler_name] = self.state.stats.routes.get(handler_name, 0) + 1
+                if self.state.latency_sec:
+                    sleep(self.state.latency_sec)
+                if parsed.path.startswith('/api/') and self.should_inject_error():
+                    self.read_body()
+                    return self.send_json(503, {'error': 'Injected error'}, {'Retry-After': str(ERROR_RETRY_AFTER_SEC)})
+                self.lose_response = method == 'POST' and parsed.path.startswith('/api/') and self.should_lose_response()
+                return getattr(self, handler_name)(**match.groupdict())
+        self.read_body()
+        self.send_json(404, {'error': f"No route for {method} {parsed.path}"})
+
+    def read_body(self, digest=None):
+        remaining = int(self.headers.get('Content-Length') or 0)
+        size = 0
+        chunks = [] if digest is None else None
+        while remaining > 0:
+            chunk = self.rfile.read(min(READ_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            size += len(chunk)
+            if digest is None:
+                chunks.append(chunk)
+            else:
+                digest.update(chunk)
+        self.state.count(bytes_received=size)
+        return size if digest is not None else b''.join(chunks)
+
+    def read_form(self):
+        body = self.read_body()
+        content_type = self.headers.get('Content-Type', '')
+        if not content_type.startswith('multipart/form-data'):
+            return {key: values[0] for key, values in parse_qs(body.decode(errors='replace')).items()}
+        message = BytesParser(policy=HTTP).parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+        return {part.get_param('name', header='content-disposition'): part.get_content()
+                for part in message.iter_parts()}
+
+    def send_body(self, status_code, body, content_type, headers=None):
+        self.send_response(status_code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.state.count(bytes_sent=len(body))
+
+    def send_payload(self, size, content_type, etag=None):
+        # Payloads are generated in chunks so large outputs don't take server memory
+        byte_range = self.requested_range(size, etag)
+        if byte_range == 'unsatisfiable':
+            return self.send_body(416, b'', content_type, {'Content-Range': f"bytes */{size}"})
+        start, end = byte_range or (0, size - 1)
+        length = end - start + 1
+        self.send_response(206 if byte_range else 200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(length))
+        if etag:
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('ETag', etag)
+        if byte_range:
+            self.send_header('Content-Range', f"bytes {start}-{end}/{size}")
+        elif etag:
+            self.send_header('Content-MD5', self.state.payload_md5(size))
+        self.end_headers()
+        if etag and self.should_drop_download():
+            # The connection closes halfway, like a dropped transfer
+            length //= 2
+            self.close_connection = True
+        sent = 0
+        try:
+            for chunk in payload_chunks(start, length):
+                self.wfile.write(chunk)
+                sent += len(chunk)
+        except (BrokenPipeError, ConnectionResetError):
+            # Clients reading only the start of a file close the connection
+            self.close_connection = True
+        self.state.count(bytes_sent=sent)
+
+    def requested_range(self, size, etag):
+        match = RANGE_HEADER.match(self.headers.get('Range', '')) if etag else None
+        if not match or not any(match.groups()) or self.headers.get('If-Range', etag) != etag:
+            return None
+        first, last = match.groups()
+        start, end = (int(first), min(int(last or size - 1), size - 1)) if first else (max(size - int(last), 0), size - 1)
+        return (start, end) if start <= end else 'unsatisfiable'
+
+    def send_redirect(self, location):
+        self.send_response(302)
+        self.send_header('Location', location)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def send_json(self, status_code, obj, headers=None):
+        if getattr(self, 'lose_response', False):
+            # The request was handled, but the answer is replaced like a gateway that timed out waiting for it
+            self.lose_response = False
+            status_code, obj, headers = 502, {'error': 'Injected lost response'}, None
+        self.send_body(status_code, json.dumps(obj).encode(), 'application/json', headers)
+
+    def should_fail(self):
+        return self.state.fail_rate and random.random() < self.state.fail_rate
+
+    def should_drop_download(self):
+        if self.state.download_drop_rate and random.random() < self.state.download_drop_rate:
+            self.state.count(downloads_dropped=1)
+            return True
+        return False
+
+    def should_inject_error(self):
+        if self.state.error_rate and random.random() < self.state.error_rate:
+            self.state.count(errors_injected=1)
+            return True
+        return False
+
+    def should_lose_response(self):
+        if self.state.lost_response_rate and random.random() < self.state.lost_response_rate:
+            self.state.count(responses_lost=1)
+            return True
+        return False
+
+    def upload_link(self):
+        file_id = uuid4().hex
+        storage_url = f"{self.base_url}/storage/{file_id}"
+        if self.query.get('multipart') != 'true':
+            return self.send_json(200, {'url': storage_url, 'file_id': file_id})
+        file_size = int(self.query['file_size'])
+        part_size = int(self.query['part_size'])
+        upload_id = uuid4().hex
+        num_of_parts = max((file_size + part_size - 1) // part_size, 1)
+        with self.state.lock:
+            self.state.multipart_uploads[upload_id] = {'file_id': file_id, 'parts': {}}
+        self.send_json(200, {
+            'file_id': file_id,
+            'upload_id': upload_id,
+            'part_urls': [f"{storage_url}?uploadId={upload_id}&partNumber={n}" for n in range(1, num_of_parts + 1)],
+            'complete_url': f"{storage_url}?uploadId={upload_id}"
+        })
+
+    def storage_put(self, file_id):
+        digest = hashlib.md5()
+        size = self.read_body(digest)
+        if self.should_fail():
+            return self.send_body(503, b'SlowDown', 'text/plain')
+        etag = f'"{digest.hexdigest()}"'
+        upload_id = self.query.get('uploadId')
+        with self.state.lock:
+            upload = self.state.multipart_uploads.get(upload_id) if upload_id else None
+            if upload:
+                upload['parts'][int(self.query['partNumber'])] = (size, etag)
+            elif not upload_id:
+                self.state.files[file_id] = size
+        if upload_id and not upload:
+            return self.send_body(404, b'NoSuchUpload', 'text/plain')
+        self.send_body(200, b'', 'text/plain', {'ETag': etag})
+
+    def storage_complete(self, file_id):
+        body = self.read_body()
+        with self.state.lock:
+            upload = self.state.multipart_uploads.pop(self.query.get('uploadId'), None)
+        if not upload:
+            return self.send_body(404, b'NoSuchUpload', 'text/plain')
+        requested_parts = {int(part.findtext('PartNumber')): part.findtext('ETag')
+                           for part in ElementTree.fromstring(body).iter('Part')}
+        if requested_parts != {n: etag for n, (size, etag) in upload['parts'].items()}:
+            return self.send_body(400, b'InvalidPart', 'text/plain')
+        with self.state.lock:
+            self.state.files[file_id] = sum(size for size, etag in upload['parts'].values())
+        self.send_body(200, b'<CompleteMultipartUploadResult/>', 'application/xml')
+
+    def upload_using_link(self):
+        form = self.read_form()
+        file_id = form.get('file_app_id')
+        app_id = uuid4().hex
+        with self.state.lock:
+            known_file = file_id in self.state.files
+            if known_file:
+                self.state.apps[app_id] = {'file_id': file_id, 'file_name': form.get('file_name')}
+        if not known_file:
+            return self.send_json(400, {'error': f"Unknown file id {file_id}"})
+        self.send_json(200, {'id': app_id, 'file_id': file_id})
+
+    def start_task(self, task_id, action):
+        failed = self.state.task_fail_rate and random.random() < self.state.task_fail_rate
+        # Every action writes new outputs, with a new ETag
+        self.state.tasks[task_id] = {'action': action, 'done_time': monotonic() + self.state.task_duration_sec,
+                                     'status': 'failed' if failed else 'completed', 'version': uuid4().hex[:8]}
+
+    def task_status_value(self, task):
+        return task['status'] if monotonic() >= task['done_time'] else 'progress'
+
+    def create_task(self):
+        form = self.read_form()
+        action = form.get('action')
+        with self.state.lock:
+            status_code, response = self.start_task_action(action, form)
+        self.send_json(status_code, response)
+
+    def start_task_action(self, action, form):
+        if action == 'fuse':
+            if form.get('app_id') not in self.state.apps:
+                return 404, {'error': f"Unknown app id {form.get('app_id')}"}
+            task_id = uuid4().hex
+        else:
+            # Post build actions run on the build task, which the client keeps polling
+            task_id = form.get('parent_task_id')
+            task = self.state.tasks.get(task_id)
+            if not task:
+                return 404, {'error': f"Unknown task id {task_id}"}
+            if self.task_status_value(task) != 'completed':
+                return 400, {'error': f"Task {task_id} is not ready for {action}"}
+            if self.state.separate_sign_tasks and action != 'context':
+                task_id = uuid4().hex
+        self.start_task(task_id, action)
+        return 200, {'task_id': task_id}
+
+    def task_status(self, task_id):
+        with self.state.lock:
+            task = self.state.tasks.get(task_id)
+            status_value = self.task_status_value(task) if task else None
+        if not task:
+            return self.send_json(404, {'error': f"Unknown task id {task_id}"})
+        response = {'task_id': task_id, 'status': status_value}
+        if status_value == 'failed':
+            response['message'] = 'Injected task failure'
+        self.send_json(200, response)
+
+    def task_output(self, task_id, command):
+        with self.state.lock:
+            task = self.state.tasks.get(task_id)
+            status_value = self.task_status_value(task) if task else None
+        if status_value != 'completed':
+            return self.send_json(404, {'error': f"No {command} for task {task_id} ({status_value})"})
+        if command == 'certificate-json':
+            return self.send_json(200, {'task_id': task_id, 'action': task['action'], 'certified_secure': True})
+        # Files are served from storage, like the presigned URLs the API redirects to
+        self.send_redirect(f"{self.base_url}/downloads/{task_id}/{command}")
+
+    def storage_get(self, task_id, command):
+        with self.state.lock:
+            task = self.state.tasks.get(task_id)
+        if not task:
+            return self.send_json(404, {'error': f"Unknown task id {task_id}"})
+        etag = f'"{task_id}-{task["version"]}-{command}"'
+        if command == 'certificate':
+            return self.send_payload(CERTIFICATE_SIZE, 'application/pdf', etag)
+        self.send_payload(self.state.output_size, 'application/octet-stream', etag)
+
+    def validation_upload(self):
+        if 'file' not in self.read_form():
+            return self.send_json(400, {'error': 'Missing file'})
+        validation_id = uuid4().hex
+        with self.state.lock:
+            self.state.validations[validation_id] = monotonic() + self.state.task_duration_sec
+        self.send_json(200, {'id': validation_id})
+
+    def validation_status(self, validation_id):
+        with self.state.lock:
+            done_time = self.state.validations.get(validation_id)
+        if done_time is None:
+            return self.send_json(404, {'error': f"Unknown validation id {validation_id}"})
+        validation_state = 'completed' if monotonic() >= done_time else 'active'
+        self.send_json(200, {'id': validation_id, 'validation_state': validation_state, 'signed': validation_state == 'completed'})
+
+    def mock_stats(self):
+        with self.state.lock:
+            stats = self.state.stats.to_json()
+        self.send_json(200, stats)
+
+
+class MockAppdomeServer:
+    def __init__(self, host='127.0.0.1', port=0, latency_sec=0, fail_rate=0, task_duration_sec=DEFAULT_TASK_DURATION_SEC,
+                 output_size_mb=DEFAULT_OUTPUT_SIZE_MB, error_rate=0, task_fail_rate=0, separate_sign_tasks=False, lost_response_rate=0,
+                 download_drop_rate=0):
+        self.httpd = ThreadingHTTPServer((host, port), MockRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.state = MockState(latency_sec, fail_rate, task_duration_sec, output_size_mb, error_rate, task_fail_rate,
+                                     separate_sign_tasks, lost_response_rate, download_drop_rate)
+        self._thread = None
+
+    @property
+    def state(self):
+        return self.httpd.state
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def start(self):
+        self._thread = Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def serve_forever(self):
+        self.httpd.serve_forever()
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Run a local stand-in for the Appdome API and storage endpoints')
+    parser.add_argument('--host', default='127.0.0.1', help='Host to listen on. Default is 127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080, help='Port to listen on. Default is 8080')
+    parser.add_argument('--latency', type=float, default=0, metavar='seconds', help='Latency added to every request')
+    parser.add_argument('--fail_rate', type=float, default=0, metavar='ratio', help='Fraction of storage uploads to fail with 503')
+    parser.add_argument('--error_rate', type=float, default=0, metavar='ratio',
+                        help='Fraction of API requests to fail with 503 and Retry-After')
+    parser.add_argument('--lost_response_rate', type=float, default=0, metavar='ratio',
+                        help='Fraction of API POST requests to handle and then answer with 502, as if the response was lost')
+    parser.add_argument('--download_drop_rate', type=float, default=0, metavar='ratio',
+                        help='Fraction of output downloads to close halfway through, as if the connection dropped')
+    parser.add_argument('--task_duration', type=float, default=DEFAULT_TASK_DURATION_SEC, metavar='seconds',
+                        help=f'Time every build, context, signing and validation task stays in progress. Default is {DEFAULT_TASK_DURATION_SEC}')
+    parser.add_argument('--task_fail_rate', type=float, default=0, metavar='ratio', help='Fraction of tasks to end with failed status')
+    parser.add_argument('--output_size', type=float, default=DEFAULT_OUTPUT_SIZE_MB, metavar='MB',
+                        help=f'Size of the output app of every task. Default is {DEFAULT_OUTPUT_SIZE_MB}')
+    parser.add_argument('--separate_sign_tasks', action='store_true',
+                        help='Run every signing in a new task instead of on the build task, so one build can be signed concurrently')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Show debug logs')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    logging.basicConfig(format='[%(asctime)s] [%(levelname)s] %(message)s', level=logging.DEBUG if args.verbose else logging.INFO)
+    server = MockAppdomeServer(args.host, args.port, args.latency, args.fail_rate, args.task_duration, args.output_size,
+                               args.error_rate, args.task_fail_rate, args.separate_sign_tasks, args.lost_response_rate,
+                               args.download_drop_rate)
+    logging.info(f"Mock Appdome server listening. Set APPDOME_SERVER_BASE_URL={server.base_url} to use it")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+import hashlib
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from os import makedirs, remove, replace, stat
+from os.path import exists, join, dirname
+from threading import Lock, current_thread
+from time import time, monotonic
+from html import escape
+
+from metrics import get_metrics
+from timeline import get_timeline
+from upload_cache import DEFAULT_UPLOAD_CACHE_DIR, file_sha256
+from utils import (SERVER_API_V1_URL, SERVER_BASE_URL, UploadFileReader, format_throughput, get_client, build_url, debug_log_request,
+                   validate_response, AppdomeError)
+
+MB = 1024 * 1024
+DEFAULT_PART_SIZE_MB = 64
+MIN_PART_SIZE_MB = 5
+DEFAULT_UPLOAD_WORKERS = 4
+CHECKPOINT_MAX_AGE_SEC = 6 * 3600
+CHECKPOINT_SUFFIX = '.appdome-upload.json'
+UPLOAD_CHECKPOINT_DIR = join(DEFAULT_UPLOAD_CACHE_DIR, 'uploads')
+
+
+def get_multipart_upload_link(api_key, team_id, file_size, part_size):
+    url = build_url(SERVER_API_V1_URL, 'upload-link')
+    params = {'multipart': 'true', 'file_size': file_size, 'part_size': part_size}
+    return get_client().get(url, api_key, team_id, params=params, retry=True)
+
+
+def upload_checkpoint_path(file_path, team_id, job=None):
+    # Kept out of the app directory, which may be read-only, and per job, so concurrent uploads of one app don't share it
+    key = hashlib.sha256(f"{SERVER_BASE_URL}|{team_id or ''}|{file_sha256(file_path)}|{job or ''}".encode()).hexdigest()
+    return join(UPLOAD_CHECKPOINT_DIR, key + CHECKPOINT_SUFFIX)
+
+
+class UploadCheckpoint:
+    def __init__(self, path, data):
+        self.path = path
+        self.data = data
+        self._lock = Lock()
+
+    @classmethod
+    def load(cls, path, file_path, part_size):
+        if not exists(path):
+            return None
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable upload checkpoint [{path}]: {e}")
+            return None
+        file_stat = stat(file_path)
+        if (data.get('file_size') != file_stat.st_size or data.get('file_mtime') != file_stat.st_mtime
+                or data.get('part_size') != part_size or time() - data.get('created', 0) > CHECKPOINT_MAX_AGE_SEC):
+            logging.info(f"Upload checkpoint [{path}] does not match [{file_path}] or has expired. Starting a new upload")
+            return None
+        return cls(path, data)
+
+    @classmethod
+    def create(cls, path, file_path, part_size, link_json):
+        file_stat = stat(file_path)
+        data = {
+            'file_size': file_stat.st_size,
+            'file_mtime': file_stat.st_mtime,
+            'part_size': part_size,
+            'created': time(),
+            'file_id': link_json['file_id'],
+            'upload_id': link_json.get('upload_id'),
+            'part_urls': link_json['part_urls'],
+            'complete_url': link_json['complete_url'],
+            'completed_parts': {}
+        }
+        checkpoint = cls(path, data)
+        checkpoint.save()
+        return checkpoint
+
+    def completed_parts(self):
+        return {int(part_number): etag for part_number, etag in self.data['completed_parts'].items()}
+
+    def mark_done(self, part_number, etag):
+        with self._lock:
+            self.data['completed_parts'][str(part_number)] = etag
+            self.save()
+
+    def save(self):
+        temp_path = self.path + '-tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self.data, f)
+        replace(temp_path, self.path)
+
+    def remove(self):
+        if exists(self.path):
+            remove(self.path)
+
+
+def put_part(part_url, file_path, offset, length, num_of_retries=3):
+    error = None
+    for i in range(num_of_retries):
+        r = None
+        try:
+            with open(file_path, 'rb') as f:
+                f.seek(offset)
+                reader = UploadFileReader(f, length, log_progress=False)
+                r = get_client().request('PUT', part_url, data=reader, headers={'Content-Length': str(length)})
+            etag = r.headers.get('ETag')
+            if r.status_code in [200, 204] and etag:
+                return etag
+            error = f"Status Code: {r.status_code}. Response: {r.text}"
+        except Exception as e:
+            error = e
+        finally:
+            if r is not None:
+                r.close()
+        logging.debug(f"Upload part at offset {offset} failed (attempt {i + 1}/{num_of_retries}). Error: {error}")
+        if i < num_of_retries - 1:
+            get_metrics().record_retry('storage_put')
+            get_timeline().sleep(2 ** i, 'upload_retry_sleep')
+    raise AppdomeError(f"Upload part at offset {offset} failed after {num_of_retries} attempts. Error: {error}")
+
+
+def complete_multipart_upload(complete_url, completed_parts):
+    parts_xml = ''.join(f"<Part><PartNumber>{part_number}</PartNumber><ETag>{escape(etag, quote=False)}</ETag></Part>"
+                        for part_number, etag in sorted(completed_parts.items()))
+    body = f"<CompleteMultipartUpload>{parts_xml}</CompleteMultipartUpload>"
+    debug_log_request(complete_url, data=body)
+    return get_client().request('POST', complete_url, data=body, headers={'Content-Type': 'application/xml'})
+
+
+def multipart_upload(api_key, team_id, file_path, part_size_mb=DEFAULT_PART_SIZE_MB, workers=DEFAULT_UPLOAD_WORKERS,
+                     num_of_retries=3, checkpoint_path=None, job=None):
+    part_size = max(part_size_mb, MIN_PART_SIZE_MB) * MB
+    file_size = stat(file_path).st_size
+    checkpoint_path = checkpoint_path or upload_checkpoint_path(file_path, team_id, job)
+    makedirs(dirname(checkpoint_path), exist_ok=True)
+
+    checkpoint = UploadCheckpoint.load(checkpoint_path, file_path, part_size)
+    if checkpoint:
+        logging.info(f"Resuming upload of file id {checkpoint.data['file_id']} from checkpoint [{checkpoint_path}]")
+    else:
+        link_response = get_multipart_upload_link(api_key, team_id, file_size, part_size)
+        validate_response(link_response)
+        link_json = link_response.json()
+        if not link_json.get('part_urls') or not link_json.get('complete_url') or not link_json.get('file_id'):
+            logging.info("Server did not return multipart upload links. Falling back to a single upload")
+            return None
+        checkpoint = UploadCheckpoint.create(checkpoint_path, file_path, part_size, link_json)
+
+    part_urls = checkpoint.data['part_urls']
+    completed = checkpoint.completed_parts()
+    pending = [part_number for part_number in range(1, len(part_urls) + 1) if part_number not in completed]
+    logging.info(f"Uploading {len(pending)} of {len(part_urls)} parts of [{file_path}] with {workers} workers")
+
+    start_time = monotonic()
+    bytes_sent = 0
+    failed_parts = []
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix=current_thread().name) as executor:
+        futures = {}
+        for part_number in pending:
+            offset = (part_number - 1) * part_size
+            length = min(part_size, file_size - offset)
+            future = executor.submit(put_part, part_urls[part_number - 1], file_path, offset, length, num_of_retries)
+            futures[future] = (part_number, length)
+        for future in as_completed(futures):
+            part_number, length = futures[future]
+            try:
+                checkpoint.mark_done(part_number, future.result())
+                bytes_sent += length
+                logging.debug(f"Part {part_number}/{len(part_urls)} uploaded")
+            except Exception as e:
+                logging.error(f"Part {part_number} failed: {e}")
+                failed_parts.append(part_number)
+
+    elapsed = monotonic() - start_time
+    get_metrics().record_transfer('upload', bytes_sent, elapsed)
+    logging.info(f"Sent {bytes_sent} bytes in {elapsed:.2f} seconds ({format_throughput(bytes_sent, elapsed)})")
+    if failed_parts:
+        raise AppdomeError(f"Multipart upload failed for parts {sorted(failed_parts)}. "
+                     f"Run again to resume from checkpoint [{checkpoint_path}]")
+
+    complete_response = complete_multipart_upload(checkpoint.data['complete_url'], checkpoint.completed_parts())
+    validate_response(complete_response)
+    checkpoint.remove()
+    return checkpoint.data['file_id']
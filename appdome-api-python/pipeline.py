@@ -0,0 +1,87 @@
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from threading import Lock
+from time import monotonic
+
+
+class StageStats:
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self.completed = 0
+        self.failed = 0
+        self.busy_sec = 0
+
+
+class StagedPipeline:
+    def __init__(self, stages, stage_workers):
+        self.stages = stages
+        self.stats = [StageStats(name, stage_workers[name]) for name, stage_func in stages]
+        self._executors = [ThreadPoolExecutor(max_workers=stage_workers[name], thread_name_prefix=f"appdome-{name}")
+                           for name, stage_func in stages]
+        self._pending = set()
+        self._lock = Lock()
+        self._start_time = monotonic()
+
+    def submit(self, item):
+        future = Future()
+        with self._lock:
+            self._pending.add(future)
+        # Finished items are forgotten, so a long lived pipeline doesn't keep every item it ever ran
+        future.add_done_callback(self._discard)
+        self._executors[0].submit(self._run_stage, 0, item, future)
+        return future
+
+    def _run_stage(self, index, item, future):
+        stage_name, stage_func = self.stages[index]
+        stats = self.stats[index]
+        start_time = monotonic()
+        try:
+            stage_func(item)
+        # Anything raised in a worker, KeyboardInterrupt included, must resolve the future or join() waits forever
+        except BaseException as e:
+            with self._lock:
+                stats.failed += 1
+                stats.busy_sec += monotonic() - start_time
+            future.set_exception(e)
+            return
+        with self._lock:
+            stats.completed += 1
+            stats.busy_sec += monotonic() - start_time
+        if index == len(self.stages) - 1:
+            future.set_result(item)
+            return
+        try:
+            self._executors[index + 1].submit(self._run_stage, index + 1, item, future)
+        except RuntimeError as e:
+            # The next stage was shut down
+            future.set_exception(e)
+
+    def _discard(self, future):
+        with self._lock:
+            self._pending.discard(future)
+
+    def join(self):
+        # Items move to the next stage from worker threads, so wait until none is left before closing the pools
+        while True:
+            with self._lock:
+                futures = list(self._pending)
+            if not futures:
+                break
+            wait(futures)
+        for executor in self._executors:
+            executor.shutdown(wait=True)
+        self.log_stats()
+
+    def log_stats(self):
+        elapsed = max(monotonic() - self._start_time, 1e-6)
+        for stats in self.stats:
+            utilization = stats.busy_sec / (elapsed * stats.workers) * 100
+            logging.info(f"Stage {stats.name}: {stats.completed} completed, {stats.failed} failed, {stats.workers} workers, "
+                         f"{stats.busy_sec:.1f} busy seconds ({utilization:.0f}% utilization)")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.join()
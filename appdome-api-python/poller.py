@@ -0,0 +1,122 @@
+import heapq
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import count
+from threading import Condition, Thread
+from time import monotonic
+
+from timeline import get_timeline
+from status import status, PollingPolicy, StatusWait
+from utils import AppdomeError, DEFAULT_HTTP_POOL_SIZE
+
+DEFAULT_STATUS_REQUESTS_PER_SEC = 5
+
+
+class _Registration:
+    def __init__(self, api_key, team_id, task_id, status_wait):
+        self.api_key = api_key
+        self.team_id = team_id
+        self.task_id = task_id
+        self.status_wait = status_wait
+        self.future = Future()
+
+
+class StatusPoller:
+    def __init__(self, requests_per_sec=DEFAULT_STATUS_REQUESTS_PER_SEC, polling_policy=None, num_of_retries=3,
+                 max_in_flight=DEFAULT_HTTP_POOL_SIZE):
+        self.min_request_interval = 1 / requests_per_sec if requests_per_sec else 0
+        self.polling_policy = polling_policy or PollingPolicy()
+        self.num_of_retries = num_of_retries
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix='appdome-status-poller')
+        self._condition = Condition()
+        self._schedule = []
+        self._sequence = count()
+        self._registrations = {}
+        self._next_request_time = 0
+        self._closed = False
+        self._thread = Thread(target=self._run, name='appdome-status-poller', daemon=True)
+        self._thread.start()
+
+    def register(self, api_key, team_id, task_id, timeout_sec=3600):
+        return self._register(api_key, team_id, task_id, timeout_sec).future
+
+    def wait(self, api_key, team_id, task_id, timeout_sec=3600):
+        registration = self._register(api_key, team_id, task_id, timeout_sec)
+        with get_timeline().span('status_poller_wait', 'sleep', task_id=task_id):
+            registration.future.result()
+        return registration.status_wait.finish()
+
+    def _register(self, api_key, team_id, task_id, timeout_sec):
+        key = (team_id, task_id)
+        with self._condition:
+            if self._closed:
+                raise AppdomeError('Status poller is closed')
+            registration = self._registrations.get(key)
+            if not registration:
+                status_wait = StatusWait(task_id, self.polling_policy, timeout_sec, self.num_of_retries)
+                registration = _Registration(api_key, team_id, task_id, status_wait)
+                self._registrations[key] = registration
+                self._schedule_poll(registration, 0)
+            return registration
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            for registration in self._registrations.values():
+                registration.future.set_exception(AppdomeError('Status poller closed'))
+            self._registrations.clear()
+            self._condition.notify_all()
+        self._thread.join()
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _schedule_poll(self, registration, delay_sec):
+        heapq.heappush(self._schedule, (monotonic() + delay_sec, next(self._sequence), registration))
+        self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._closed:
+                    now = monotonic()
+                    wait_sec = None
+                    if self._schedule:
+                        wait_sec = max(self._schedule[0][0], self._next_request_time) - now
+                        if wait_sec <= 0:
+                            break
+                    self._condition.wait(wait_sec)
+                if self._closed:
+                    return
+                poll_time, _, registration = heapq.heappop(self._schedule)
+                self._next_request_time = max(now, self._next_request_time) + self.min_request_interval
+            self._executor.submit(self._poll, registration)
+
+    def _finish(self, registration, result=None, error=None):
+        with self._condition:
+            self._registrations.pop((registration.team_id, registration.task_id), None)
+            if registration.future.done():
+                return
+            if error:
+                registration.future.set_exception(error)
+            else:
+                registration.future.set_result(result)
+
+    def _poll(self, registration):
+        status_response = error = None
+        try:
+            status_response = status(registration.api_key, registration.team_id, registration.task_id)
+        except Exception as e:
+            error = e
+        try:
+            delay_sec = registration.status_wait.step(status_response, error)
+        except Exception as e:
+            return self._finish(registration, error=e)
+        if delay_sec is None:
+            return self._finish(registration, result=registration.status_wait.status_response_json)
+        with self._condition:
+            if not self._closed:
+                self._schedule_poll(registration, delay_sec)
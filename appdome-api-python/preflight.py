@@ -0,0 +1,153 @@
+import argparse
+import logging
+import plistlib
+import re
+import zipfile
+import zlib
+from fnmatch import fnmatchcase
+from os.path import exists, getsize, splitext
+from time import monotonic
+
+from credentials import SigningCredentials, read_provisioning_profile
+from metrics import get_metrics
+from utils import AppdomeError, init_logging, exit_on_error
+
+APP_KINDS = {'.apk': 'apk', '.aab': 'aab', '.ipa': 'ipa'}
+ANDROID_KINDS = ['apk', 'aab']
+APK_MANIFEST = 'AndroidManifest.xml'
+AAB_MANIFEST = 'base/manifest/AndroidManifest.xml'
+AAB_BUNDLE_CONFIG = 'BundleConfig.pb'
+# Compiled binary XML starts with a RES_XML_TYPE chunk header
+BINARY_XML_MAGIC = b'\x03\x00\x08\x00'
+IOS_APP_INFO_PLIST = re.compile(r'^Payload/[^/]+\.app/Info\.plist$')
+# The app and its extensions, watch apps and app clips are each signed with their own provisioning profile
+IOS_BUNDLE_INFO_PLIST = re.compile(r'^Payload/[^/]+\.app/(?:[^/]+/)*[^/]+\.(?:app|appex)/Info\.plist$')
+
+
+class AppInfo:
+    def __init__(self, path, kind, entries):
+        self.path = path
+        self.kind = kind
+        self.entries = entries
+        self.bundle_id = None
+        self.extension_bundle_ids = {}
+
+    @property
+    def platform(self):
+        return 'android' if self.kind in ANDROID_KINDS else 'ios'
+
+
+def app_kind(path):
+    return APP_KINDS.get(splitext(path)[-1].lower())
+
+
+def detect_app_kind(names, info_plists):
+    if AAB_MANIFEST in names and AAB_BUNDLE_CONFIG in names:
+        return 'aab'
+    if APK_MANIFEST in names:
+        return 'apk'
+    if any(IOS_APP_INFO_PLIST.match(name) for name in info_plists):
+        return 'ipa'
+    return None
+
+
+def _read_plist(zip_file, name):
+    try:
+        return plistlib.loads(zip_file.read(name))
+    except Exception as e:
+        raise AppdomeError(f"{name} is not a valid plist: {e}")
+
+
+def inspect_app(path):
+    # Only the central directory and a few small entries are read, so this takes milliseconds even for very large apps
+    if not exists(path):
+        raise AppdomeError(f"App file [{path}] does not exist")
+    file_size = getsize(path)
+    try:
+        with zipfile.ZipFile(path) as zip_file:
+            infos = zip_file.infolist()
+            if any(info.header_offset + info.compress_size > file_size for info in infos):
+                raise AppdomeError(f"App file [{path}] is truncated, entries point past its end")
+            names = set(zip_file.NameToInfo)
+            info_plists = sorted(name for name in names if name.endswith('/Info.plist'))
+            kind = detect_app_kind(names, info_plists)
+            expected_kind = app_kind(path)
+            if not kind:
+                raise AppdomeError(f"App file [{path}] is not an apk, aab or ipa, it has no app manifest or Info.plist")
+            if expected_kind and kind != expected_kind:
+                raise AppdomeError(f"App file [{path}] has a .{expected_kind} extension but its contents are of an .{kind}")
+            app_info = AppInfo(path, kind, len(infos))
+            if kind == 'apk':
+                with zip_file.open(APK_MANIFEST) as f:
+                    if f.read(len(BINARY_XML_MAGIC)) != BINARY_XML_MAGIC:
+                        raise AppdomeError(f"{APK_MANIFEST} of app file [{path}] is not compiled binary XML")
+            elif kind == 'ipa':
+                for name in info_plists:
+                    if IOS_APP_INFO_PLIST.match(name):
+                        app_info.bundle_id = _read_plist(zip_file, name).get('CFBundleIdentifier')
+                    elif IOS_BUNDLE_INFO_PLIST.match(name):
+                        app_info.extension_bundle_ids[name] = _read_plist(zip_file, name).get('CFBundleIdentifier')
+                if not app_info.bundle_id:
+                    raise AppdomeError(f"Info.plist of app file [{path}] has no CFBundleIdentifier")
+    except (zipfile.BadZipFile, zipfile.LargeZipFile, EOFError, zlib.error) as e:
+        raise AppdomeError(f"App file [{path}] is not a valid zip archive: {e}")
+    return app_info
+
+
+def profile_app_id_pattern(profile):
+    # application-identifier is <team id>.<bundle id>, where the bundle id may end with a * wildcard
+    app_identifier = profile.get('Entitlements', {}).get('application-identifier', '')
+    return app_identifier.partition('.')[2] or None
+
+
+def check_provisioning_profiles(app_info, provisioning_profiles):
+    patterns = {}
+    for path, content in provisioning_profiles:
+        pattern = profile_app_id_pattern(read_provisioning_profile(content) or {})
+        if pattern:
+            patterns[pattern] = path
+    bundle_ids = [app_info.bundle_id] + sorted(set(app_info.extension_bundle_ids.values()) - {None})
+    missing = [bundle_id for bundle_id in bundle_ids if not any(fnmatchcase(bundle_id, pattern) for pattern in patterns)]
+    if missing:
+        raise AppdomeError(f"No provisioning profile matches bundle id {', '.join(missing)} of app file [{app_info.path}]. "
+                           f"Profiles are for: {', '.join(sorted(patterns)) or 'none'}")
+
+
+def preflight(path, provisioning_profiles_list=None):
+    start_time = monotonic()
+    with get_metrics().stage('preflight'):
+        app_info = inspect_app(path)
+        if app_info.kind == 'ipa':
+            for provisioning_profiles in provisioning_profiles_list or []:
+                if provisioning_profiles:
+                    check_provisioning_profiles(app_info, provisioning_profiles)
+    bundle_line = f", bundle id {app_info.bundle_id} and {len(app_info.extension_bundle_ids)} extensions" if app_info.bundle_id else ''
+    logging.info(f"Preflight of [{path}] passed in {(monotonic() - start_time) * 1000:.1f} ms: {app_info.kind} with "
+                 f"{app_info.entries} entries{bundle_line}")
+    return app_info
+
+
+def add_preflight_args(parser):
+    parser.add_argument('--skip_preflight', action='store_true',
+                        help='Do not check the app archive and its bundle ids against the provisioning profiles before uploading it')
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Check an app file before uploading it to Appdome')
+    parser.add_argument('-a', '--app', required=True, metavar='application_file', help='App file to check')
+    parser.add_argument('-pr', '--provisioning_profiles', nargs='+', metavar='provisioning_profile_file',
+                        help='iOS provisioning profiles that must match the bundle ids of the app and its extensions')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Show debug logs')
+    return parser.parse_args()
+
+
+@exit_on_error
+def main():
+    args = parse_arguments()
+    init_logging(args.verbose)
+    with SigningCredentials(provisioning_profiles_paths=args.provisioning_profiles) as credentials:
+        preflight(args.app, [credentials.provisioning_profiles])
+
+
+if __name__ == '__main__':
+    main()
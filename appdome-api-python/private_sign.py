@@ -1,8 +1,9 @@
 import argparse
 import logging
 
-from utils import (cleaned_fd_list, add_provisioning_profiles_entitlements, run_task_action, add_google_play_signing_fingerprint,
-                   ANDROID_SIGNING_FINGERPRINT_KEY, validate_response, add_common_args, init_common_args, init_overrides)
+from credentials import SigningCredentials
+from utils import (run_task_action, add_google_play_signing_fingerprint,
+                   ANDROID_SIGNING_FINGERPRINT_KEY, validate_response, add_common_args, init_common_args, init_overrides, exit_on_error)
 
 PRIVATE_SIGN_ACTION = 'seal'
 
@@ -18,14 +19,13 @@ def private_sign_android(api_key, team_id, task_id, signing_fingerprint, is_goog
     return run_task_action(api_key, team_id, PRIVATE_SIGN_ACTION, task_id, overrides, None)
 
 
-def private_sign_ios(api_key, team_id, task_id, provisioning_profiles_paths, sign_overrides=None):
+def private_sign_ios(api_key, team_id, task_id, provisioning_profiles_paths, sign_overrides=None, credentials=None):
     overrides = {}
-    files_list = []
-    with cleaned_fd_list() as open_fd:
-        add_provisioning_profiles_entitlements(provisioning_profiles_paths, None, files_list, overrides, open_fd)
-        if sign_overrides:
-            overrides.update(sign_overrides)
-        return run_task_action(api_key, team_id, PRIVATE_SIGN_ACTION, task_id, overrides, files_list)
+    credentials = credentials or SigningCredentials(provisioning_profiles_paths=provisioning_profiles_paths)
+    files_list = credentials.ios_files(overrides, use_entitlements=False)
+    if sign_overrides:
+        overrides.update(sign_overrides)
+    return run_task_action(api_key, team_id, PRIVATE_SIGN_ACTION, task_id, overrides, files_list)
 
 
 def parse_arguments():
@@ -39,6 +39,7 @@ def parse_arguments():
     return parser.parse_args()
 
 
+@exit_on_error
 def main():
     args = parse_arguments()
     init_common_args(args)
@@ -51,7 +52,7 @@ def main():
         r = private_sign_ios(args.api_key, args.team_id, args.task_id, args.provisioning_profiles, overrides)
 
     validate_response(r)
-    logging.info(f"Private signing for Build id: {r.json()['task_id']} started")
+    logging.info(f"Private signing for Build id: {r.json().get('task_id', args.task_id)} started")
 
 
 if __name__ == '__main__':
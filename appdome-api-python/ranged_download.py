@@ -0,0 +1,309 @@
+import base64
+import hashlib
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from os import remove, replace, stat
+from os.path import exists
+from threading import Lock, current_thread
+from time import time, monotonic
+
+from metrics import get_metrics
+from timeline import get_timeline
+from utils import (DEFAULT_DOWNLOAD_CHUNK_SIZE, AppdomeError, format_throughput, get_client, replace_output_file,
+                   write_response_to_file)
+
+MB = 1024 * 1024
+DEFAULT_DOWNLOAD_CONNECTIONS = 4
+DEFAULT_DOWNLOAD_PART_SIZE_MB = 32
+DEFAULT_RANGED_DOWNLOAD_MIN_SIZE_MB = 64
+CHECKPOINT_MAX_AGE_SEC = 6 * 3600
+CHECKPOINT_SUFFIX = '.appdome-download.json'
+PARTIAL_SUFFIX = '.appdome-download.part'
+CONTENT_RANGE_PREFIX = 'bytes '
+
+
+def expected_digests(headers):
+    # Whole object hashes sent by storage, base64 encoded. Multipart checksums (with a -<parts> suffix) are not of the whole file
+    digests = {}
+    if headers.get('Content-MD5'):
+        digests['md5'] = headers['Content-MD5']
+    for value in headers.get('x-goog-hash', '').split(','):
+        algorithm, _, encoded = value.strip().partition('=')
+        if algorithm == 'md5' and encoded:
+            digests['md5'] = encoded
+    checksum = headers.get('x-amz-checksum-sha256')
+    if checksum and '-' not in checksum:
+        digests['sha256'] = checksum
+    return digests
+
+
+def object_validator(headers):
+    # If-Range only accepts a strong ETag
+    etag = headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return headers.get('Last-Modified')
+
+
+class DownloadCheckpoint:
+    def __init__(self, path, data):
+        self.path = path
+        self.data = data
+        self._lock = Lock()
+
+    @classmethod
+    def load(cls, path, partial_path, source, size, validator, part_size):
+        if not exists(path):
+            return None
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable download checkpoint [{path}]: {e}")
+            return None
+        if (data.get('source') != source or data.get('size') != size or data.get('validator') != validator
+                or data.get('part_size') != part_size or time() - data.get('created', 0) > CHECKPOINT_MAX_AGE_SEC
+                or not exists(partial_path) or stat(partial_path).st_size != size):
+            logging.info(f"Download checkpoint [{path}] does not match the output or has expired. Starting a new download")
+            return None
+        return cls(path, data)
+
+    @classmethod
+    def create(cls, path, source, size, validator, part_size):
+        data = {
+            'source': source,
+            'size': size,
+            'validator': validator,
+            'part_size': part_size,
+            'created': time(),
+            'completed_parts': []
+        }
+        checkpoint = cls(path, data)
+        checkpoint.save()
+        return checkpoint
+
+    def completed_parts(self):
+        return set(self.data['completed_parts'])
+
+    def mark_done(self, part_number):
+        with self._lock:
+            self.data['completed_parts'].append(part_number)
+            self.save()
+
+    def save(self):
+        temp_path = self.path + '-tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self.data, f)
+        replace(temp_path, self.path)
+
+    def remove(self):
+        if exists(self.path):
+            remove(self.path)
+
+
+class RangeIgnoredError(Exception):
+    # The server answered a range request with the whole file, which is kept to be downloaded in a single stream
+    def __init__(self, response):
+        super().__init__(f"Server sent the whole file (status code {response.status_code}) instead of a range")
+        self.response = response
+
+
+def content_range_start(response):
+    content_range = response.headers.get('Content-Range', '')
+    if not content_range.startswith(CONTENT_RANGE_PREFIX):
+        return None
+    return int(content_range[len(CONTENT_RANGE_PREFIX):].partition('-')[0])
+
+
+def get_part(url, headers, partial_path, offset, length, num_of_retries=3, first_response=None):
+    # A dropped connection continues from the last byte written instead of the start of the part
+    written = 0
+    error = None
+    for i in range(num_of_retries):
+        try:
+            if first_response is not None:
+                # The first part is read from the start of the response that found the file
+                r, first_response = first_response, None
+            else:
+                range_headers = dict(headers, Range=f"bytes={offset + written}-{offset + length - 1}")
+                r = get_client().request('GET', url, headers=range_headers, stream=True)
+                if r.status_code == 200:
+                    raise RangeIgnoredError(r)
+                if r.status_code != 206 or content_range_start(r) != offset + written:
+                    r.close()
+                    raise AppdomeError(f"Status Code: {r.status_code}. Content-Range: {r.headers.get('Content-Range')}")
+            try:
+                with open(partial_path, 'r+b') as f:
+                    f.seek(offset + written)
+                    for chunk in r.iter_content(DEFAULT_DOWNLOAD_CHUNK_SIZE):
+                        chunk = chunk[:length - written]
+                        f.write(chunk)
+                        written += len(chunk)
+                        if written == length:
+                            break
+            finally:
+                r.close()
+            if written == length:
+                return length
+            error = f"Connection closed after {written} of {length} bytes"
+        except RangeIgnoredError:
+            raise
+        except Exception as e:
+            error = e
+        logging.debug(f"Download of bytes {offset}-{offset + length - 1} failed at byte {offset + written} "
+                      f"(attempt {i + 1}/{num_of_retries}). Error: {error}")
+        if i < num_of_retries - 1:
+            get_metrics().record_retry('storage_get')
+            get_timeline().sleep(2 ** i, 'download_retry_sleep')
+    raise AppdomeError(f"Download of bytes {offset}-{offset + length - 1} failed after {num_of_retries} attempts. Error: {error}")
+
+
+def verify_file(path, size, digests, digest=None):
+    file_size = stat(path).st_size
+    if file_size != size:
+        raise AppdomeError(f"Downloaded {file_size} bytes instead of {size}")
+    if not digests and not digest:
+        return
+    # One pass over the file computes the hashes sent by storage and the one requested by the caller
+    hashes = {algorithm: hashlib.new(algorithm) for algorithm in digests}
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DEFAULT_DOWNLOAD_CHUNK_SIZE), b''):
+            for file_hash in hashes.values():
+                file_hash.update(chunk)
+            if digest:
+                digest.update(chunk)
+    for algorithm, expected in digests.items():
+        actual = base64.b64encode(hashes[algorithm].digest()).decode()
+        if actual != expected:
+            raise AppdomeError(f"Downloaded file {algorithm} is {actual} instead of {expected}")
+
+
+def discard_download(checkpoint, partial_path):
+    # A file that changed or failed verification is downloaded from the start next time
+    checkpoint.remove()
+    if exists(partial_path):
+        remove(partial_path)
+
+
+class RangedDownload:
+    def __init__(self, connections=DEFAULT_DOWNLOAD_CONNECTIONS, part_size_mb=DEFAULT_DOWNLOAD_PART_SIZE_MB,
+                 min_size_mb=DEFAULT_RANGED_DOWNLOAD_MIN_SIZE_MB):
+        self.connections = connections
+        self.part_size = max(int(part_size_mb * MB), 1)
+        self.min_size = int(min_size_mb * MB)
+
+    def supported_size(self, response):
+        # Checked on the final response, after any redirect to storage
+        size = int(response.headers.get('Content-Length') or 0)
+        if (self.connections < 1 or response.status_code != 200 or size < max(self.min_size, 1)
+                or 'bytes' not in response.headers.get('Accept-Ranges', '')
+                or response.headers.get('Content-Encoding', 'identity') != 'identity'):
+            return None
+        return size
+
+    def write(self, response, output_path, source, size, digest=None):
+        url = response.url
+        # Authorization is only still set when there was no redirect to another host
+        headers = {key: value for key, value in response.request.headers.items() if key == 'Authorization'}
+        validator = object_validator(response.headers)
+        if validator:
+            headers['If-Range'] = validator
+        digests = expected_digests(response.headers)
+
+        checkpoint_path = output_path + CHECKPOINT_SUFFIX
+        partial_path = output_path + PARTIAL_SUFFIX
+        checkpoint = DownloadCheckpoint.load(checkpoint_path, partial_path, source, size, validator, self.part_size)
+        if checkpoint:
+            logging.info(f"Resuming download of [{output_path}] from checkpoint [{checkpoint_path}]")
+        else:
+            with open(partial_path, 'wb') as f:
+                f.truncate(size)
+            checkpoint = DownloadCheckpoint.create(checkpoint_path, source, size, validator, self.part_size)
+
+        num_of_parts = (size + self.part_size - 1) // self.part_size
+        completed = checkpoint.completed_parts()
+        pending = [part_number for part_number in range(num_of_parts) if part_number not in completed]
+        logging.info(f"Downloading {len(pending)} of {num_of_parts} parts of [{output_path}] with {self.connections} connections")
+        if 0 not in pending:
+            response.close()
+
+        start_time = monotonic()
+        bytes_received = 0
+        failed_parts = []
+        full_responses = []
+        try:
+            with get_timeline().span('ranged_download', 'file', path=output_path, parts=len(pending)) as trace_args:
+                with ThreadPoolExecutor(max_workers=max(min(self.connections, len(pending)), 1),
+                                        thread_name_prefix=current_thread().name) as executor:
+                    futures = {}
+                    for part_number in pending:
+                        offset = part_number * self.part_size
+                        length = min(self.part_size, size - offset)
+                        future = executor.submit(get_part, url, headers, partial_path, offset, length, get_client().num_of_retries + 1,
+                                                 response if part_number == 0 else None)
+                        futures[future] = part_number
+                    for future in as_completed(futures):
+                        if future.cancelled():
+                            continue
+                        try:
+                            bytes_received += future.result()
+                            checkpoint.mark_done(futures[future])
+                        except RangeIgnoredError as e:
+                            full_responses.append(e.response)
+                            for pending_future in futures:
+                                pending_future.cancel()
+                        except Exception as e:
+                            logging.error(f"Part {futures[future]} failed: {e}")
+                            failed_parts.append(futures[future])
+                trace_args['bytes'] = bytes_received
+        except BaseException:
+            for full_response in full_responses:
+                full_response.close()
+            raise
+
+        if full_responses:
+            # Ignored ranges, or a file that changed since the download started (If-Range), get the whole current file
+            logging.info(f"Server did not return byte ranges of [{output_path}]. Falling back to a single download")
+            discard_download(checkpoint, partial_path)
+            for full_response in full_responses[1:]:
+                full_response.close()
+            return write_response_to_file(full_responses[0], output_path, digest=digest)
+
+        elapsed = monotonic() - start_time
+        get_metrics().record_transfer('download', bytes_received, elapsed)
+        logging.debug(f"Received {bytes_received} bytes in {elapsed:.2f} seconds ({format_throughput(bytes_received, elapsed)})")
+        if failed_parts:
+            raise AppdomeError(f"Download failed for parts {sorted(failed_parts)}. Run again to resume from checkpoint [{checkpoint_path}]")
+
+        try:
+            verify_file(partial_path, size, digests, digest)
+        except AppdomeError:
+            discard_download(checkpoint, partial_path)
+            raise
+        replace_output_file(partial_path, output_path)
+        checkpoint.remove()
+        return size
+
+
+def write_output_to_file(response, output_path, source, digest=None, ranged_download=None):
+    # Large outputs on servers that support ranges are downloaded in parallel parts, others in a single stream
+    ranged_download = ranged_download or RangedDownload()
+    size = ranged_download.supported_size(response)
+    if not size:
+        return write_response_to_file(response, output_path, digest=digest)
+    return ranged_download.write(response, output_path, source, size, digest)
+
+
+def add_ranged_download_args(parser):
+    parser.add_argument('--download_connections', type=int, default=DEFAULT_DOWNLOAD_CONNECTIONS, metavar='connections',
+                        help=f'Number of byte ranges of a large output to download concurrently when the server supports ranges. '
+                             f'0 always downloads in a single stream. Default is {DEFAULT_DOWNLOAD_CONNECTIONS}')
+    parser.add_argument('--download_part_size', type=float, default=DEFAULT_DOWNLOAD_PART_SIZE_MB, metavar='part_size_mb',
+                        help=f'Size in MB of every byte range. Default is {DEFAULT_DOWNLOAD_PART_SIZE_MB}')
+    parser.add_argument('--ranged_download_min_size', type=float, default=DEFAULT_RANGED_DOWNLOAD_MIN_SIZE_MB, metavar='MB',
+                        help=f'Outputs smaller than this are downloaded in a single stream. Default is {DEFAULT_RANGED_DOWNLOAD_MIN_SIZE_MB}')
+
+
+def init_ranged_download(args):
+    return RangedDownload(args.download_connections, args.download_part_size, args.ranged_download_min_size)
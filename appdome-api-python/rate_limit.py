@@ -0,0 +1,90 @@
+import hashlib
+import json
+from os import fdopen, open as os_open, O_CREAT, O_RDWR
+from threading import Lock
+from time import time
+
+from metrics import get_metrics
+from timeline import get_timeline
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+SHARED_RATE_LIMIT_SUPPORTED = fcntl is not None
+
+
+def rate_limit_key(api_key, team_id):
+    # The api key itself is never written to the shared state file
+    return f"{hashlib.sha256(str(api_key).encode()).hexdigest()[:16]}:{team_id or ''}"
+
+
+def reserve_token(bucket, now, requests_per_sec, burst):
+    # Tokens go below zero for requests that are already waiting, so later requests queue behind them
+    tokens, updated = bucket or (burst, now)
+    tokens = min(burst, tokens + max(now - updated, 0) * requests_per_sec) - 1
+    return [tokens, now], max(-tokens / requests_per_sec, 0)
+
+
+class RateLimiter:
+    def __init__(self, requests_per_sec=0, burst=None, state_path=None):
+        self.requests_per_sec = requests_per_sec
+        self.burst = max(burst or requests_per_sec, 1)
+        self.state_path = state_path
+        self._lock = Lock()
+        self._buckets = {}
+
+    @property
+    def enabled(self):
+        return self.requests_per_sec > 0
+
+    def reserve(self, api_key, team_id):
+        key = rate_limit_key(api_key, team_id)
+        with self._lock:
+            if self.state_path:
+                return self._reserve_shared(key)
+            self._buckets[key], wait_sec = reserve_token(self._buckets.get(key), time(), self.requests_per_sec, self.burst)
+            return wait_sec
+
+    def _reserve_shared(self, key):
+        # Processes on the same host share the buckets in one file, updated under an exclusive lock
+        with fdopen(os_open(self.state_path, O_RDWR | O_CREAT, 0o600), 'r+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                buckets = json.loads(f.read() or '{}')
+            except ValueError:
+                buckets = {}
+            buckets[key], wait_sec = reserve_token(buckets.get(key), time(), self.requests_per_sec, self.burst)
+            f.seek(0)
+            f.truncate()
+            f.write(json.dumps(buckets))
+            f.flush()
+            fcntl.flock(f, fcntl.LOCK_UN)
+        return wait_sec
+
+    def acquire(self, api_key, team_id, operation):
+        if not self.enabled:
+            return 0
+        wait_sec = self.reserve(api_key, team_id)
+        if wait_sec > 0:
+            get_timeline().sleep(wait_sec, 'rate_limit_wait', operation=operation)
+        get_metrics().record_rate_limit(operation, wait_sec)
+        return wait_sec
+
+
+_rate_limiter = RateLimiter()
+
+
+def get_rate_limiter():
+    return _rate_limiter
+
+
+def init_rate_limiter(requests_per_sec=0, burst=None, state_path=None):
+    global _rate_limiter
+    rate_limiter = RateLimiter(requests_per_sec, burst, state_path)
+    # Jobs initialized with the same limits keep sharing the buckets
+    if (rate_limiter.requests_per_sec, rate_limiter.burst, rate_limiter.state_path) != \
+            (_rate_limiter.requests_per_sec, _rate_limiter.burst, _rate_limiter.state_path):
+        _rate_limiter = rate_limiter
+    return _rate_limiter
@@ -2,15 +2,16 @@ import argparse
 import logging
 import json
 
-from utils import (add_provisioning_profiles_entitlements, add_google_play_signing_fingerprint,
-                   run_task_action, cleaned_fd_list, validate_response, add_common_args, init_common_args, init_overrides)
+from credentials import SigningCredentials
+from utils import (add_google_play_signing_fingerprint, run_task_action, validate_response, add_common_args, init_common_args,
+                   init_overrides, exit_on_error)
 
 SIGN_ACTION = 'sign'
 
 
 def sign_android(api_key, team_id, task_id,
                  keystore_path, keystore_pass, key_alias, key_pass,
-                 google_play_signing_fingerprint=None, sign_overrides=None):
+                 google_play_signing_fingerprint=None, sign_overrides=None, credentials=None):
     overrides = {
         'signing_keystore_password':  keystore_pass,
         'signing_keystore_alias': key_alias,
@@ -22,23 +23,20 @@ def sign_android(api_key, team_id, task_id,
     if sign_overrides:
         overrides.update(sign_overrides)
 
-    with open(keystore_path, 'rb') as f:
-        files = {'signing_keystore': (keystore_path, f)}
-        return run_task_action(api_key, team_id, SIGN_ACTION, task_id, overrides, files)
+    credentials = credentials or SigningCredentials(keystore_path)
+    return run_task_action(api_key, team_id, SIGN_ACTION, task_id, overrides, credentials.keystore_files('signing_keystore'))
 
 
 def sign_ios(api_key, team_id, task_id,
-             keystore_p12_path, keystore_pass, provisioning_profiles_paths, entitlements_paths=None, sign_overrides=None):
+             keystore_p12_path, keystore_pass, provisioning_profiles_paths, entitlements_paths=None, sign_overrides=None,
+             credentials=None):
     overrides = {'signing_p12_password':  keystore_pass}
 
-    with cleaned_fd_list() as open_fd:
-        f = open(keystore_p12_path, 'rb')
-        open_fd.append(f)
-        files_list = [('signing_p12_content', (keystore_p12_path, f))]
-        add_provisioning_profiles_entitlements(provisioning_profiles_paths, entitlements_paths, files_list, overrides, open_fd)
-        if sign_overrides:
-            overrides.update(sign_overrides)
-        return run_task_action(api_key, team_id, SIGN_ACTION, task_id, overrides, files_list)
+    credentials = credentials or SigningCredentials(keystore_p12_path, provisioning_profiles_paths, entitlements_paths)
+    files_list = credentials.keystore_files('signing_p12_content') + credentials.ios_files(overrides)
+    if sign_overrides:
+        overrides.update(sign_overrides)
+    return run_task_action(api_key, team_id, SIGN_ACTION, task_id, overrides, files_list)
 
 
 def parse_arguments():
@@ -58,6 +56,7 @@ def parse_arguments():
     return parser.parse_args()
 
 
+@exit_on_error
 def main():
     args = parse_arguments()
     init_common_args(args)
@@ -72,7 +71,7 @@ def main():
                      args.provisioning_profiles, args.entitlements, overrides)
 
     validate_response(r)
-    logging.info(f"On Appdome signing for Build id: {r.json()['task_id']} started")
+    logging.info(f"On Appdome signing for Build id: {r.json().get('task_id', args.task_id)} started")
 
 
 if __name__ == '__main__':
@@ -1,63 +1,180 @@
 import argparse
 import logging
-from time import sleep
+import random
+import sys
+from math import ceil
+from threading import current_thread, main_thread
+from time import monotonic
 
-import requests
+from metrics import get_metrics
+from timeline import get_timeline
+from utils import (TASKS_URL, JSON_CONTENT_TYPE, validate_response, get_client,
+                   AppdomeError, add_common_args, init_common_args, build_url, exit_on_error, retry_after_sec)
 
-from utils import (TASKS_URL, request_headers, JSON_CONTENT_TYPE, validate_response,
-                   log_and_exit, add_common_args, init_common_args, build_url, team_params)
+LEGACY_POLL_INTERVAL_SEC = 10
+DEFAULT_POLL_INITIAL_INTERVAL_SEC = 1
+DEFAULT_POLL_MAX_INTERVAL_SEC = 30
+DEFAULT_POLL_BACKOFF = 1.5
+DEFAULT_POLL_JITTER = 0.1
+RETRY_AFTER_STATUS_CODES = [429, 503]
 
 
-def status(api_key, team_id, task_id):
-    url = build_url(TASKS_URL, task_id, 'status')
-    params = team_params(team_id)
-    headers = request_headers(api_key, JSON_CONTENT_TYPE)
-    return requests.get(url, headers=headers, params=params)
-
-
-def wait_for_status_complete(api_key, team_id, task_id, interval_sec=10, timeout_sec=3600, num_of_retries=3):
-    accumulated_sleep = 0
-    status_value = 'not initialized'
-    status_response_json = ''
-    while accumulated_sleep <= timeout_sec:
-        status_response = None
-        for i in range(num_of_retries):
-            try:
-                status_response = status(api_key, team_id, task_id)
-            except Exception as e:
-                if i == num_of_retries - 1:
-                    raise Exception('Wait for status Error. Error: {}'.format(e))
-                logging.debug('Wait for status Error. Error: {}'.format(e))
-                sleep(interval_sec)
+class PollingPolicy:
+    def __init__(self, initial_interval_sec=DEFAULT_POLL_INITIAL_INTERVAL_SEC, max_interval_sec=DEFAULT_POLL_MAX_INTERVAL_SEC,
+                 backoff=DEFAULT_POLL_BACKOFF, jitter=DEFAULT_POLL_JITTER):
+        self.initial_interval_sec = initial_interval_sec
+        self.max_interval_sec = max(max_interval_sec, initial_interval_sec)
+        self.backoff = max(backoff, 1)
+        self.jitter = jitter
+
+    @classmethod
+    def fixed(cls, interval_sec):
+        return cls(interval_sec, interval_sec, 1, 0)
+
+    def interval(self, attempt):
+        interval = min(self.initial_interval_sec * self.backoff ** attempt, self.max_interval_sec)
+        if self.jitter:
+            interval *= 1 + random.uniform(-self.jitter, self.jitter)
+        return max(interval, 0)
+
+
+def log_polling_stats(task_id, status_value, elapsed_sec, polls, slack_sec=None):
+    get_metrics().record_wait(elapsed_sec, polls, slack_sec, status_value != 'completed')
+    # A fixed interval poller notices completion only on its next tick after the task is done
+    legacy_polls = ceil(elapsed_sec / LEGACY_POLL_INTERVAL_SEC) + 1 if polls > 1 else polls
+    legacy_elapsed_sec = (legacy_polls - 1) * LEGACY_POLL_INTERVAL_SEC if polls > 1 else elapsed_sec
+    logging.info(f"Task {task_id} {status_value} after {elapsed_sec:.1f} seconds and {polls} status requests "
+                 f"(fixed {LEGACY_POLL_INTERVAL_SEC} second polling: ~{legacy_elapsed_sec:.1f} seconds, {legacy_polls} requests, "
+                 f"time saved: {max(legacy_elapsed_sec - elapsed_sec, 0):.1f} seconds)")
+
+
+class StatusWait:
+    # The polling of one task, shared by the blocking, asyncio and multiplexed waits. step() takes the result of a status
+    # request and returns the seconds to sleep before the next one, or None once the task left progress
+    def __init__(self, task_id, polling_policy=None, timeout_sec=3600, num_of_retries=3):
+        self.task_id = task_id
+        self.polling_policy = polling_policy or PollingPolicy()
+        self.timeout_sec = timeout_sec
+        self.num_of_retries = num_of_retries
+        self.start_time = monotonic()
+        self.polls = 0
+        self.attempt = 0
+        self.errors = 0
+        self.last_progress_time = None
+        self.status_response_json = {}
+        self.sleep_name = None
+
+    @property
+    def status_value(self):
+        return self.status_response_json.get('status', '')
+
+    def step(self, status_response=None, error=None):
+        if error is not None:
+            self.errors += 1
+            if self.errors >= self.num_of_retries:
+                raise AppdomeError(f"Wait for status Error. Error: {error}")
+            logging.debug(f"Wait for status Error. Error: {error}")
+            return self._retry(self.polling_policy.interval(self.errors - 1))
+        self.polls += 1
+        if status_response.status_code in RETRY_AFTER_STATUS_CODES and self.errors + 1 < self.num_of_retries:
+            self.errors += 1
+            throttle_sec = retry_after_sec(status_response)
+            throttle_sec = self.polling_policy.interval(self.errors - 1) if throttle_sec is None else throttle_sec
+            logging.debug(f"Status request returned {status_response.status_code}. Retrying after {throttle_sec:.1f} seconds")
+            return self._retry(throttle_sec)
+        self.errors = 0
         validate_response(status_response)
-        status_response_json = status_response.json()
-        status_value = status_response_json.get('status', '')
-        if status_value == 'progress':
-            logging.debug(f'Task not complete. Response: {status_response_json}. Sleeping for {interval_sec} seconds')
-            print('.', end='', flush=True)
-            sleep(interval_sec)
-            accumulated_sleep += interval_sec
-        else:
-            print('', flush=True)
+        self.status_response_json = status_response.json()
+        if self.status_value != 'progress':
+            return None
+        self.last_progress_time = monotonic()
+        interval = max(self.polling_policy.interval(self.attempt), retry_after_sec(status_response) or 0)
+        self.attempt += 1
+        logging.debug(f"Task {self.task_id} not complete. Response: {self.status_response_json}. Sleeping for {interval:.1f} seconds")
+        self.sleep_name = 'status_poll_sleep'
+        return self._before_sleep(interval)
+
+    def _retry(self, delay_sec):
+        get_metrics().record_retry('task_status')
+        self.sleep_name = 'status_retry_sleep'
+        return self._before_sleep(delay_sec)
+
+    def _before_sleep(self, delay_sec):
+        if monotonic() + delay_sec - self.start_time > self.timeout_sec:
+            raise AppdomeError(f"Task {self.task_id} did not complete in the specified timeout of: {self.timeout_sec} seconds")
+        return delay_sec
+
+    def finish(self):
+        now = monotonic()
+        slack_sec = now - self.last_progress_time if self.last_progress_time else None
+        log_polling_stats(self.task_id, self.status_value, now - self.start_time, self.polls, slack_sec)
+        return self.status_response_json
+
+
+def status(api_key, team_id, task_id, retry=False):
+    url = build_url(TASKS_URL, task_id, 'status')
+    return get_client().get(url, api_key, team_id, content_type=JSON_CONTENT_TYPE, log_request=False, retry=retry)
+
+
+def wait_for_status_complete(api_key, team_id, task_id, interval_sec=None, timeout_sec=3600, num_of_retries=3, polling_policy=None,
+                             poller=None):
+    if poller:
+        status_response_json = poller.wait(api_key, team_id, task_id, timeout_sec)
+        if status_response_json.get('status', '') != 'completed':
+            raise AppdomeError(f"Task not completed successfully. Response: {status_response_json}")
+        return
+    if not polling_policy:
+        polling_policy = PollingPolicy.fixed(interval_sec) if interval_sec else PollingPolicy()
+    status_wait = StatusWait(task_id, polling_policy, timeout_sec, num_of_retries)
+    # Batch and daemon jobs wait on worker threads that share stdout, progress dots are only printed for a terminal user
+    show_progress = sys.stdout.isatty() and current_thread() is main_thread()
+    while True:
+        status_response = error = None
+        try:
+            status_response = status(api_key, team_id, task_id)
+        except Exception as e:
+            error = e
+        delay_sec = status_wait.step(status_response, error)
+        if delay_sec is None:
             break
+        if show_progress and status_wait.sleep_name == 'status_poll_sleep':
+            print('.', end='', flush=True)
+        get_timeline().sleep(delay_sec, status_wait.sleep_name, task_id=task_id)
+    if show_progress and status_wait.attempt:
+        print('', flush=True)
+
+    status_response_json = status_wait.finish()
+    if status_wait.status_value != 'completed':
+        raise AppdomeError(f"Task not completed successfully. Response: {status_response_json}")
+
+
+def add_polling_args(parser):
+    parser.add_argument('--poll_interval', type=float, default=DEFAULT_POLL_INITIAL_INTERVAL_SEC, metavar='seconds',
+                        help=f'First interval between task status requests. Default is {DEFAULT_POLL_INITIAL_INTERVAL_SEC}')
+    parser.add_argument('--poll_max_interval', type=float, default=DEFAULT_POLL_MAX_INTERVAL_SEC, metavar='seconds',
+                        help=f'Max interval between task status requests. Default is {DEFAULT_POLL_MAX_INTERVAL_SEC}')
+    parser.add_argument('--poll_backoff', type=float, default=DEFAULT_POLL_BACKOFF, metavar='multiplier',
+                        help=f'Growth factor of the interval after each status request. 1 means fixed interval. Default is {DEFAULT_POLL_BACKOFF}')
+    parser.add_argument('--poll_jitter', type=float, default=DEFAULT_POLL_JITTER, metavar='ratio',
+                        help=f'Random +/- ratio applied to each interval. Default is {DEFAULT_POLL_JITTER}')
 
-    if accumulated_sleep > timeout_sec:
-        log_and_exit(f"\nTask did not complete in the specified timeout of: {timeout_sec} seconds")
 
-    if status_value != 'completed':
-        log_and_exit(f"Task not completed successfully. Response: {status_response_json}")
+def init_polling_policy(args):
+    return PollingPolicy(args.poll_interval, args.poll_max_interval, args.poll_backoff, args.poll_jitter)
 
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Wait for status of task to be done')
     add_common_args(parser, add_task_id=True)
+    add_polling_args(parser)
     return parser.parse_args()
 
 
+@exit_on_error
 def main():
     args = parse_arguments()
     init_common_args(args)
-    wait_for_status_complete(args.api_key, args.team_id, args.task_id)
+    wait_for_status_complete(args.api_key, args.team_id, args.task_id, polling_policy=init_polling_policy(args))
     logging.info("Task complete")
 
 
@@ -0,0 +1,45 @@
+import sys
+from os import environ
+from os.path import abspath, dirname
+from uuid import uuid4
+
+import pytest
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from mock_server import MockAppdomeServer
+
+# The scripts read the server url when they are imported, so the mock server is started before any test module imports them
+mock_server = MockAppdomeServer(task_duration_sec=0, output_size_mb=1).start()
+environ['APPDOME_SERVER_BASE_URL'] = mock_server.base_url
+
+from utils import init_client
+
+# Failed requests are not retried unless a test asks for it
+init_client(num_of_retries=0)
+
+API_KEY = 'test-api-key'
+TEAM_ID = 'test-team'
+
+
+def add_completed_task(server, action='fuse'):
+    task_id = uuid4().hex
+    with server.state.lock:
+        server.state.tasks[task_id] = {'action': action, 'done_time': 0, 'status': 'completed', 'version': uuid4().hex[:8]}
+    return task_id
+
+
+def replace_task_outputs(server, task_id):
+    # Like a signing that wrote new outputs for the task
+    with server.state.lock:
+        server.state.tasks[task_id]['version'] = uuid4().hex[:8]
+
+
+@pytest.fixture
+def server():
+    state = mock_server.state
+    state.reset_stats()
+    yield mock_server
+    state.error_rate = state.lost_response_rate = state.download_drop_rate = 0
+    state.task_duration_sec = 0
+    state.output_size = 1024 * 1024
@@ -0,0 +1,80 @@
+from os import stat
+
+import pytest
+
+from artifact_cache import ArtifactCache, download_output
+from conftest import API_KEY, TEAM_ID, add_completed_task, replace_task_outputs
+from utils import run_task_action
+
+OUTPUT_SIZE = 1024 * 1024
+
+
+@pytest.fixture
+def artifact_cache(tmp_path):
+    return ArtifactCache(str(tmp_path / 'cache'))
+
+
+def download(task_id, output_path, artifact_cache):
+    download_output(API_KEY, TEAM_ID, task_id, 'output', str(output_path), artifact_cache=artifact_cache)
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_cache_hit_shares_no_inode(server, tmp_path, artifact_cache):
+    task_id = add_completed_task(server)
+    download(task_id, tmp_path / 'first.apk', artifact_cache)
+    server.state.reset_stats()
+    download(task_id, tmp_path / 'second.apk', artifact_cache)
+    download(task_id, tmp_path / 'third.apk', artifact_cache)
+    # Hits only read the first byte to check the output was not replaced
+    assert server.state.stats.bytes_sent == 2
+
+    key = artifact_cache.key(TEAM_ID, task_id, 'output')
+    blob_path = artifact_cache._blob_path(artifact_cache._load()[key]['sha256'])
+    paths = [blob_path] + [tmp_path / name for name in ['first.apk', 'second.apk', 'third.apk']]
+    stats = [stat(path) for path in paths]
+    assert len({file_stat.st_ino for file_stat in stats}) == len(paths)
+    assert all(file_stat.st_nlink == 1 for file_stat in stats)
+
+    # Writing into one output changes neither the cache nor the other outputs
+    content = read(blob_path)
+    with open(tmp_path / 'second.apk', 'r+b') as f:
+        f.write(b'changed')
+    assert read(blob_path) == content
+    assert read(tmp_path / 'third.apk') == content
+    download(task_id, tmp_path / 'fourth.apk', artifact_cache)
+    assert read(tmp_path / 'fourth.apk') == content
+
+
+def test_replaced_output_is_downloaded_again(server, tmp_path, artifact_cache):
+    task_id = add_completed_task(server)
+    download(task_id, tmp_path / 'first.apk', artifact_cache)
+    # Another host signed the task again, only the storage validator tells
+    replace_task_outputs(server, task_id)
+    server.state.reset_stats()
+    download(task_id, tmp_path / 'second.apk', artifact_cache)
+    assert server.state.stats.bytes_sent == 1 + OUTPUT_SIZE
+
+
+def test_changed_blob_is_downloaded_again(server, tmp_path, artifact_cache):
+    task_id = add_completed_task(server)
+    download(task_id, tmp_path / 'first.apk', artifact_cache)
+    key = artifact_cache.key(TEAM_ID, task_id, 'output')
+    with open(artifact_cache._blob_path(artifact_cache._load()[key]['sha256']), 'r+b') as f:
+        f.write(b'changed')
+    server.state.reset_stats()
+    download(task_id, tmp_path / 'second.apk', artifact_cache)
+    assert server.state.stats.bytes_sent == 1 + OUTPUT_SIZE
+    assert read(tmp_path / 'second.apk') == read(tmp_path / 'first.apk')
+
+
+def test_action_drops_task_outputs(server, tmp_path, artifact_cache):
+    task_id = add_completed_task(server)
+    download(task_id, tmp_path / 'first.apk', artifact_cache)
+    key = artifact_cache.key(TEAM_ID, task_id, 'output')
+    assert artifact_cache.contains(key)
+    run_task_action(API_KEY, TEAM_ID, 'sign', task_id, {}, None)
+    assert not artifact_cache.contains(key)
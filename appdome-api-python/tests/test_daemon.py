@@ -0,0 +1,104 @@
+import sys
+import zipfile
+from os import stat
+from threading import Thread
+from time import monotonic, sleep
+
+import pytest
+import requests
+
+import daemon
+from conftest import API_KEY, TEAM_ID
+from preflight import APK_MANIFEST, BINARY_XML_MAGIC
+
+JOB_TIMEOUT_SEC = 30
+
+
+@pytest.fixture
+def daemon_url(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(sys, 'argv', ['daemon.py', '--api_key', API_KEY, '--team_id', TEAM_ID, '--port', '0',
+                                      '--token_file', str(tmp_path / 'daemon.token')])
+    args = daemon.parse_arguments()
+    service = daemon.JobService(args)
+    httpd = daemon.create_server(args, service)
+    thread = Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+    service.close()
+
+
+@pytest.fixture
+def auth_headers(tmp_path):
+    with open(tmp_path / 'daemon.token') as f:
+        return {'Authorization': f"Bearer {f.read()}"}
+
+
+@pytest.fixture
+def job(tmp_path):
+    app_path = tmp_path / 'app.apk'
+    with zipfile.ZipFile(app_path, 'w') as app_file:
+        app_file.writestr(APK_MANIFEST, BINARY_XML_MAGIC + b'\0' * 1024)
+        app_file.writestr('classes.dex', b'dex\n' * 1024)
+    return {'name': 'job-1', 'app': str(app_path), 'fusion_set_id': 'fusion-set', 'private_signing': True,
+            'signing_fingerprint': 'AA', 'output': str(tmp_path / 'output.apk')}
+
+
+def test_token_file_is_owner_only(daemon_url, tmp_path):
+    assert (tmp_path / 'daemon.token').stat().st_mode & 0o777 == 0o600
+
+
+def test_health_needs_no_token(daemon_url):
+    response = requests.get(f"{daemon_url}/health")
+    assert response.status_code == 200
+    assert response.json()['status'] == 'ok'
+
+
+def test_unix_socket_is_owner_only(server, tmp_path, monkeypatch):
+    socket_path = str(tmp_path / 'daemon.sock')
+    monkeypatch.setattr(sys, 'argv', ['daemon.py', '--api_key', API_KEY, '--socket', socket_path])
+    args = daemon.parse_arguments()
+    service = daemon.JobService(args)
+    httpd = daemon.create_server(args, service)
+    try:
+        assert stat(socket_path).st_mode & 0o777 == 0o600
+        assert httpd.token is None
+    finally:
+        httpd.server_close()
+        service.close()
+
+
+@pytest.mark.parametrize('headers', [{}, {'Authorization': 'Bearer wrong-token'}, {'Authorization': 'Basic d3Jvbmc='}])
+def test_requests_without_token_are_rejected(daemon_url, job, headers):
+    assert requests.get(f"{daemon_url}/jobs", headers=headers).status_code == 401
+    assert requests.get(f"{daemon_url}/metrics", headers=headers).status_code == 401
+    assert requests.post(f"{daemon_url}/jobs", json=job, headers=headers).status_code == 401
+
+
+@pytest.mark.parametrize('content_type', ['text/plain', 'application/x-www-form-urlencoded', None])
+def test_job_must_be_json(daemon_url, auth_headers, job, content_type):
+    headers = dict(auth_headers, **({'Content-Type': content_type} if content_type else {}))
+    response = requests.post(f"{daemon_url}/jobs", data=str(job).encode(), headers=headers)
+    assert response.status_code == 415
+    assert requests.get(f"{daemon_url}/jobs", headers=auth_headers).json() == []
+
+
+def test_invalid_job_gets_argparse_reason(daemon_url, auth_headers, job):
+    response = requests.post(f"{daemon_url}/jobs", json=dict(job, no_such_option='value'), headers=auth_headers)
+    assert response.status_code == 400
+    assert 'unrecognized arguments: --no_such_option value' in response.json()['error']
+
+
+def test_job_runs_to_completion(daemon_url, auth_headers, job):
+    response = requests.post(f"{daemon_url}/jobs", json=job, headers=auth_headers)
+    assert response.status_code == 202
+    assert requests.post(f"{daemon_url}/jobs", json=job, headers=auth_headers).status_code == 409
+    deadline = monotonic() + JOB_TIMEOUT_SEC
+    while monotonic() < deadline:
+        job_status = requests.get(f"{daemon_url}/jobs/{job['name']}", headers=auth_headers).json()
+        if job_status['status'] in ['completed', 'failed']:
+            break
+        sleep(0.1)
+    assert job_status['status'] == 'completed', job_status['error']
+    assert job_status['outputs'] == {'output': job['output']}
@@ -0,0 +1,68 @@
+import json
+from os import remove
+from os.path import exists
+
+import pytest
+
+from artifact_cache import download_output
+from conftest import API_KEY, TEAM_ID, add_completed_task, replace_task_outputs
+from mock_server import payload_chunks
+from ranged_download import CHECKPOINT_SUFFIX, PARTIAL_SUFFIX, RangedDownload
+from utils import AppdomeError
+
+OUTPUT_SIZE = 1024 * 1024
+PART_SIZE_MB = 0.125
+NUM_OF_PARTS = 8
+
+
+def ranged_download():
+    return RangedDownload(connections=2, part_size_mb=PART_SIZE_MB, min_size_mb=0)
+
+
+def interrupted_download(server, task_id, output_path):
+    # Drops are random, so the download is run until it stops with some of its parts written
+    server.state.download_drop_rate = 0.5
+    for _ in range(20):
+        try:
+            download_output(API_KEY, TEAM_ID, task_id, 'output', output_path, ranged_download=ranged_download())
+        except AppdomeError:
+            with open(output_path + CHECKPOINT_SUFFIX) as f:
+                completed_parts = json.load(f)['completed_parts']
+            if completed_parts:
+                server.state.download_drop_rate = 0
+                server.state.reset_stats()
+                return set(completed_parts)
+        else:
+            remove(output_path)
+    pytest.fail('No download stopped with completed parts')
+
+
+def assert_downloaded(output_path):
+    with open(output_path, 'rb') as f:
+        assert f.read() == b''.join(payload_chunks(0, OUTPUT_SIZE))
+    assert not exists(output_path + CHECKPOINT_SUFFIX)
+    assert not exists(output_path + PARTIAL_SUFFIX)
+
+
+def test_resume_downloads_missing_parts_only(server, tmp_path):
+    task_id = add_completed_task(server)
+    output_path = str(tmp_path / 'output.apk')
+    completed_parts = interrupted_download(server, task_id, output_path)
+    assert not exists(output_path)
+
+    download_output(API_KEY, TEAM_ID, task_id, 'output', output_path, ranged_download=ranged_download())
+    assert_downloaded(output_path)
+    # The first request finds the file and is read as part 0 when that part is missing
+    range_requests = len(set(range(1, NUM_OF_PARTS)) - completed_parts)
+    assert server.state.stats.routes['storage_get'] == 1 + range_requests
+
+
+def test_changed_output_is_downloaded_again(server, tmp_path):
+    task_id = add_completed_task(server)
+    output_path = str(tmp_path / 'output.apk')
+    interrupted_download(server, task_id, output_path)
+    replace_task_outputs(server, task_id)
+
+    download_output(API_KEY, TEAM_ID, task_id, 'output', output_path, ranged_download=ranged_download())
+    assert_downloaded(output_path)
+    assert server.state.stats.routes['storage_get'] == NUM_OF_PARTS
@@ -0,0 +1,135 @@
+import socket
+from http.client import RemoteDisconnected
+from threading import Thread
+
+import pytest
+import requests
+from requests.exceptions import ConnectionError, ConnectTimeout, ReadTimeout
+from urllib3.exceptions import ProtocolError
+
+import utils
+from conftest import API_KEY, TEAM_ID, add_completed_task
+from utils import TASKS_URL, AppdomeClient, build_url, classify_failure, closed_before_response, run_task_action
+
+
+def status_response(status_code):
+    response = requests.Response()
+    response.status_code = status_code
+    return response
+
+
+@pytest.fixture
+def no_retry_delay(monkeypatch):
+    monkeypatch.setattr(utils, 'retry_delay_sec', lambda attempt, response=None: 0)
+
+
+@pytest.mark.parametrize('status_code, failure', [
+    (200, None), (400, None), (404, None),
+    (408, 'not_processed'), (429, 'not_processed'), (503, 'not_processed'),
+    (500, 'unknown_outcome'), (502, 'unknown_outcome'), (504, 'unknown_outcome'),
+])
+def test_classify_status_code(status_code, failure):
+    assert classify_failure(status_response(status_code)) == failure
+
+
+@pytest.mark.parametrize('error, failure', [
+    (ConnectTimeout('connect timed out'), 'not_sent'),
+    (ReadTimeout('read timed out'), 'unknown_outcome'),
+    (ConnectionError(ProtocolError('Connection aborted.', ConnectionResetError())), 'unknown_outcome'),
+    (ValueError('not a connection error'), None),
+])
+def test_classify_error(error, failure):
+    assert classify_failure(error=error) == failure
+
+
+def test_refused_connection_was_not_sent():
+    # Nothing listens on a port right after it was closed
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    with pytest.raises(ConnectionError) as e:
+        requests.get(f"http://127.0.0.1:{port}/")
+    assert classify_failure(error=e.value) == 'not_sent'
+
+
+@pytest.mark.parametrize('error, closed', [
+    (ConnectionError(ProtocolError('Connection aborted.', RemoteDisconnected('closed'))), True),
+    (ConnectionError(ProtocolError('Connection aborted.', ConnectionResetError())), True),
+    (ConnectionError(ProtocolError('Connection aborted.', BrokenPipeError())), True),
+    (ConnectionError(ProtocolError('Connection broken: IncompleteRead')), False),
+    (ReadTimeout('read timed out'), False),
+])
+def test_closed_before_response(error, closed):
+    assert closed_before_response(error) == closed
+
+
+def test_not_processed_request_is_retried(server, no_retry_delay):
+    server.state.error_rate = 1
+    response = AppdomeClient(num_of_retries=2).post(TASKS_URL, API_KEY, TEAM_ID, data={'action': 'fuse'}, retry=True)
+    assert response.status_code == 503
+    assert server.state.stats.routes['create_task'] == 3
+
+
+def test_unknown_outcome_post_is_not_retried(server, no_retry_delay):
+    server.state.lost_response_rate = 1
+    task_id = add_completed_task(server)
+    response = AppdomeClient(num_of_retries=2).post(TASKS_URL, API_KEY, TEAM_ID, data={'action': 'sign', 'parent_task_id': task_id},
+                                                    retry=True)
+    assert response.status_code == 502
+    assert server.state.stats.routes['create_task'] == 1
+
+
+def test_unknown_outcome_get_is_retried(server, no_retry_delay):
+    task_id = add_completed_task(server)
+    server.state.error_rate = 1
+    client = AppdomeClient(num_of_retries=2)
+    assert client.get(build_url(TASKS_URL, task_id, 'status'), API_KEY, TEAM_ID, retry=True).status_code == 503
+    server.state.error_rate = 0
+    assert client.get(build_url(TASKS_URL, task_id, 'status'), API_KEY, TEAM_ID, retry=True).json()['status'] == 'completed'
+    assert server.state.stats.routes['task_status'] == 4
+
+
+def test_lost_action_response_continues_with_started_task(server, no_retry_delay):
+    task_id = add_completed_task(server)
+    server.state.task_duration_sec = 60
+    server.state.lost_response_rate = 1
+    response = run_task_action(API_KEY, TEAM_ID, 'sign', task_id, {}, None)
+    assert response.json() == {'task_id': task_id, 'status': 'progress'}
+    assert server.state.stats.routes['create_task'] == 1
+
+
+def test_lost_action_response_without_started_task_fails(server, no_retry_delay):
+    # The action of an unknown task is rejected, then the answer is lost
+    server.state.lost_response_rate = 1
+    with pytest.raises(utils.AppdomeError):
+        run_task_action(API_KEY, TEAM_ID, 'sign', 'unknown-task', {}, None)
+    assert server.state.stats.routes['create_task'] == 1
+
+
+def test_request_on_connection_closed_while_idle_is_sent_again():
+    # The server answers the first request and closes the kept-alive connection when the second one arrives
+    with socket.socket() as listener:
+        listener.bind(('127.0.0.1', 0))
+        listener.listen()
+        received = []
+
+        def serve():
+            connection, _ = listener.accept()
+            received.append(connection.recv(65536))
+            connection.sendall(b'HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nfirst')
+            received.append(connection.recv(65536))
+            connection.close()
+            connection, _ = listener.accept()
+            received.append(connection.recv(65536))
+            connection.sendall(b'HTTP/1.1 200 OK\r\nContent-Length: 6\r\n\r\nsecond')
+            connection.close()
+
+        thread = Thread(target=serve, daemon=True)
+        thread.start()
+        client = AppdomeClient(num_of_retries=0)
+        url = f"http://127.0.0.1:{listener.getsockname()[1]}/"
+        assert client.request('POST', url, data={'action': 'fuse'}).text == 'first'
+        assert client.request('POST', url, data={'action': 'fuse'}).text == 'second'
+        thread.join(5)
+        client.close()
+    assert len(received) == 3
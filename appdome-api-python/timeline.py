@@ -0,0 +1,100 @@
+import json
+import os
+import re
+from contextlib import contextmanager
+from threading import Lock, current_thread
+from time import monotonic, sleep
+
+MAIN_TRACK_GROUP = 'appdome'
+
+
+def track_group(thread_name):
+    # Threads started by a job are named with the job thread name and a _<n> suffix
+    return re.sub(r'(_\d+)+$', '', thread_name)
+
+
+class Timeline:
+    def __init__(self):
+        self.enabled = False
+        self._lock = Lock()
+        self._events = []
+        self._groups = {}
+        self._tracks = {}
+        self._start = monotonic()
+
+    def enable(self):
+        with self._lock:
+            self.enabled = True
+            self._start = monotonic()
+
+    def _timestamp(self, time_sec):
+        return round((time_sec - self._start) * 1e6, 1)
+
+    def _track(self):
+        # Every job is shown as a process and every thread working for it as one of its tracks
+        thread_name = current_thread().name
+        group = track_group(thread_name)
+        if group not in self._groups:
+            self._groups[group] = len(self._groups) + 1
+            self._events.append({'ph': 'M', 'name': 'process_name', 'pid': self._groups[group], 'tid': 0, 'args': {'name': group}})
+        pid = self._groups[group]
+        if (pid, thread_name) not in self._tracks:
+            self._tracks[(pid, thread_name)] = len(self._tracks) + 1
+            self._events.append({'ph': 'M', 'name': 'thread_name', 'pid': pid, 'tid': self._tracks[(pid, thread_name)],
+                                 'args': {'name': thread_name}})
+        return pid, self._tracks[(pid, thread_name)]
+
+    @contextmanager
+    def span(self, name, category, **args):
+        if not self.enabled:
+            yield args
+            return
+        start_time = monotonic()
+        try:
+            yield args
+        except BaseException as e:
+            args['error'] = type(e).__name__
+            raise
+        finally:
+            end_time = monotonic()
+            with self._lock:
+                pid, tid = self._track()
+                self._events.append({'ph': 'X', 'name': name, 'cat': category, 'pid': pid, 'tid': tid,
+                                     'ts': self._timestamp(start_time), 'dur': round((end_time - start_time) * 1e6, 1),
+                                     'args': args})
+
+    def sleep(self, seconds, name='sleep', **args):
+        with self.span(name, 'sleep', seconds=round(seconds, 3), **args):
+            sleep(seconds)
+
+    def write(self, path):
+        with self._lock:
+            trace = {'traceEvents': list(self._events), 'displayTimeUnit': 'ms',
+                     'otherData': {'pid': os.getpid(), 'events': len(self._events)}}
+        temp_path = path + '-tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(trace, f)
+        os.replace(temp_path, path)
+
+
+_timeline = Timeline()
+
+
+def get_timeline():
+    return _timeline
+
+
+def add_timeline_args(parser):
+    parser.add_argument('--trace', metavar='trace_json_file',
+                        help='Output file for a timeline of every stage, HTTP request, status wait and file write, '
+                             'viewable in chrome://tracing or https://ui.perfetto.dev')
+
+
+def init_timeline(args):
+    if getattr(args, 'trace', None):
+        _timeline.enable()
+
+
+def export_timeline(args):
+    if getattr(args, 'trace', None):
+        _timeline.write(args.trace)
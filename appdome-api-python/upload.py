@@ -1,49 +1,58 @@
 import argparse
 import logging
-from os.path import basename
+from os.path import basename, getsize
 
-import requests
-
-from utils import (SERVER_API_V1_URL, request_headers, empty_files, validate_response, debug_log_request,
-                   add_common_args, log_and_exit, init_common_args, build_url, team_params)
+from metrics import get_metrics
+from multipart_upload import multipart_upload, DEFAULT_PART_SIZE_MB, DEFAULT_UPLOAD_WORKERS
+from utils import (SERVER_API_V1_URL, empty_files, validate_response, debug_log_request, get_client, UploadFileReader,
+                   UPLOAD_CHUNK_SIZE, format_throughput, add_common_args, AppdomeError, init_common_args, build_url, exit_on_error)
 
 
 def get_upload_link(api_key, team_id):
     url = build_url(SERVER_API_V1_URL, 'upload-link')
-    params = team_params(team_id)
-    headers = request_headers(api_key)
-    debug_log_request(url, headers, params=params, request_type='get')
-    return requests.get(url, headers=headers, params=params)
+    return get_client().get(url, api_key, team_id, retry=True)
 
 
-def put_file_in_aws(file_path, aws_url):
+def put_file_in_aws(file_path, aws_url, chunk_size=UPLOAD_CHUNK_SIZE):
+    file_size = getsize(file_path)
     with open(file_path, 'rb') as f:
+        reader = UploadFileReader(f, file_size, chunk_size)
         debug_log_request(aws_url, request_type='put')
-        return requests.put(aws_url, data=f.read())
+        response = get_client().request('PUT', aws_url, data=reader, headers={'Content-Length': str(file_size)})
+    elapsed = reader.elapsed()
+    get_metrics().record_transfer('upload', reader.bytes_sent, elapsed)
+    logging.info(f"Sent {reader.bytes_sent} bytes in {elapsed:.2f} seconds ({format_throughput(reader.bytes_sent, elapsed)})")
+    return response
 
 
 def upload_using_link(api_key, team_id, file_id, file_name):
     url = build_url(SERVER_API_V1_URL, 'upload-using-link')
-    params = team_params(team_id)
-    headers = request_headers(api_key)
     body = {'file_app_id': file_id, 'file_name': file_name}
-    debug_log_request(url, params=params, data=body)
-    return requests.post(url, headers=headers, params=params, data=body, files=empty_files())
+    # Sending it twice at most registers the uploaded file twice, the second app id is the one used
+    return get_client().post(url, api_key, team_id, data=body, files=empty_files(), retry=True, idempotent=True)
 
 
-def upload(api_key, team_id, file_path):
-    logging.info(f"Preparing to upload [{file_path}]")
+def upload_single_put(api_key, team_id, file_path):
     upload_link_response = get_upload_link(api_key, team_id)
     validate_response(upload_link_response)
     upload_link_json = upload_link_response.json()
     aws_url = upload_link_json.get('url')
     file_id = upload_link_json.get('file_id')
     if not aws_url or not file_id:
-        log_and_exit('Error in upload link response: ' + upload_link_response.text)
+        raise AppdomeError('Error in upload link response: ' + upload_link_response.text)
 
     logging.info(f"Uploading file id {file_id} to url: {aws_url}")
     aws_put_response = put_file_in_aws(file_path, aws_url)
     validate_response(aws_put_response)
+    return file_id
+
+
+def upload(api_key, team_id, file_path, multipart=False, part_size_mb=DEFAULT_PART_SIZE_MB, upload_workers=DEFAULT_UPLOAD_WORKERS,
+           job=None):
+    logging.info(f"Preparing to upload [{file_path}]")
+    file_id = multipart_upload(api_key, team_id, file_path, part_size_mb, upload_workers, job=job) if multipart else None
+    if not file_id:
+        file_id = upload_single_put(api_key, team_id, file_path)
     app = upload_using_link(api_key, team_id, file_id, basename(file_path))
     validate_response(app)
     return app
@@ -53,13 +62,24 @@ def parse_arguments():
     parser = argparse.ArgumentParser(description='Upload app to Appdome')
     add_common_args(parser)
     parser.add_argument('-a', '--app', required=True, metavar='application_file', help='Upload app file input path')
+    add_multipart_upload_args(parser)
     return parser.parse_args()
 
 
+def add_multipart_upload_args(parser):
+    parser.add_argument('-mu', '--multipart_upload', action='store_true',
+                        help='Upload the app in parallel parts. An interrupted upload resumes on the next run')
+    parser.add_argument('--upload_part_size', type=int, default=DEFAULT_PART_SIZE_MB, metavar='part_size_mb',
+                        help=f'Part size in MB for multipart upload. Default is {DEFAULT_PART_SIZE_MB}')
+    parser.add_argument('--upload_workers', type=int, default=DEFAULT_UPLOAD_WORKERS, metavar='workers',
+                        help=f'Number of parts to upload concurrently in multipart upload. Default is {DEFAULT_UPLOAD_WORKERS}')
+
+
+@exit_on_error
 def main():
     args = parse_arguments()
     init_common_args(args)
-    r = upload(args.api_key, args.team_id, args.app)
+    r = upload(args.api_key, args.team_id, args.app, args.multipart_upload, args.upload_part_size, args.upload_workers)
     validate_response(r)
     logging.info(f"Upload success: App id: {r.json()['id']}")
 
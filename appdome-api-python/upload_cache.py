@@ -0,0 +1,139 @@
+import hashlib
+import json
+import logging
+from collections import OrderedDict
+from contextlib import contextmanager
+from os import getenv, makedirs, replace, stat
+from os.path import join, expanduser, exists, getsize, abspath
+from threading import Lock
+from time import time
+
+from timeline import get_timeline
+from utils import SERVER_BASE_URL
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+UPLOAD_CACHE_DIR_ENV = 'APPDOME_UPLOAD_CACHE_DIR'
+DEFAULT_UPLOAD_CACHE_DIR = getenv(UPLOAD_CACHE_DIR_ENV, join(expanduser('~'), '.cache', 'appdome'))
+DEFAULT_UPLOAD_CACHE_TTL_HOURS = 24
+DEFAULT_UPLOAD_CACHE_MAX_ENTRIES = 200
+HASH_CHUNK_SIZE = 1024 * 1024
+MAX_FILE_HASHES = 64
+
+_file_hashes = OrderedDict()
+_file_hashes_lock = Lock()
+
+
+def file_sha256(file_path, chunk_size=HASH_CHUNK_SIZE):
+    # The flow state, the upload cache and the multipart upload checkpoint all key on the app hash, so the app is read once
+    file_stat = stat(file_path)
+    key = (abspath(file_path), file_stat.st_size, file_stat.st_mtime_ns)
+    with _file_hashes_lock:
+        if key in _file_hashes:
+            _file_hashes.move_to_end(key)
+            return _file_hashes[key]
+    with get_timeline().span('hash_file', 'file', path=file_path):
+        file_hash = _file_sha256(file_path, chunk_size)
+    with _file_hashes_lock:
+        _file_hashes[key] = file_hash
+        while len(_file_hashes) > MAX_FILE_HASHES:
+            _file_hashes.popitem(last=False)
+    return file_hash
+
+
+def _file_sha256(file_path, chunk_size):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class UploadCache:
+    def __init__(self, cache_dir=DEFAULT_UPLOAD_CACHE_DIR, ttl_hours=DEFAULT_UPLOAD_CACHE_TTL_HOURS,
+                 max_entries=DEFAULT_UPLOAD_CACHE_MAX_ENTRIES):
+        self.cache_dir = cache_dir
+        self.ttl_sec = ttl_hours * 3600
+        self.max_entries = max_entries
+        self.index_path = join(cache_dir, 'upload_cache.json')
+        self._lock = Lock()
+
+    def key(self, file_path, team_id):
+        file_hash = file_sha256(file_path)
+        return hashlib.sha256(f"{SERVER_BASE_URL}|{team_id or ''}|{file_hash}".encode()).hexdigest()
+
+    def get(self, key):
+        with self._locked_index() as index:
+            entry = index.get(key)
+            if not entry:
+                return None
+            if time() - entry['created'] > self.ttl_sec:
+                del index[key]
+                return None
+            entry['last_used'] = time()
+            return entry['app_id']
+
+    def put(self, key, app_id, file_path):
+        with self._locked_index() as index:
+            now = time()
+            index[key] = {'app_id': app_id, 'file_name': file_path, 'file_size': getsize(file_path),
+                          'created': now, 'last_used': now}
+            self._evict(index, now)
+
+    def invalidate(self, key):
+        with self._locked_index() as index:
+            index.pop(key, None)
+
+    def _evict(self, index, now):
+        for key in [key for key, entry in index.items() if now - entry['created'] > self.ttl_sec]:
+            del index[key]
+        if len(index) > self.max_entries:
+            by_last_used = sorted(index, key=lambda key: index[key]['last_used'])
+            for key in by_last_used[:len(index) - self.max_entries]:
+                del index[key]
+
+    @contextmanager
+    def _locked_index(self):
+        makedirs(self.cache_dir, exist_ok=True)
+        with self._lock, open(join(self.cache_dir, 'upload_cache.lock'), 'w') as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            index = self._load()
+            yield index
+            self._save(index)
+
+    def _load(self):
+        if not exists(self.index_path):
+            return {}
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable upload cache index [{self.index_path}]: {e}")
+            return {}
+
+    def _save(self, index):
+        temp_path = self.index_path + '-tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(index, f)
+        replace(temp_path, self.index_path)
+
+
+def add_upload_cache_args(parser):
+    parser.add_argument('-uc', '--upload_cache', action='store_true',
+                        help='Reuse the app id of a previous upload of the same file instead of uploading it again')
+    parser.add_argument('--upload_cache_dir', default=DEFAULT_UPLOAD_CACHE_DIR, metavar=UPLOAD_CACHE_DIR_ENV,
+                        help=f"Upload cache directory. Default is environment variable '{UPLOAD_CACHE_DIR_ENV}' or ~/.cache/appdome")
+    parser.add_argument('--upload_cache_ttl', type=float, default=DEFAULT_UPLOAD_CACHE_TTL_HOURS, metavar='hours',
+                        help=f'Hours a cached app id is reused. Default is {DEFAULT_UPLOAD_CACHE_TTL_HOURS}')
+    parser.add_argument('--upload_cache_max_entries', type=int, default=DEFAULT_UPLOAD_CACHE_MAX_ENTRIES, metavar='entries',
+                        help=f'Max number of cached app ids. Least recently used entries are evicted. Default is {DEFAULT_UPLOAD_CACHE_MAX_ENTRIES}')
+
+
+def init_upload_cache(args):
+    if not args.upload_cache:
+        return None
+    return UploadCache(args.upload_cache_dir, args.upload_cache_ttl, args.upload_cache_max_entries)
@@ -1,12 +1,19 @@
-
 import json
 import logging
+import random
 from contextlib import contextmanager
-from os import getenv, makedirs
-from os.path import isdir, dirname, exists
-from urllib.parse import urljoin
-
-import requests
+from functools import wraps
+from threading import Lock
+from time import monotonic, time
+from os import getenv, makedirs, fdopen, fsync, fstat, replace, remove, chmod, close, O_CREAT, O_EXCL, O_WRONLY
+from os import open as os_open
+from os.path import isdir, dirname, exists, abspath, basename
+from tempfile import mkstemp
+from urllib.parse import urljoin, urlparse
+
+from metrics import get_metrics, request_operation
+from rate_limit import get_rate_limiter, init_rate_limiter, SHARED_RATE_LIMIT_SUPPORTED
+from timeline import get_timeline
 
 SERVER_BASE_URL = getenv('APPDOME_SERVER_BASE_URL', 'https://fusion.appdome.com/')
 SERVER_API_V1_URL = urljoin(SERVER_BASE_URL, 'api/v1')
@@ -17,6 +24,26 @@ ACTION_KEY = 'action'
 ANDROID_SIGNING_FINGERPRINT_KEY = 'signing_sha1_fingerprint'
 JSON_CONTENT_TYPE = 'application/json'
 APPDOME_CLIENT_HEADER = getenv('APPDOME_CLIENT_HEADER', 'Appdome-cli-python/1.0')
+HTTP_POOL_SIZE_ENV = 'APPDOME_HTTP_POOL_SIZE'
+DEFAULT_HTTP_POOL_SIZE = int(getenv(HTTP_POOL_SIZE_ENV, '10'))
+HTTP_RETRIES_ENV = 'APPDOME_HTTP_RETRIES'
+DEFAULT_HTTP_RETRIES = int(getenv(HTTP_RETRIES_ENV, '3'))
+RATE_LIMIT_ENV = 'APPDOME_RATE_LIMIT'
+RATE_LIMIT_FILE_ENV = 'APPDOME_RATE_LIMIT_FILE'
+RETRY_INITIAL_DELAY_SEC = 1
+RETRY_MAX_DELAY_SEC = 60
+# The server answered without handling the request, so any request can be sent again
+NOT_PROCESSED_STATUS_CODES = [408, 429, 503]
+# The server or a gateway failed after the request arrived, it may or may not have been handled
+UNKNOWN_OUTCOME_STATUS_CODES = [500, 502, 504]
+IDEMPOTENT_METHODS = ['GET', 'HEAD', 'PUT', 'DELETE']
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_CHUNK_SIZE_ENV = 'APPDOME_DOWNLOAD_CHUNK_SIZE'
+DEFAULT_DOWNLOAD_CHUNK_SIZE = int(getenv(DOWNLOAD_CHUNK_SIZE_ENV, str(1024 * 1024)))
+
+
+class AppdomeError(Exception):
+    pass
 
 
 def build_url(*args):
@@ -47,6 +74,232 @@ def request_headers(api_key, content_type=None):
     return headers
 
 
+def retry_after_sec(response):
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    # Servers rarely send an HTTP date, so its parser is only loaded when one arrives
+    from email.utils import parsedate_to_datetime
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def classify_failure(response=None, error=None):
+    # Returns None for answers and errors that are not worth retrying
+    if error is not None:
+        from requests.exceptions import ConnectionError, ConnectTimeout, Timeout, ChunkedEncodingError
+        from urllib3.exceptions import ConnectTimeoutError
+        if not isinstance(error, (ConnectionError, Timeout, ChunkedEncodingError)):
+            return None
+        reason = getattr(error.args[0], 'reason', None) if error.args else None
+        # Refused connections and failed DNS lookups are connect errors too, the request never left
+        if isinstance(error, ConnectTimeout) or isinstance(reason, ConnectTimeoutError):
+            return 'not_sent'
+        return 'unknown_outcome'
+    if response.status_code in NOT_PROCESSED_STATUS_CODES:
+        return 'not_processed'
+    if response.status_code in UNKNOWN_OUTCOME_STATUS_CODES:
+        return 'unknown_outcome'
+    return None
+
+
+def closed_before_response(error):
+    # A pooled keep-alive connection that the server closed while it was idle fails when the next request is sent on it,
+    # before any answer. The server never handled that request
+    from http.client import RemoteDisconnected
+    from requests.exceptions import ConnectionError
+    from urllib3.exceptions import ProtocolError
+    cause = error.args[0] if isinstance(error, ConnectionError) and error.args else None
+    if not isinstance(cause, ProtocolError) or len(cause.args) < 2:
+        return False
+    return isinstance(cause.args[1], (RemoteDisconnected, ConnectionResetError, BrokenPipeError))
+
+
+def retry_delay_sec(attempt, response=None):
+    delay = min(RETRY_INITIAL_DELAY_SEC * 2 ** attempt, RETRY_MAX_DELAY_SEC) * random.uniform(0.8, 1.2)
+    server_delay = retry_after_sec(response) if response is not None else None
+    return min(max(delay, server_delay or 0), RETRY_MAX_DELAY_SEC)
+
+
+def _rewind_files(files):
+    for value in (files.values() if isinstance(files, dict) else files or []):
+        file_value = value[1] if isinstance(value, tuple) else value
+        if hasattr(file_value, 'seek'):
+            file_value.seek(0)
+
+
+class AppdomeClient:
+    def __init__(self, pool_size=DEFAULT_HTTP_POOL_SIZE, num_of_retries=DEFAULT_HTTP_RETRIES):
+        self.pool_size = pool_size
+        self.num_of_retries = num_of_retries
+        self._session = None
+        self._session_lock = Lock()
+
+    @property
+    def session(self):
+        # requests is imported with the first request, so help and argument errors don't pay for loading it
+        with self._session_lock:
+            if not self._session:
+                import requests
+                from requests.adapters import HTTPAdapter
+
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self._session = session
+            return self._session
+
+    def request(self, method, url, retry=False, idempotent=None, **kwargs):
+        # Requests that are not idempotent are only sent again when the server surely did not handle them
+        operation = request_operation(method, url, kwargs.get('data'))
+        idempotent = method in IDEMPOTENT_METHODS if idempotent is None else idempotent
+        attempts = self.num_of_retries + 1 if retry else 1
+        # API requests carry the api key, presigned storage URLs don't count against the API quota
+        api_key = (kwargs.get('headers') or {}).get('Authorization')
+        for attempt in range(attempts):
+            if attempt:
+                _rewind_files(kwargs.get('files'))
+            if api_key:
+                get_rate_limiter().acquire(api_key, (kwargs.get('params') or {}).get('team_id'), operation)
+            response = error = None
+            try:
+                response = self._send_on_live_connection(operation, method, url, **kwargs)
+            except Exception as e:
+                error = e
+            failure = classify_failure(response, error)
+            if not failure or attempt == attempts - 1:
+                break
+            failure_text = f"status code {response.status_code}" if response is not None else f"{type(error).__name__}: {error}"
+            if failure == 'unknown_outcome' and not idempotent:
+                logging.warning(f"Request {operation} failed ({failure_text}) after the server may have handled it. "
+                                f"Not sending it again to avoid starting a duplicate task")
+                break
+            delay_sec = retry_delay_sec(attempt, response)
+            logging.info(f"Request {operation} failed ({failure_text}). Retrying in {delay_sec:.1f} seconds "
+                         f"(attempt {attempt + 1}/{attempts})")
+            if response is not None:
+                response.close()
+            get_metrics().record_retry(operation)
+            get_timeline().sleep(delay_sec, 'http_retry_sleep', operation=operation)
+        if error is not None:
+            raise error
+        return response
+
+    def _send_on_live_connection(self, operation, method, url, **kwargs):
+        # A request that hit a connection closed while idle is sent once more on a new connection, whatever its method.
+        # Streamed bodies were partly read and can't be sent again
+        try:
+            return self._send(operation, method, url, **kwargs)
+        except Exception as e:
+            if not closed_before_response(e) or hasattr(kwargs.get('data'), 'read'):
+                raise
+            logging.debug(f"Request {operation} was sent on a connection the server had closed. Sending it again on a new connection")
+        # The other idle connections of the pool are as old as that one
+        self.session.get_adapter(url).poolmanager.clear()
+        _rewind_files(kwargs.get('files'))
+        get_metrics().record_retry(operation)
+        return self._send(operation, method, url, **kwargs)
+
+    def _send(self, operation, method, url, **kwargs):
+        start_time = monotonic()
+        with get_timeline().span(operation, 'http', method=method, url=urlparse(url).path) as trace_args:
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except Exception:
+                get_metrics().record_request(operation, None, monotonic() - start_time)
+                raise
+            # Streamed bodies are counted from the headers, they are read later by the caller
+            bytes_received = int(response.headers.get('Content-Length') or 0) if kwargs.get('stream') else len(response.content)
+            bytes_sent = int(response.request.headers.get('Content-Length') or 0)
+            get_metrics().record_request(operation, response.status_code, monotonic() - start_time, bytes_sent, bytes_received)
+            trace_args.update(status_code=response.status_code, bytes_sent=bytes_sent, bytes_received=bytes_received)
+        return response
+
+    def api_request(self, method, url, api_key, team_id=None, content_type=None, params=None, log_request=True, extra_headers=None,
+                    **kwargs):
+        request_params = team_params(team_id)
+        if params:
+            request_params.update(params)
+        headers = request_headers(api_key, content_type)
+        if extra_headers:
+            headers.update(extra_headers)
+        if log_request:
+            debug_log_request(url, headers=headers, params=request_params, data=kwargs.get('data'),
+                              files=kwargs.get('files'), request_type=method.lower())
+        return self.request(method, url, headers=headers, params=request_params, **kwargs)
+
+    def get(self, url, api_key, team_id=None, **kwargs):
+        return self.api_request('GET', url, api_key, team_id, **kwargs)
+
+    def post(self, url, api_key, team_id=None, **kwargs):
+        return self.api_request('POST', url, api_key, team_id, **kwargs)
+
+    def close(self):
+        if self._session:
+            self._session.close()
+
+
+_client = None
+_client_lock = Lock()
+
+
+def init_client(pool_size=DEFAULT_HTTP_POOL_SIZE, num_of_retries=DEFAULT_HTTP_RETRIES):
+    # The first call sets up the process-wide client. Later calls keep it, other jobs may have requests in flight on its session
+    global _client
+    with _client_lock:
+        if not _client:
+            _client = AppdomeClient(pool_size, num_of_retries)
+        elif (_client.pool_size, _client.num_of_retries) != (pool_size, num_of_retries):
+            logging.debug(f"Keeping the HTTP client with pool size {_client.pool_size} and {_client.num_of_retries} retries")
+        return _client
+
+
+def get_client():
+    with _client_lock:
+        if _client:
+            return _client
+    return init_client()
+
+
+class UploadFileReader:
+    def __init__(self, f, size, chunk_size=UPLOAD_CHUNK_SIZE, log_progress=True):
+        self.f = f
+        self.size = size
+        self.chunk_size = chunk_size
+        self.log_progress = log_progress
+        self.bytes_sent = 0
+        self.start_time = monotonic()
+        self._next_progress_log = size // 10
+
+    def __len__(self):
+        return self.size
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.chunk_size:
+            size = self.chunk_size
+        data = self.f.read(min(size, self.size - self.bytes_sent))
+        self.bytes_sent += len(data)
+        if self.log_progress and self.bytes_sent >= self._next_progress_log and self.size:
+            logging.debug(f"Uploaded {self.bytes_sent}/{self.size} bytes ({self.bytes_sent * 100 // self.size}%)"
+                          f" at {format_throughput(self.bytes_sent, self.elapsed())}")
+            self._next_progress_log += max(self.size // 10, 1)
+        return data
+
+    def elapsed(self):
+        return monotonic() - self.start_time
+
+
+def format_throughput(num_bytes, seconds):
+    return f"{num_bytes / max(seconds, 1e-6) / (1024 * 1024):.2f} MB/s"
+
+
 def empty_files():
     return {"None": ""}
 
@@ -67,22 +320,6 @@ def add_google_play_signing_fingerprint(google_play_signing_fingerprint, overrid
         overrides['signing_keystore_google_signing_sha1_key'] = google_play_signing_fingerprint
 
 
-def add_provisioning_profiles_entitlements(provisioning_profiles_paths, entitlements_paths, files_list, overrides, open_fd):
-    for prov_profile_path in provisioning_profiles_paths:
-        f = open(prov_profile_path, 'rb')
-        open_fd.append(f)
-        files_list.append(('provisioning_profile', (prov_profile_path, f)))
-    if entitlements_paths:
-        if overrides:
-            overrides['manual_entitlements_matching'] = True
-        for entitlements_path in entitlements_paths:
-            f = open(entitlements_path, 'rb')
-            open_fd.append(f)
-            files_list.append(('entitlements_files', (entitlements_path, f)))
-    else:
-        overrides['manual_entitlements_matching'] = False
-
-
 def init_overrides(overrides_file):
     overrides = {}
     if overrides_file:
@@ -91,25 +328,106 @@ def init_overrides(overrides_file):
     return overrides
 
 
+def task_action_status(api_key, team_id, task_id, action):
+    # Post build actions run on the completed build task and put it back in progress. A completed task can't tell an action
+    # that never started from one that already finished, so only a task in progress shows the action was started
+    response = get_client().get(build_url(TASKS_URL, task_id, 'status'), api_key, team_id, content_type=JSON_CONTENT_TYPE, retry=True)
+    status_value = response.json().get('status') if response.status_code == 200 else None
+    logging.info(f"Task {task_id} is {status_value or f'unknown (status code {response.status_code})'} "
+                 f"after an unanswered {action} request")
+    return response if status_value == 'progress' else None
+
+
 def run_task_action(api_key, team_id, action, task_id, overrides, files):
     if not files:
         files = empty_files()
-    headers = request_headers(api_key)
-    url = TASKS_URL
-    params = team_params(team_id)
     body = {ACTION_KEY: action, 'parent_task_id': task_id, OVERRIDES_KEY: json.dumps(overrides)}
-    debug_log_request(url, headers=headers, params=params, data=body, files=files)
-    return requests.post(url, headers=headers, params=params, data=body, files=files)
+    # Imported here since the artifact cache downloads through this module
+    from artifact_cache import invalidate_task_artifacts
+    invalidate_task_artifacts(team_id, task_id)
+    response = error = None
+    try:
+        response = get_client().post(TASKS_URL, api_key, team_id, data=body, files=files, retry=True)
+    except Exception as e:
+        error = e
+    if classify_failure(response, error) != 'unknown_outcome':
+        if error is not None:
+            raise error
+        return response
+    # The request is not sent again, the server may have handled it
+    status_response = task_action_status(api_key, team_id, task_id, action)
+    if status_response is None:
+        raise AppdomeError(f"The {action} request for task {task_id} got no answer and the task is not in progress, "
+                           f"so it is unknown whether the server started it. Check the task status before running it again")
+    if response is not None:
+        response.close()
+    # It runs on the build task, which is what the caller waits for. The caller gets the status response of the task
+    # ({'task_id', 'status', ...}) in place of the lost action response, both carry the task id
+    logging.info(f"Continuing with the {action} action the server started on task {task_id}")
+    return status_response
+
+
+def task_output_command(api_key, team_id, task_id, command, action=None, byte_range=None):
+    url = build_url(TASKS_URL, task_id, command)
+    params = {ACTION_KEY: action} if action else None
+    headers = {'Range': f"bytes={byte_range[0]}-{byte_range[1]}"} if byte_range else None
+    return get_client().get(url, api_key, team_id, content_type=JSON_CONTENT_TYPE, params=params, extra_headers=headers,
+                            stream=True, retry=True)
 
 
-def task_output_command(api_key, team_id, task_id, command, action=None):
-    url = build_url(TASKS_URL, task_id, command)
-    params = team_params(team_id)
-    if action:
-        params[ACTION_KEY] = action
-    headers = request_headers(api_key, JSON_CONTENT_TYPE)
-    debug_log_request(url, headers=headers,  params=params, request_type='get')
-    return requests.get(url, headers=headers, params=params)
+def write_response_to_file(response, output_path, chunk_size=DEFAULT_DOWNLOAD_CHUNK_SIZE, digest=None):
+    fd, temp_path = mkstemp(dir=dirname(abspath(output_path)), prefix=f".{basename(output_path)}.", suffix='.part')
+    bytes_written = 0
+    start_time = monotonic()
+    try:
+        with get_timeline().span('write_file', 'file', path=output_path) as trace_args, fdopen(fd, 'wb') as f:
+            for chunk in response.iter_content(chunk_size):
+                f.write(chunk)
+                if digest:
+                    digest.update(chunk)
+                bytes_written += len(chunk)
+            f.flush()
+            fsync(f.fileno())
+            trace_args['bytes'] = bytes_written
+        chmod(temp_path, output_file_mode(temp_path))
+        replace(temp_path, output_path)
+    except BaseException:
+        if exists(temp_path):
+            remove(temp_path)
+        raise
+    finally:
+        response.close()
+    elapsed = monotonic() - start_time
+    get_metrics().record_transfer('download', bytes_written, elapsed)
+    logging.debug(f"Wrote {bytes_written} bytes to {output_path} in {elapsed:.2f} seconds ({format_throughput(bytes_written, elapsed)})")
+    return bytes_written
+
+
+_output_file_mode = None
+_output_file_mode_lock = Lock()
+
+
+def output_file_mode(temp_path):
+    # Temp files are created 0600, outputs get the mode a plain open() would give them. The umask is read once from a new
+    # file, setting it to read it back is process wide and races with other threads creating files
+    global _output_file_mode
+    with _output_file_mode_lock:
+        if _output_file_mode is None:
+            probe_path = temp_path + '-mode'
+            fd = os_open(probe_path, O_CREAT | O_EXCL | O_WRONLY, 0o666)
+            try:
+                _output_file_mode = fstat(fd).st_mode & 0o777
+            finally:
+                close(fd)
+                remove(probe_path)
+        return _output_file_mode
+
+
+def replace_output_file(temp_path, output_path):
+    with open(temp_path, 'rb+') as f:
+        fsync(f.fileno())
+    chmod(temp_path, output_file_mode(temp_path))
+    replace(temp_path, output_path)
 
 
 def validate_response(response):
@@ -120,8 +438,8 @@ def validate_response(response):
             headers_to_print[key] = value_to_print(value)
         body_to_print = value_to_print(response.request.body)
 
-        log_and_exit(f'Validation status for request {response.request.url} with headers {headers_to_print} and body {body_to_print} failed.'
-                     f' Status Code: {response.status_code}. Response: {response.text}')
+        raise AppdomeError(f'Validation status for request {response.request.url} with headers {headers_to_print} and body {body_to_print} failed.'
+                           f' Status Code: {response.status_code}. Response: {response.text}')
 
 
 def value_to_print(value):
@@ -134,6 +452,17 @@ def log_and_exit(log_line):
     exit(-1)
 
 
+def exit_on_error(main):
+    # Library code raises AppdomeError so it can run inside a long lived process. Scripts log it and exit as before
+    @wraps(main)
+    def wrapper(*args, **kwargs):
+        try:
+            return main(*args, **kwargs)
+        except AppdomeError as e:
+            log_and_exit(str(e))
+    return wrapper
+
+
 def init_logging(verbose=False):
     level = logging.DEBUG if verbose else logging.INFO
     logging.basicConfig(format='[%(asctime)s] [%(levelname)s] [%(filename)s:%(lineno)d - %(funcName)s] %(message)s', level=level)
@@ -153,22 +482,44 @@ def add_common_args(parser, add_task_id=False, add_team_id=True):
     if add_team_id:
         parser.add_argument('-t', '--team_id', default=getenv(TEAM_ID_ENV), metavar=TEAM_ID_ENV, help=f"Appdome team id. Default is environment variable '{TEAM_ID_ENV}'")
     parser.add_argument('-v', '--verbose', action='store_true', help='Show debug logs')
+    parser.add_argument('--http_pool_size', type=int, default=DEFAULT_HTTP_POOL_SIZE, metavar=HTTP_POOL_SIZE_ENV,
+                        help=f"Max pooled HTTP connections to reuse across requests. Default is environment variable '{HTTP_POOL_SIZE_ENV}' or 10")
+    parser.add_argument('--http_retries', type=int, default=DEFAULT_HTTP_RETRIES, metavar=HTTP_RETRIES_ENV,
+                        help=f"Times to retry API requests that failed with a connection error, timeout, 429 or 5xx. "
+                             f"Default is environment variable '{HTTP_RETRIES_ENV}' or 3")
+    parser.add_argument('--rate_limit', type=float, default=float(getenv(RATE_LIMIT_ENV, '0')), metavar=RATE_LIMIT_ENV,
+                        help=f"Max API requests per second for each api key and team, shared by all jobs. "
+                             f"Default is environment variable '{RATE_LIMIT_ENV}' or no limit")
+    parser.add_argument('--rate_limit_burst', type=int, metavar='requests',
+                        help='Requests that can be sent at once before the rate limit applies. Default is one second of requests')
+    parser.add_argument('--rate_limit_file', default=getenv(RATE_LIMIT_FILE_ENV), metavar=RATE_LIMIT_FILE_ENV,
+                        help=f"File to share the rate limit with other processes on this host. "
+                             f"Default is environment variable '{RATE_LIMIT_FILE_ENV}'")
     if add_task_id:
         parser.add_argument('--task_id', required=True, metavar='task_id_value', help='Build id on Appdome')
 
 
-def init_common_args(args):
+def validate_common_args(args):
     if not args.api_key:
-        log_and_exit(f"api_key must be specified or set though the '{API_KEY_ENV}' environment variable")
+        raise AppdomeError(f"api_key must be specified or set though the '{API_KEY_ENV}' environment variable")
+
+
+def init_common_args(args):
+    # Process-wide setup, called once by the entry point of every command
+    validate_common_args(args)
     init_logging(args.verbose)
+    init_client(args.http_pool_size, args.http_retries)
+    if args.rate_limit_file and not SHARED_RATE_LIMIT_SUPPORTED:
+        raise AppdomeError('rate_limit_file is not supported on this platform')
+    init_rate_limiter(args.rate_limit, args.rate_limit_burst, args.rate_limit_file if args.rate_limit else None)
 
 
 def validate_output_path(path):
     if not path:
         return
     if isdir(path):
-        log_and_exit(f"Output parameter [{path}] should be a path to a file, not a directory")
+        raise AppdomeError(f"Output parameter [{path}] should be a path to a file, not a directory")
     path_dir = dirname(path)
     if path_dir and not exists(path_dir):
         logging.info(f"Creating non-existent output directory [{path_dir}]")
-        makedirs(path_dir)
+        makedirs(path_dir, exist_ok=True)
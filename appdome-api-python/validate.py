@@ -2,27 +2,22 @@ import argparse
 import logging
 from time import sleep
 
-import requests
-
-from utils import (SERVER_API_V1_URL, request_headers, JSON_CONTENT_TYPE, validate_response, add_common_args,
-                   debug_log_request, log_and_exit, init_common_args, build_url)
+from utils import (SERVER_API_V1_URL, JSON_CONTENT_TYPE, validate_response, add_common_args,
+                   get_client, AppdomeError, init_common_args, build_url, exit_on_error)
 
 VALIDATION = 'validation'
 
 
 def validation_upload(api_key, file_path):
     url = build_url(SERVER_API_V1_URL, VALIDATION, 'upload')
-    headers = request_headers(api_key)
     with open(file_path, 'rb') as f:
         files = {'file': (file_path, f)}
-        debug_log_request(url, headers=headers, files=files)
-        return requests.post(url, headers=headers, files=files)
+        return get_client().post(url, api_key, files=files)
 
 
 def validation_status(api_key, validation_id):
     url = build_url(SERVER_API_V1_URL, VALIDATION, validation_id, 'status')
-    headers = request_headers(api_key, JSON_CONTENT_TYPE)
-    return requests.get(url, headers=headers)
+    return get_client().get(url, api_key, content_type=JSON_CONTENT_TYPE, log_request=False)
 
 
 def wait_for_validation_result(api_key, validation_id, timeout_sec=3600):
@@ -43,7 +38,7 @@ def wait_for_validation_result(api_key, validation_id, timeout_sec=3600):
             break
 
     if accumulated_sleep > timeout_sec:
-        log_and_exit(f"\nValidation did not complete in the specified timeout of: {timeout_sec} seconds")
+        raise AppdomeError(f"Validation did not complete in the specified timeout of: {timeout_sec} seconds")
 
     return status_response
 
@@ -55,7 +50,7 @@ def validate_app(api_key, file_path):
     upload_response_json = upload_response.json()
     validation_id = upload_response_json.get('id')
     if not validation_id:
-        log_and_exit('Error in upload validation response: ' + upload_response.text)
+        raise AppdomeError('Error in upload validation response: ' + upload_response.text)
 
     return wait_for_validation_result(api_key, validation_id)
 
@@ -67,6 +62,7 @@ def parse_arguments():
     return parser.parse_args()
 
 
+@exit_on_error
 def main():
     args = parse_arguments()
     init_common_args(args)